@@ -18,87 +18,586 @@
 
 from urllib import urlopen
 from optparse import OptionParser
+from Queue import Queue
 import time
 import datetime
+import calendar
+import cPickle
+import ctypes
+import ctypes.util
+import gzip
+import hashlib
+import httplib
+import io
+import math
+import select
+import signal
+import socket
+import subprocess
+import sys
+import traceback
+import urlparse
 
 import threading
 import os
+from multiprocessing.sharedctypes import RawArray
+
+# a clock for measuring intervals that, unlike time.time(), never jumps
+# python 2 has none, so call clock_gettime(CLOCK_MONOTONIC) where we know how
+def find_monotonic():
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c')).clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        t = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = find_monotonic()
+
+class CommandReader(object):
+    '''a urllist read from the output of a command such as a decompressor.
+       it only goes forwards, and counts the bytes read for tell()'''
+
+    def __init__(self, command):
+        self.proc = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1048576)
+        self.pos = 0
+
+    def readline(self):
+        line = self.proc.stdout.readline()
+        self.pos += len(line)
+        return line
+
+    def readlines(self, sizehint=0):
+        lines = self.proc.stdout.readlines(sizehint)
+        self.pos += sum(len(line) for line in lines)
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def tell(self):
+        return self.pos
+
+    # skip ahead to byte <pos>
+    def seek(self, pos):
+        if pos < self.pos:
+            raise IOError("can't seek backwards in the output of %s" % self.proc.pid)
+        while self.pos < pos:
+            data = self.proc.stdout.read(min(pos - self.pos, 1048576))
+            if not data:
+                break
+            self.pos += len(data)
+
+    def close(self):
+        self.proc.stdout.close()
+        self.proc.wait()
+
+# whether the urllist is gzip or zstd compressed, and so can't be seeked in
+# cheaply nor have its size taken; returns 'gzip', 'zstd' or None
+def urllist_compression(filename):
+    magic = open(filename, 'rb').read(4)
+    if magic.startswith('\x1f\x8b'):
+        return 'gzip'
+    if magic == '\x28\xb5\x2f\xfd':
+        return 'zstd'
+    return None
+
+# open the urllist, decompressing it on the fly if need be, starting at the
+# first line that starts after byte <start> of the uncompressed urllist
+def open_urllist(filename, start=0):
+    compression = urllist_compression(filename)
+    if compression == 'gzip':
+        # buffered, or GzipFile reads lines a byte at a time in python
+        urlfh = io.BufferedReader(gzip.GzipFile(filename), 1048576)
+    elif compression == 'zstd':
+        try:
+            urlfh = CommandReader(['zstd', '-dcq', filename])
+        except OSError as e:
+            print "Error: reading a zstd urllist requires the zstd command: %s" % e
+            exit(1)
+    else:
+        urlfh = open(filename)
+    if start:
+        urlfh.seek(start)
+        # throw out one line because we're probably in the middle of it
+        urlfh.readline()
+    return urlfh
+
+# read the next <chunk> bytes' worth of lines from the urllist (0 = all), but
+# none that start after byte <end>; the next shard starts with those
+def read_urllist(fh, chunk, end=None):
+    pos = fh.tell()
+    if end is not None and pos > end:
+        return []
+    lines = fh.readlines(chunk)
+    if end is not None:
+        for i, line in enumerate(lines):
+            if pos > end:
+                return lines[:i]
+            pos += len(line)
+    return lines
+
+class LineIndex(object):
+    '''a sidecar index of the urllist, <urllist>.idx, with the offset in the
+       uncompressed urllist of every <every>th line, so that a run can start
+       at an exact line and the urllist can be split exactly between
+       processes without reading through it.  it is ignored once the urllist
+       changes'''
+
+    def __init__(self, every, lines, size, offsets):
+        self.every = every
+        # the number of lines and of (uncompressed) bytes in the urllist
+        self.lines = lines
+        self.size = size
+        # offsets[i] is where line every * i starts, counting lines from 0
+        self.offsets = offsets
+
+    @staticmethod
+    def path(filename):
+        return filename + '.idx'
+
+    # read through the urllist and write its index
+    @classmethod
+    def build(cls, filename, every):
+        stat = os.stat(filename)
+        urlfh = open_urllist(filename)
+        offsets = []
+        lines = pos = 0
+        chunk = urlfh.readlines(1048576)
+        while chunk:
+            for line in chunk:
+                if not lines % every:
+                    offsets.append(pos)
+                lines += 1
+                pos += len(line)
+            chunk = urlfh.readlines(1048576)
+        urlfh.close()
+        index = cls(every, lines, pos, offsets)
+        out = open(cls.path(filename), 'w')
+        out.write("# geturls line index: every lines size urllist-size urllist-mtime, then offsets\n")
+        out.write("%s %s %s %s %s\n" % (every, lines, pos, stat.st_size, int(stat.st_mtime)))
+        for offset in offsets:
+            out.write("%s\n" % offset)
+        out.close()
+        return index
+
+    # the index of the urllist, or None if it has none or the urllist has changed since
+    @classmethod
+    def load(cls, filename):
+        try:
+            infh = open(cls.path(filename))
+        except IOError:
+            return None
+        infh.readline()
+        every, lines, size, filesize, mtime = [int(x) for x in infh.readline().split()]
+        stat = os.stat(filename)
+        if (filesize, mtime) != (stat.st_size, int(stat.st_mtime)):
+            print("Warning: ignoring %s, the urllist has changed since it was built" % cls.path(filename))
+            return None
+        return cls(every, lines, size, [int(x) for x in infh])
+
+    # the byte offset at which line number <line> starts, counting from 0
+    # reads up to <every> lines from the nearest indexed line before it
+    def line_offset(self, filename, line):
+        line = min(line, self.lines)
+        entry = min(line / self.every, len(self.offsets) - 1) if self.offsets else 0
+        if not self.offsets or line == entry * self.every:
+            return self.offsets[entry] if self.offsets else 0
+        return skip_lines(filename, self.offsets[entry], line - entry * self.every)
+
+# the byte offset of the line <lines> lines after the one starting at <offset>
+def skip_lines(filename, offset, lines):
+    # seek to the newline ending the line before, to have open_urllist() throw out just that
+    urlfh = open_urllist(filename, offset - 1 if offset else 0)
+    offset = urlfh.tell()
+    while lines:
+        chunk = urlfh.readlines(1048576)
+        if not chunk:
+            break
+        offset += sum(len(line) for line in chunk[:lines])
+        lines -= min(len(chunk), lines)
+    urlfh.close()
+    return offset
+
+# the point to open the urllist at with open_urllist() for it to start with
+# the line at byte <offset>
+def line_start(offset):
+    return offset - 1 if offset else 0
+
+# split the urllist into <processes> shards to the end, as the (start, end)
+# that open_urllist() and read_urllist() take for each.  with an index, the
+# shards start from the line at byte <offset> and are split at indexed lines,
+# into about as many lines each without reading any; otherwise they start
+# after byte <start> and are split evenly by bytes, each but the first
+# starting after a partial line
+def shard_urllist(filename, index, start, offset, processes):
+    if not index:
+        filesize = os.stat(filename).st_size
+        return [(start + (filesize - start) * i / processes,
+                 start + (filesize - start) * (i + 1) / processes)
+                for i in range(processes)]
+    # the indexed lines the shards after the first can start at
+    entries = [i for i, entry_offset in enumerate(index.offsets) if entry_offset > offset]
+    starts = [line_start(offset)]
+    for i in range(1, processes):
+        if entries:
+            starts.append(line_start(index.offsets[entries[len(entries) * i / processes]]))
+        else:
+            starts.append(line_start(index.size))
+    ends = starts[1:] + [index.size]
+    return [(shard_start, max(shard_start, end)) for shard_start, end in zip(starts, ends)]
+
+class Schedule(object):
+    '''when to send each URL in open-loop mode, in seconds from the start:
+       at a constant rate, along a linear ramp from one rate to another and
+       then at the latter, or at the timestamps of the urllist lines'''
+
+    # passed in - the rate, the (start rate, end rate, seconds) of a ramp, or
+    # replay and how many times faster than the original to replay
+    def __init__(self, rate=0, ramp=None, replay=False, speed=1.0):
+        self.rate = rate
+        self.ramp = ramp
+        self.replay = replay
+        self.speed = speed
+        # the timestamp of the first URL replayed
+        self.first = None
+
+    # the send time of the n-th URL (counting from 0), or of one logged at timestamp
+    def offset(self, n, timestamp=None):
+        if self.replay:
+            if self.first is None:
+                self.first = timestamp
+            return (timestamp - self.first) / self.speed
+        if self.ramp:
+            start, end, seconds = self.ramp
+            # the number of URLs sent by the end of the ramp
+            ramped = (start + end) / 2.0 * seconds
+            if n >= ramped:
+                return seconds + (n - ramped) / end
+            # solve start * t + (end - start) / seconds * t^2 / 2 = n for t
+            slope = (end - start) / float(seconds)
+            if slope == 0:
+                return n / float(start)
+            return (math.sqrt(start * start + 2 * slope * n) - start) / slope
+        return n / float(self.rate)
+
+    # split a '<timestamp> <url>' urllist line; timestamps are seconds since
+    # the epoch, or ISO 8601 UTC times like 2011-08-01T12:34:56.789Z
+    # returns None for the timestamp if it can't be parsed
+    @staticmethod
+    def parse_line(line):
+        fields = line.split(None, 1)
+        if len(fields) != 2:
+            return None, line
+        stamp, url = fields
+        try:
+            return float(stamp), url.strip()
+        except ValueError:
+            pass
+        try:
+            seconds = calendar.timegm(time.strptime(stamp[:19], "%Y-%m-%dT%H:%M:%S"))
+        except ValueError:
+            return None, url
+        fraction = stamp[19:].rstrip('Z')
+        if fraction.startswith('.') and fraction[1:].isdigit():
+            seconds += float(fraction)
+        return seconds, url.strip()
+
+class UrlReader(threading.Thread):
+    '''a thread that reads the urllist and hands it out to the UrlCallers
+       in batches, through a bounded queue'''
+
+    # passed in - the open urllist, how many bytes to read at a time (0 = all),
+    # the byte to stop reading at (None = the end of the file), the lines
+    # already read from it, how many URLs to put in a batch, and in open-loop
+    # mode the Schedule to hand out (url, send time) pairs along
+    def __init__(self, fh, chunk, end, lines, batch_size, schedule=None):
+        threading.Thread.__init__(self)
+        self.fh = fh
+        self.chunk = chunk
+        self.end = end
+        self.lines = lines
+        self.batch_size = batch_size
+        self.schedule = schedule
+        # the number of URLs scheduled so far
+        self.scheduled = 0
+
+    def run(self):
+        try:
+            lines = self.lines
+            while lines and not UrlCaller.stopped:
+                # skip comments and empty lines
+                urls = [url.strip() for url in lines]
+                urls = [url for url in urls if len(url) > 1 and not url.startswith('#')]
+                if self.schedule:
+                    urls = self.schedule_urls(urls)
+                for i in range(0, len(urls), self.batch_size):
+                    if UrlCaller.stopped:
+                        break
+                    # reversed, so that callers can pop() the URLs in order
+                    batch = urls[i:i + self.batch_size]
+                    batch.reverse()
+                    UrlCaller.batches.put(batch)
+                lines = read_urllist(self.fh, self.chunk, self.end)
+        finally:
+            # tell the callers we're done; each one passes it on to the next
+            UrlCaller.batches.put(None)
+
+    # pair up URLs with the time they are due to be sent
+    def schedule_urls(self, urls):
+        scheduled = []
+        for url in urls:
+            timestamp = None
+            if self.schedule.replay:
+                timestamp, url = self.schedule.parse_line(url)
+                if timestamp is None:
+                    print("  error unparseable timestamp: %s" % url)
+                    continue
+            scheduled.append((url, UrlCaller.schedule_start + self.schedule.offset(self.scheduled, timestamp)))
+            self.scheduled += 1
+        return scheduled
+
+class Histogram(object):
+    '''a fixed-size histogram of non-negative integers such as durations in
+       microseconds, in the manner of HdrHistogram: every power of two is
+       split into 64 linear buckets, so recorded values are kept to within
+       1.6%.  recording is O(1) without locking, so each thread keeps its own
+       and they get merged on read'''
+
+    SUB_BITS = 7
+    # durations of 2^35us (9.5 hours) and beyond all count as the largest
+    MAX_SHIFT = 28
+
+    def __init__(self):
+        self.counts = [0] * ((self.MAX_SHIFT + 2) << (self.SUB_BITS - 1))
+        self.count = 0
+        self.max = 0
+
+    # the bucket a value falls in
+    @classmethod
+    def index(cls, value):
+        shift = value.bit_length() - cls.SUB_BITS
+        if shift <= 0:
+            return value
+        if shift > cls.MAX_SHIFT:
+            return ((cls.MAX_SHIFT + 2) << (cls.SUB_BITS - 1)) - 1
+        return (shift << (cls.SUB_BITS - 1)) + (value >> shift)
+
+    # the smallest value counted in a bucket
+    @classmethod
+    def lowest(cls, index):
+        if index == 0:
+            return 0
+        return cls.highest(index - 1) + 1
+
+    # the largest value counted in a bucket
+    @classmethod
+    def highest(cls, index):
+        if index < (1 << cls.SUB_BITS):
+            return index
+        shift = (index >> (cls.SUB_BITS - 1)) - 1
+        return ((index - (shift << (cls.SUB_BITS - 1)) + 1) << shift) - 1
+
+    def record(self, value):
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    # add the counts of another histogram to this one
+    def merge(self, other):
+        counts = self.counts
+        for i, n in enumerate(other.counts):
+            if n:
+                counts[i] += n
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    # the values below which the given percentages of the counts fall, in one pass
+    def percentiles(self, percents):
+        results = []
+        targets = [max(int(math.ceil(self.count * percent / 100.0)), 1) for percent in percents]
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            while targets and seen >= targets[0]:
+                targets.pop(0)
+                results.append(min(self.highest(i), self.max))
+            if not targets:
+                break
+        return results + [0] * len(targets)
+
+    # the counts in power of two millisecond ranges, by range upper bound
+    def ranges(self):
+        ranges = {}
+        for i, n in enumerate(self.counts):
+            if n:
+                key = 1
+                while key * 1000 <= self.highest(i):
+                    key *= 2
+                ranges[key] = ranges.get(key, 0) + n
+        return ranges
+
+class ConnectionPool(object):
+    '''persistent HTTP connections shared by all the UrlCallers, by scheme,
+       host and port, with at most max_per_host of them to any one host'''
+
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        # idle connections and a semaphore limiting connections in use, by host
+        self.idle = {}
+        self.slots = {}
+        # connections opened and requests sent over a reused connection
+        self.opened = 0
+        self.reused = 0
+
+    # the pool key of a urlsplit() result
+    @staticmethod
+    def host_key(split):
+        port = split.port or (443 if split.scheme == 'https' else 80)
+        return (split.scheme, split.hostname, port)
+
+    # take a connection to the host, waiting if max_per_host are in use
+    # returns the connection and whether it was used before
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            slots = self.slots[key]
+        except KeyError:
+            slots = self.slots[key] = threading.Semaphore(self.max_per_host)
+        self.lock.release()
+        slots.acquire()
+        self.lock.acquire()
+        try:
+            conn = self.idle[key].pop()
+            self.reused += 1
+            reused = True
+        except (KeyError, IndexError):
+            self.opened += 1
+            reused = False
+        self.lock.release()
+        if not reused:
+            scheme, host, port = key
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(host, port)
+            else:
+                conn = httplib.HTTPConnection(host, port)
+        return conn, reused
+
+    # give back a connection that can take another request
+    def put(self, key, conn):
+        self.lock.acquire()
+        self.idle.setdefault(key, []).append(conn)
+        self.lock.release()
+        self.slots[key].release()
+
+    # give up on a connection
+    def discard(self, key, conn):
+        conn.close()
+        self.slots[key].release()
+
+    # takes the connections opened and requests that reused one, of one pool
+    # or added up over those of several processes
+    @staticmethod
+    def print_stats(opened, reused):
+        requests = opened + reused
+        print("Connection report: %s connections opened, %s of %s requests reused one (%s%%)" %
+              (opened, reused, requests, 100 * reused / max(requests, 1)))
 
 class UrlCaller(threading.Thread):
     '''a threaded object that will call URLs from the urllist'''
 
-    # the filehandle of the open url list file
-    urlfh = None
-    # a global urllist shared between all threads
-    urllist=[]
-    # the index of the next url to be read - lock this with self.poslock b/f editing
-    position=0
-    # the number of URLs we've tried so far
-    tried=0
-    # the number of URLs that have failed so far - lock this with failedlock b/f editing
-    failed=0
+    # the bounded queue of URL batches filled by the UrlReader
+    batches = None
+    # set to make all threads stop after the URL they are calling
+    stopped = False
+    # the ConnectionPool to call URLs over, or None to call them with urlopen
+    pool = None
+    # what to do with response bodies: discard them, or write the size, or
+    # the size and MD5 of each to body_log
+    body = 'discard'
+    body_log = None
+    # the number of bytes of a response body to read at a time
+    BODY_CHUNK = 65536
+    # the redirects the pooled client follows, and how many in a row, as urlopen does
+    REDIRECTS = (301, 302, 303, 307)
+    MAX_REDIRECTS = 10
+    # the query duration histograms kept, by outcome, to the first byte of
+    # the response and to the last
+    DURATIONS = [('success', 'ttfb'), ('success', 'ttlb'),
+                 ('failed', 'ttfb'), ('failed', 'ttlb'),
+                 ('exceptions', 'ttlb')]
+    # in open-loop mode, the monotonic() time URL send times are relative to
+    schedule_start = None
+    # all the UrlCallers, whose counters and duration histograms get added up for reports
+    callers = []
     # the time we started working
     starttime = None
     num_lines = 0
     total_lines = 0
-    # timing storage
-    queryduration_exception = []
-    queryduration_success = []
-    queryduration_failed = []
 
     # passed in - cmd line options though all we really need is delay
     def __init__(self, options):
         threading.Thread.__init__(self)
         self.delay = options.delay
         self.num_lines = UrlCaller.num_lines
-        self.poslock = threading.Lock()
-        self.failedlock = threading.Lock()
-        self.tryinglock = threading.Lock()
-
-        self.print_status_num = int(min(UrlCaller.total_lines / 10, 100000))
+        # the number of URLs this thread has tried and that have failed so far
+        # only this thread changes them, so they need no lock
+        self.tried = 0
+        self.failed = 0
+        # this thread's current batch of URLs, last one first
+        self.batch = []
+        # timing storage - query durations in microseconds, by outcome and to which byte
+        self.durations = dict((key, Histogram()) for key in UrlCaller.DURATIONS)
+        UrlCaller.callers.append(self)
 
     # thread entry.
     # go through urllist, exit when done
     def run(self):
         url = self.get_url()
         while url:
-            # skip comments and empty lines
-            url = url.strip()
-            if(len(url) <= 1 or url.startswith('#')):
-                url = self.get_url()
-                continue
-            self.call_url(url)
+            if UrlCaller.schedule_start is None:
+                self.call_url(url)
+            else:
+                # open loop: wait for the URL's send time, unless we're late already
+                url, sendtime = url
+                wait = sendtime - monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                self.call_url(url, sendtime)
             url = self.get_url()
             if self.delay:
                 time.sleep(self.delay)
 
-    # set the urllist globally
+    # set up the queue of URL batches, holding up to <size> batches
     @classmethod
-    def set_urllist(cls, urls):
-        UrlCaller.urllist = urls
-        UrlCaller.num_lines = len(urls)
+    def set_batches(cls, size):
+        UrlCaller.batches = Queue(size)
 
-    # set the urllist filehandle globally
-    # takes an open filehandle and a chunksize (0 = infinite)
-    # FIXME set_urllist needs to be called with a chunk before calling this but it shouldn't
+    # estimate the number of lines in the urllist
+    # takes the number of bytes we're to read of it, the chunksize (0 = infinite) and the first chunk read from it
     @classmethod
-    def set_urlfh(cls, fh, chunk, position):
-        UrlCaller.urlfh = fh
-        UrlCaller.chunk = chunk
-        filesize = os.fstat(fh.fileno()).st_size  # size in bytes
-        if position:
-            # if we were suposed to start part way through the file, only count the remaining % of the file
-            filesize = int((float(filesize) * position / 100))
+    def set_urlfh(cls, filesize, chunk, urls):
+        UrlCaller.num_lines = len(urls)
         if (filesize > chunk and chunk != 0):
-            UrlCaller.total_lines = len(UrlCaller.urllist) * (float(filesize) / chunk)
+            UrlCaller.total_lines = len(urls) * (float(filesize) / chunk)
         else:
-            UrlCaller.total_lines = len(UrlCaller.urllist)
+            UrlCaller.total_lines = len(urls)
 
-    # set position in the urllist
-    # used when you don't want to start at the beginning
+    # make the reader and all the threads finish up
     @classmethod
-    def set_position(cls, pos):
-        UrlCaller.position = pos
+    def stop(cls):
+        UrlCaller.stopped = True
 
     # set the starttime globally
     @classmethod
@@ -107,180 +606,187 @@ class UrlCaller(threading.Thread):
 
     # get the next URL to load
     # returns a url or None if we're finished
-    # prints status every so often
     def get_url(self):
-        self.poslock.acquire()
-        pos = UrlCaller.position
-        try:
-            url = UrlCaller.urllist[pos]
-            UrlCaller.position += 1
-        except IndexError:
-            # we're done with our chunk - read in some more!
-            UrlCaller.urllist = UrlCaller.urlfh.readlines(UrlCaller.chunk)
-            if (len(UrlCaller.urllist) == 0):
-                # if we're really done
-                url = None
-            else:
-                # return the first URL and keep going
-                url = UrlCaller.urllist[0]
-                UrlCaller.position = 1
-        self.poslock.release()
-
-        #only print status every print_status_num requests, and skip 100%
-        tried = UrlCaller.tried
-        if(tried > 0 and url and not tried % self.print_status_num):
-            # lock both counters so we get a consistent view
-            # note that pos here is likely different from pos right above
-            # so it may not be an even number
-            self.poslock.acquire()
-            self.failedlock.acquire()
-            self.tryinglock.acquire()
-            self.print_status()
-            self.tryinglock.release()
-            self.failedlock.release()
-            self.poslock.release()
-            percent_done = 100 * tried / self.total_lines
-            curtime = datetime.datetime.now()
-            exectime = curtime - self.starttime
-            #print("status report: progress: %s%%, %s URLs tried, %s URLs failed, execution time: %s" %\
-            #        (int(percent_done) + 1, tried, fail, exectime))
-        return url
+        if UrlCaller.stopped:
+            return None
+        if not self.batch:
+            # we're done with our batch - get another one
+            self.batch = UrlCaller.batches.get()
+            if self.batch is None:
+                # we're really done; let the next thread know too
+                UrlCaller.batches.put(None)
+                return None
+        return self.batch.pop()
+
+    # the number of URLs all the threads have tried so far
+    @classmethod
+    def total_tried(cls):
+        return sum(caller.tried for caller in UrlCaller.callers)
+
+    # the number of URLs that have failed so far in all the threads
+    @classmethod
+    def total_failed(cls):
+        return sum(caller.failed for caller in UrlCaller.callers)
 
     @classmethod
     def print_status(cls):
-        pos = UrlCaller.position
-        tried = UrlCaller.tried
-        fail = UrlCaller.failed
+        tried = UrlCaller.total_tried()
+        fail = UrlCaller.total_failed()
         percent_done = 100 * tried / UrlCaller.total_lines
         curtime = datetime.datetime.now()
         exectime = curtime - UrlCaller.starttime
         print("status report: progress: %s%%, %s URLs tried, %s URLs failed, execution time: %s" %
               (int(percent_done) + 1, tried, fail, exectime))
 
+    # merge the duration histograms of all the threads
     @classmethod
-    def crunch_querydur_stats(cls):
-        '''calculate statistics around query duration'''
-        exceptions = cls.queryduration_exception[:]
-        failed = cls.queryduration_failed[:]
-        success = cls.queryduration_success[:]
-        exceptions.sort()
-        exceptions.reverse()
-        failed.sort()
-        failed.reverse()
-        success.sort()
-        success.reverse()
-        min_dur = 0
-        max_dur = 0
-        for l in [exceptions, failed, success]:
-            try:
-                min_dur = min(l)
-                max_dur = max(l)
-            except ValueError:
-                pass
-        #min_dur = min(min(exceptions),min(failed),min(success))
-        #max_dur = max(max(exceptions),max(failed),max(success))
-
-        # count durations - bucket them by dur length
+    def merge_durations(cls):
+        histograms = {}
+        for key in UrlCaller.DURATIONS:
+            histograms[key] = Histogram()
+            for caller in UrlCaller.callers:
+                histograms[key].merge(caller.durations[key])
+        return histograms
+
+    # takes the histograms to report on, by default those of this process's threads
+    @classmethod
+    def crunch_querydur_stats(cls, histograms=None):
+        '''report query duration percentiles and distribution'''
+        if histograms is None:
+            histograms = UrlCaller.merge_durations()
+
+        names = {'success': 'successes', 'failed': 'failures', 'exceptions': 'exceptions'}
+        print "Query duration report (milliseconds, to the first byte of the response and to the last):"
+        print "                       count        p50        p90        p99      p99.9        max"
+        for key in UrlCaller.DURATIONS:
+            histogram = histograms[key]
+            print(" %16s: %9s %s" % ("%s %s" % (names[key[0]], key[1]), histogram.count,
+                  ' '.join("%10.3f" % (value / 1000.0)
+                           for value in histogram.percentiles([50, 90, 99, 99.9]) + [histogram.max])))
+
+        # count durations to the last byte in power of two millisecond ranges
         dur_buckets = {}
         num_durs = {}
-        for l in ['exceptions', 'failed', 'success']:
-            queries = locals()[l]
-            dur_buckets[l] = {}
-            cur_dur = 0
-            min_dur_range = 0
-            max_dur_range = 0
-            # iterate from 0 to the longest duration query
-            while len(queries) > 0 and cur_dur <= max(queries):
-                min_dur_range = cur_dur
-                max_dur_range = int(cur_dur * 1.25)
-                key = "%s-%s" % (min_dur_range, max_dur_range)
-                dur_buckets[l][key] = 0
-                # iterate from the current index to 150% of that duration
-                while cur_dur <= max_dur_range:
-                    # if queries is empty, we're done
-                    if len(queries) == 0:
-                        cur_dur += 1
-                        continue
-                    # if the currently lowest duration is lower than our max range, add it to the bucket
-                    if queries[-1] <= max_dur_range:
-                        queries.pop()
-                        dur_buckets[l][key] += 1
-                    else:
-                        # we've collected all the durations that belong in this bucket
-                        # bump the counter to the next bucket
-                        cur_dur = max_dur_range + 1
-
-            num_durs[l] = sum(int(x) for x in dur_buckets[l].values())
-            # if a list is empty, set the num to 1 to protect against div-by-zero later
-            num_durs[l] = (1 if num_durs[l] == 0 else num_durs[l])
-        # clear out empty hash buckets
-        for key in dur_buckets['success'].keys():
-            # make sure the buckets exist in the other lists
-            for l in ['failed', 'exceptions']:
-                try:
-                    dur_buckets[l][key] += 0
-                except KeyError:
-                    dur_buckets[l][key] = 0
-            if dur_buckets['success'][key] == 0 \
-                    and dur_buckets['failed'][key] == 0 \
-                    and dur_buckets['exceptions'][key] == 0:
-                del dur_buckets['success'][key]
-                del dur_buckets['failed'][key]
-                del dur_buckets['exceptions'][key]
-
-        # sort based on the first number in the ###-### key
-        dur_buckets_keys = dur_buckets['success'].keys()
-        dur_buckets_keys.sort(lambda x,y: cmp(int(x), int(y)), lambda x: x.split('-')[0])
-        print "Query duration report:"
+        for l in ['success', 'failed', 'exceptions']:
+            dur_buckets[l] = histograms[(l, 'ttlb')].ranges()
+            # if a histogram is empty, set the num to 1 to protect against div-by-zero later
+            num_durs[l] = max(histograms[(l, 'ttlb')].count, 1)
+        dur_buckets_keys = set()
+        for l in dur_buckets:
+            dur_buckets_keys.update(dur_buckets[l])
         print "       dur: number of queries that took within <dur> range (in milliseconds)"
         print "               successes         failures        exceptions"
-        for key in dur_buckets_keys:
-            sucval = dur_buckets['success'][key]
-            try:
-                failval = dur_buckets['failed'][key]
-            except KeyError:
-                failval = 0
-            try:
-                excval = dur_buckets['exceptions'][key]
-            except KeyError:
-                excval = 0
+        for key in sorted(dur_buckets_keys):
+            sucval = dur_buckets['success'].get(key, 0)
+            failval = dur_buckets['failed'].get(key, 0)
+            excval = dur_buckets['exceptions'].get(key, 0)
             print(" %9s: %5s  (%2s%%)  |  %5s  (%2s%%)  |  %5s  (%2s%%)" %
-                  (key, sucval, int(float(sucval) / num_durs['success'] * 100),
+                  ("%s-%s" % (key / 2, key), sucval, int(float(sucval) / num_durs['success'] * 100),
                    failval, int(float(failval) / num_durs['failed'] * 100),
                    excval, int(float(excval) / num_durs['exceptions'] * 100)))
 
     # call out to the net and retrieve the URL
     # record failures, throw away success
-    def call_url(self, url=None):
-        self.tryinglock.acquire()
-        UrlCaller.tried += 1
-        self.tryinglock.release()
+    # in open-loop mode durations count from when the URL was due to be sent
+    # rather than from when it was, so that they include any queueing
+    def call_url(self, url=None, sendtime=None):
+        self.tried += 1
+        starttime = monotonic() if sendtime is None else sendtime
         try:
-            starttime = datetime.datetime.now()
-            req = urlopen(url)
-        except IOError as e:
+            if UrlCaller.pool:
+                resp, firstbyte, size, checksum = self.fetch_keepalive(url)
+            else:
+                resp, firstbyte, size, checksum = self.fetch_urlopen(url)
+        except (IOError, httplib.HTTPException) as e:
             # urlopen throws an exception on HTTP 401 but not on 404.
-            endtime = datetime.datetime.now()
-            dur = endtime - starttime
-            # store timing data in milliseconds
-            self.queryduration_exception.append(int((dur.seconds * 1000000) + dur.microseconds / 1000))
-            print("  error %s: %s" % (e[1], url))
-            self.failedlock.acquire()
-            UrlCaller.failed += 1
-            self.failedlock.release()
+            # store timing data in microseconds
+            self.durations[('exceptions', 'ttlb')].record(int((monotonic() - starttime) * 1000000))
+            print("  error %s: %s" % (e.args[-1] if e.args else e.__class__.__name__, url))
+            self.failed += 1
             return
-        endtime = datetime.datetime.now()
-        dur = endtime - starttime
+        dur = int((monotonic() - starttime) * 1000000)
+        ttfb = int((firstbyte - starttime) * 1000000)
         # store the HTTP return code from the query
-        resp = req.getcode()
         if resp != 200:
-            self.queryduration_failed.append(int((dur.seconds * 1000000) + dur.microseconds / 1000))
+            self.durations[('failed', 'ttfb')].record(ttfb)
+            self.durations[('failed', 'ttlb')].record(dur)
             print("  error %s: %s" % (resp, url))
-            self.failedlock.acquire()
-            UrlCaller.failed += 1
-            self.failedlock.release()
+            self.failed += 1
         else:
-            self.queryduration_success.append(int((dur.seconds * 1000000) + dur.microseconds / 1000))
+            self.durations[('success', 'ttfb')].record(ttfb)
+            self.durations[('success', 'ttlb')].record(dur)
+        if UrlCaller.body != 'discard':
+            UrlCaller.body_log.write("%s %s %s %s\n" % (resp, size, checksum or '-', url))
+
+    # read a response body BODY_CHUNK bytes at a time, keeping none of it
+    # returns its size, and its MD5 in checksum mode
+    def read_body(self, response):
+        size = 0
+        md5 = hashlib.md5() if UrlCaller.body == 'checksum' else None
+        while True:
+            data = response.read(UrlCaller.BODY_CHUNK)
+            if not data:
+                break
+            size += len(data)
+            if md5:
+                md5.update(data)
+        return size, md5 and md5.hexdigest()
+
+    # call out to the net with urlopen, on a new connection
+    # returns the HTTP status, the time the response headers were in, and
+    # the body's size and checksum
+    def fetch_urlopen(self, url):
+        response = urlopen(url)
+        firstbyte = monotonic()
+        try:
+            size, checksum = self.read_body(response)
+        finally:
+            response.close()
+        return (response.getcode(), firstbyte, size, checksum)
+
+    # call out to the net over pooled persistent connections, following
+    # redirects as urlopen does
+    # returns the same as fetch_urlopen, for the last response
+    def fetch_keepalive(self, url):
+        for i in range(UrlCaller.MAX_REDIRECTS + 1):
+            resp, location, firstbyte, size, checksum = self.get_keepalive(url)
+            if resp not in UrlCaller.REDIRECTS or location is None:
+                return (resp, firstbyte, size, checksum)
+            url = urlparse.urljoin(url, location)
+            if urlparse.urlsplit(url).scheme not in ('http', 'https'):
+                raise IOError('redirect to %s' % url)
+        # urlopen answers redirect loops with a 500 too
+        return (500, firstbyte, size, checksum)
+
+    # GET a URL over a pooled persistent connection to its host, reading the
+    # whole response so that the connection can be reused
+    # returns the HTTP status, the Location header, the time the response
+    # headers were in, and the body's size and checksum
+    def get_keepalive(self, url):
+        split = urlparse.urlsplit(url)
+        path = split.path or '/'
+        if split.query:
+            path += '?' + split.query
+        key = ConnectionPool.host_key(split)
+        while True:
+            conn, reused = UrlCaller.pool.get(key)
+            try:
+                conn.request('GET', path)
+                # buffered, or httplib reads the status line and headers a byte at a time
+                response = conn.getresponse(buffering=True)
+                firstbyte = monotonic()
+                size, checksum = self.read_body(response)
+            except (IOError, httplib.HTTPException) as e:
+                UrlCaller.pool.discard(key, conn)
+                # the server may have closed an idle connection; try the next one
+                if reused and not isinstance(e, socket.timeout):
+                    continue
+                raise
+            if response.will_close:
+                UrlCaller.pool.discard(key, conn)
+            else:
+                UrlCaller.pool.put(key, conn)
+            return (response.status, response.getheader('location'), firstbyte, size, checksum)
 
 class PrintStatus(threading.Thread):
     '''a class that prints current status when the user hits return'''
@@ -291,116 +797,266 @@ class PrintStatus(threading.Thread):
 
     def run(self):
         while(True):
-            raw_input()
+            # wait for input with select so that greenlets keep running
+            select.select([sys.stdin], [], [])
+            try:
+                raw_input()
+            except EOFError:
+                # no terminal to read from
+                return
             UrlCaller.print_status()
+            self.timer_thread.print_short_stats()
+            if UrlCaller.pool:
+                ConnectionPool.print_stats(UrlCaller.pool.opened, UrlCaller.pool.reused)
             UrlCaller.crunch_querydur_stats()
             self.timer_thread.print_full_stats()
 
 class TimingCollector(threading.Thread):
     '''a class to collect per-second throughput data.
-       maintains how many qps have gone by the previous second, the previous 5
-       seconds and 30 seconds, and a hash of how many seconds have a specific
-       qps throughput (i.e. there were 26 seconds during which throughput was
-       110qps)'''
-    cur_sec = 0
-    last_five_sec = [0,0,0,0,0]
-    last_thirty_sec = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
-    throughput_frequency = {}
-    last_pos = 0
-    def __init__(self):
+       every second by the monotonic clock it counts the queries of the past
+       second into a ring buffer of the last 30 seconds, for the current, 5s
+       and 30s throughput, and into a Histogram of how many seconds had a
+       specific qps throughput (i.e. there were 26 seconds during which
+       throughput was 110qps), which takes the same memory however long we run'''
+    # the number of seconds of samples kept
+    WINDOW = 30
+    # the monotonic() time seconds are counted from, shared by the collectors
+    # of all processes so that they sample at the same moments
+    origin = None
+
+    # passed in - a function returning the number of queries so far, whether
+    # to print status every 10% or 100k lines, the RawArray and index to
+    # publish the number of queries to at every sample (for the parent of a
+    # worker process), and how long after each second to sample
+    def __init__(self, counter, status=False, shared=None, offset=0):
         threading.Thread.__init__(self)
-        cur_sec = 0
-        last_five_sec = [0,0,0,0,0]
-        last_thirty_sec = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
-        throughput_frequency = {}
-        last_pos = 0
+        self.counter = counter
+        self.status = status
+        self.shared = shared
+        self.offset = offset
+        # queries per second, the last one at samples[(seconds - 1) % WINDOW]
+        self.samples = [0] * self.WINDOW
+        # the number of seconds sampled so far
+        self.seconds = 0
+        self.last_pos = 0
+        self.throughput_frequency = Histogram()
+        self.print_status_num = None
 
     def run(self):
-        #self.setDaemon(True)
         while True:
-            # populate cur_sec, last_*_sec
+            # wait for the end of the next second by the clock, rather than
+            # for a second after the last sample, so that we don't drift
+            wait = TimingCollector.origin + self.offset + self.seconds + 1 - monotonic()
+            if wait > 0:
+                time.sleep(wait)
             self.collect_positions()
-            # wait a second, then do it all over again.
-            time.sleep(1)
 
     def collect_positions(self):
-        cur_time = datetime.datetime.now().second
-        cur_pos = UrlCaller.tried
-        # cur_sec hold how many queries we hit this most recent second
-        self.cur_sec = cur_pos - self.last_pos
-        self.last_five_sec[cur_time % 5] = self.cur_sec
-        self.last_thirty_sec[cur_time % 30] = self.cur_sec
-        # add cur_sec to overall stats
-        try:
-            self.throughput_frequency[self.cur_sec] += 1
-        except KeyError:
-            self.throughput_frequency[self.cur_sec] = 1
+        now = int(monotonic() - TimingCollector.origin - self.offset)
+        elapsed = now - self.seconds
+        if elapsed < 1:
+            return
+        cur_pos = self.counter()
+        if self.shared:
+            array, index = self.shared
+            array[index] = cur_pos
+        count = cur_pos - self.last_pos
+        # if we were held up past the end of more than one second, share
+        # the queries out between them rather than lose track of any
+        for i in range(elapsed):
+            cur_sec = count / elapsed + (1 if i < count % elapsed else 0)
+            self.samples[(self.seconds + i) % self.WINDOW] = cur_sec
+            self.throughput_frequency.record(cur_sec)
+        self.seconds = now
+        # print status every 10% or 100k lines
+        if self.status:
+            if self.print_status_num is None:
+                self.print_status_num = max(int(min(UrlCaller.total_lines / 10, 100000)), 1)
+            if cur_pos / self.print_status_num > self.last_pos / self.print_status_num:
+                UrlCaller.print_status()
         # get ready for the next run
         self.last_pos = cur_pos
 
-    def get_curent_throughput(self):
-        pass
+    # the average queries per second over the last <seconds> seconds sampled
+    def get_avg_throughput(self, seconds):
+        seconds = min(seconds, self.seconds, self.WINDOW)
+        if not seconds:
+            return 0
+        return sum(self.samples[(self.seconds - 1 - i) % self.WINDOW] for i in range(seconds)) / float(seconds)
+    def get_current_throughput(self):
+        return self.get_avg_throughput(1)
     def get_5s_avg_throughput(self):
-        pass
+        return self.get_avg_throughput(5)
     def get_30s_avg_throughput(self):
-        pass
-    def get_oveall_stats(self):
-        pass
+        return self.get_avg_throughput(30)
     def print_short_stats(self):
         '''prints a one-liner with curren, 5s, and 30s throughput'''
-        five_avg = sum(int(x) for x in self.last_five_sec) / 5
-        thirty_avg = sum(int(x) for x in self.last_thirty_sec) / 30
-        print ("Current throughput: %s queries per second.  Last 5s avg: %sqps.  Last 30s avg: %sqps" %
-               (self.cur_sec, five_avg, thirty_avg))
+        print ("Current throughput: %.1f queries per second.  Last 5s avg: %.1fqps.  Last 30s avg: %.1fqps" %
+               (self.get_current_throughput(), self.get_5s_avg_throughput(), self.get_30s_avg_throughput()))
     def print_full_stats(self):
         '''Prints a few bucketted counts for throughput stats.'''
-        tp_hash = self.throughput_frequency
-        tp_keys = tp_hash.keys()
-        tp_keys.sort()
-        new_perf = {}
-        new_perf_keys = []
-        # if fewer than 10 items, just print.
-        #if len(tp_keys) < 10:
-        #    new_perf = self.throughput_frequency
-        # now for some fancy footwork.  To decrease the number of lines printed, combine nearby stats.
-        # for each key, calculate 10%.  Sum all keys that show up between key and key+10%, then report as key + 5% +-5%
-        tp_keys.reverse()  # work from small numbers up
-        real_max = tp_keys[0]
-        while len(tp_keys) > 0:
-            key = tp_keys.pop()
-            if(key == 0):
-                next
-            perfsum = 0
-            min_key = key
-            max_key = key + int(float(key) * 0.1)
-            while key < max_key:
-                # add the key's value to the sum if it exists
-                perfsum += tp_hash[key]
-                # remove it from the list
-                try:
-                    key = tp_keys.pop()
-                except IndexError:
-                    # tp_keys is empty
-                    key = max_key
-                    tp_keys = None
-            # use the range of values covered as the key
-            new_perf["%s-%s" % (min_key, max_key)] = perfsum
-            # push the last one back onto the stack for the next round
-            try:
-                tp_keys.append(key)
-            except AttributeError:
-                # tp_keys was unset above
-                # reset to an empty list so the next while loop will fail
-                tp_keys = []
-        new_perf_keys = new_perf.keys()
-        # sort based on the first number in the ###-### key
-        new_perf_keys.sort(lambda x,y: cmp(int(x), int(y)), lambda x: x.split('-')[0])
-        num_seconds = sum(int(x) for x in new_perf.values())
+        histogram = self.throughput_frequency
+        # to decrease the number of lines printed, combine nearby stats:
+        # add up the buckets from each one that starts a range up to 10% above it
+        ranges = []
+        for i, n in enumerate(histogram.counts):
+            if not n:
+                continue
+            if ranges and histogram.highest(i) <= ranges[-1][0] + int(ranges[-1][0] * 0.1):
+                ranges[-1][1] = histogram.highest(i)
+                ranges[-1][2] += n
+            else:
+                ranges.append([histogram.lowest(i), histogram.highest(i), n])
 
         print "Throughput report:"
         print "       qps: number of seconds during which performance was in that qps range"
-        for key in new_perf_keys:
-            print(" %9s: %5s   (%2s%%)" % (key, new_perf[key], int(float(new_perf[key]) / num_seconds * 100)))
+        for min_key, max_key, perfsum in ranges:
+            print(" %9s: %5s   (%2s%%)" % ("%s-%s" % (min_key, min(max_key, histogram.max)),
+                                          perfsum, 100 * perfsum / histogram.count))
+
+
+def use_gevent():
+    '''turn the UrlCaller and helper threads into greenlets, and make the
+       socket, select and sleep calls they make cooperative'''
+    try:
+        import gevent
+        from gevent import monkey
+    except ImportError as e:
+        print "Error: -e gevent requires gevent: %s" % e
+        exit(1)
+    monkey.patch_all()
+    # ctrl-c would raise KeyboardInterrupt in whichever greenlet is running
+    gevent.signal(signal.SIGINT, UrlCaller.stop)
+
+
+def call_urls(options, filename, start, end, schedule, shared=None):
+    '''call the URLs in the urllist from byte <start> to byte <end> (None
+       = the end of the file) with this process's threads, and return the
+       counters and duration histograms of the run, and its TimingCollector.
+       a worker process passes in the RawArray and index to publish the
+       number of URLs tried in for its parent'''
+    if options.engine == "gevent":
+        use_gevent()
+
+    # open the file, seek to the middle if necessary, then set up the UrlCaller class
+    urlfh = open_urllist(filename, start)
+    urls = read_urllist(urlfh, options.chunk, end)
+    # without an index, we only know the size of a compressed urllist as compressed
+    UrlCaller.set_urlfh((end if end is not None else os.stat(filename).st_size) - start, options.chunk, urls)
+    UrlCaller.set_batches(options.num_threads * 4)
+    UrlCaller.set_starttime(datetime.datetime.now())
+    UrlCaller.body = options.body
+    if options.body != 'discard':
+        # appended to a line at a time, so that the lines of several processes don't get mixed
+        UrlCaller.body_log = open(options.body_log, 'a', 1) if options.body_log else sys.stdout
+    if options.keepalive > 0:
+        UrlCaller.pool = ConnectionPool(options.keepalive)
+
+    # start reading the urllist into batches for the threads
+    if schedule and UrlCaller.schedule_start is None:
+        # leave the threads a moment to start
+        UrlCaller.schedule_start = monotonic() + 0.1
+    reader = UrlReader(urlfh, options.chunk, end, urls, options.batch, schedule)
+    reader.setDaemon(True)
+    reader.start()
+
+    # launch threads to go through the urllist
+    threads = {}
+    for i in range(options.num_threads):
+        uc = UrlCaller(options)
+        uc.start()
+        threads[i] = uc
+
+    # start up the status printing and timing thread
+    timer = TimingCollector(UrlCaller.total_tried, status=True, shared=shared)
+    timer.setDaemon(True)
+    timer.start()
+    if shared is None:
+        status_printer = PrintStatus(timer)
+        status_printer.setDaemon(True)
+        status_printer.start()
+
+    # wait until we're done before joining the threads
+    # so that we can catch ctrl-c
+    try:
+        while any(thread.isAlive() for thread in threads.itervalues()):
+            time.sleep(0.5)  # 1/2 second is reasonably responsive
+    except KeyboardInterrupt:
+        # tell the reader and all the threads that they're done
+        UrlCaller.stop()
+
+    # pick up all the threads
+    for num in threads.iterkeys():
+        threads[num].join()
+
+    pool = UrlCaller.pool
+    return ({'tried': UrlCaller.total_tried(),
+             'failed': UrlCaller.total_failed(),
+             'connections': (pool.opened, pool.reused) if pool else None,
+             'durations': UrlCaller.merge_durations()},
+            timer)
+
+def call_urls_processes(options, filename, shards, schedule):
+    '''call the URLs of each of the (start, end) byte ranges of the urllist
+       in a worker process of its own, and return the results of all of them
+       added up, and a TimingCollector of the throughput of all of them'''
+    # the number of URLs each worker has tried, as of its last sample
+    tried = RawArray(ctypes.c_longlong, options.processes)
+    # the pending output would get printed by every worker too
+    sys.stdout.flush()
+    workers = []
+    for i, (shard_start, shard_end) in enumerate(shards):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            # line buffered, so that lines of different workers don't get mixed
+            sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)
+            status = 1
+            try:
+                results, timer = call_urls(options, filename, shard_start, shard_end, schedule, (tried, i))
+                out = os.fdopen(wfd, 'wb')
+                cPickle.dump(results, out, cPickle.HIGHEST_PROTOCOL)
+                out.close()
+                status = 0
+            except:
+                traceback.print_exc()
+            sys.stdout.flush()
+            os._exit(status)
+        os.close(wfd)
+        workers.append((pid, rfd))
+
+    # ctrl-c reaches the workers too; let them stop and report back
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # sample a moment after the workers do, to see what they saw
+    timer = TimingCollector(lambda: sum(tried), offset=0.5)
+    timer.setDaemon(True)
+    timer.start()
+    all_results = []
+    for i, (pid, rfd) in enumerate(workers):
+        infh = os.fdopen(rfd, 'rb')
+        data = infh.read()
+        infh.close()
+        status = os.waitpid(pid, 0)[1]
+        if data:
+            all_results.append(cPickle.loads(data))
+        else:
+            print("Error: process %s (pid %s) exited with status %s without results" % (i, pid, status))
+    return merge_results(all_results), timer
+
+def merge_results(all_results):
+    '''add up the results of several call_urls() runs'''
+    merged = {'tried': 0, 'failed': 0, 'connections': None,
+              'durations': dict((key, Histogram()) for key in UrlCaller.DURATIONS)}
+    for results in all_results:
+        merged['tried'] += results['tried']
+        merged['failed'] += results['failed']
+        if results['connections']:
+            opened, reused = merged['connections'] or (0, 0)
+            merged['connections'] = (opened + results['connections'][0], reused + results['connections'][1])
+        for key in merged['durations']:
+            merged['durations'][key].merge(results['durations'][key])
+    return merged
 
 
 def main():
@@ -412,15 +1068,45 @@ def main():
     parser.add_option("-d", dest="delay", default=0, help="delay in milliseconds between calling URLs. default %default")
     parser.add_option("-t", dest="num_threads", default=1, help="number of threads.  default %default")
     parser.add_option("-r", dest="resume", default=0, help="start <resume>% of the way through the urllist. range 1-100")
+    parser.add_option("-l", dest="line", default=0, type="int", help="start at line <line> of the urllist, the first being 1")
+    parser.add_option("--build-index", dest="build_index", default=0, type="int",
+                      help="write <urllist>.idx with the offset of every <build_index>th line and exit.  later runs use it to start at exact lines with -l and -r, and to split the urllist between --processes, without reading through it; compressed urllists need it for those")
     parser.add_option("-c", dest="chunk", default=100, help="Number of MB to read from urllist at a time.  0 is all.  default %default")
+    parser.add_option("-e", dest="engine", default="threads", type="choice", choices=["threads", "gevent"],
+                      help="call URLs from threads, or from gevent greenlets (-t sets the number of greenlets).  default %default")
+    parser.add_option("-k", dest="keepalive", default=None, help="maximum keep-alive connections per host; 0 calls every URL with urlopen on a new connection.  either way redirects are followed.  default the number of threads")
+    parser.add_option("--body", dest="body", default="discard", type="choice", choices=["discard", "size", "checksum"],
+                      help="read response bodies and discard them, or also write the status, size and URL of each to --body-log, or the status, size, MD5 and URL.  default %default")
+    parser.add_option("--body-log", dest="body_log", default=None,
+                      help="file to write --body size or checksum lines to.  default stdout")
+    parser.add_option("-b", dest="batch", default=100, help="Number of URLs handed to a thread at a time.  default %default")
+    parser.add_option("--processes", dest="processes", default=1, type="int",
+                      help="split the urllist between <processes> worker processes, each with -t threads and -k connections per host of its own.  default %default")
+    parser.add_option("--rate", dest="rate", default=0, type="float",
+                      help="open loop: send URLs at <rate> per second whether or not earlier ones have returned, and time them from when they were due")
+    parser.add_option("--ramp", dest="ramp", default=None,
+                      help="open loop: ramp the rate from <start> to <end> URLs per second over <seconds>, then stay at <end>.  format start,end,seconds")
+    parser.add_option("--replay", dest="replay", default=False, action="store_true",
+                      help="open loop: urllist lines are '<timestamp> <url>'; send URLs at their original relative times")
+    parser.add_option("--speed", dest="speed", default=1.0, type="float",
+                      help="with --replay, replay this many times faster than the original.  default %default")
     (options, args) = parser.parse_args()
 
     #convert millisec to seconds for sleep()
     options.delay = float(options.delay) / 1000
     # convert num_threads, chunk, and position to int so we can do MATHS
-    num_threads = int(options.num_threads)
-    chunk = int(float(options.chunk) * 1048576)  # convert from bytes to MB
+    options.num_threads = int(options.num_threads)
+    options.chunk = int(float(options.chunk) * 1048576)  # convert from bytes to MB
+    options.batch = max(int(options.batch), 1)
+    options.keepalive = options.num_threads if options.keepalive is None else int(options.keepalive)
     position = float(options.resume)
+    if options.processes < 1:
+        parser.error("--processes must be at least 1")
+    if options.body_log:
+        if options.body == 'discard':
+            parser.error("--body-log needs --body size or --body checksum")
+        # start afresh; each process appends to it
+        open(options.body_log, 'w').close()
 
     # make sure we've got a urllist passed in
     if not args:
@@ -428,65 +1114,104 @@ def main():
         parser.print_help()
         exit(1)
 
+    if options.build_index > 0:
+        index = LineIndex.build(args[0], options.build_index)
+        print("Wrote %s: %s lines, %s bytes, an offset every %s lines" %
+              (LineIndex.path(args[0]), index.lines, index.size, index.every))
+        exit(0)
+    index = LineIndex.load(args[0])
+    compression = urllist_compression(args[0])
+    if options.line and position:
+        parser.error("use only one of -r and -l")
+
+    # rates are shared out between the processes, as the urllist is
+    schedule = None
+    if options.ramp:
+        try:
+            ramp = [float(x) for x in options.ramp.split(',')]
+            if len(ramp) != 3 or min(ramp) < 0 or ramp[1] <= 0 or ramp[2] <= 0:
+                raise ValueError
+        except ValueError:
+            parser.error("--ramp takes start,end,seconds with end and seconds above 0")
+        schedule = Schedule(ramp=[ramp[0] / options.processes, ramp[1] / options.processes, ramp[2]])
+    if options.rate < 0 or options.speed <= 0:
+        parser.error("--rate must not be negative and --speed must be positive")
+    if options.rate:
+        schedule = Schedule(rate=options.rate / options.processes)
+    if options.replay:
+        schedule = Schedule(replay=True, speed=options.speed)
+    if len([x for x in (options.rate, options.ramp, options.replay) if x]) > 1:
+        parser.error("use only one of --rate, --ramp and --replay")
+    if schedule and options.delay:
+        parser.error("-d only applies to closed-loop runs, not --rate, --ramp or --replay")
+    if schedule:
+        # each URL needs its own thread at its send time, not a batch after the previous one
+        options.batch = 1
+
     # record our starting time so we can show stats at the end
     starttime = datetime.datetime.now()
 
-    # open the file, seek to the middle if necessary, then set up the UrlCaller class
-    urlfh = open(args[0])
-    # if -r was specified, start % way through the list
-    if position:
-        filesize = os.fstat(urlfh.fileno()).st_size
-        urlfh.seek(int(float(filesize) * position / 100))
-        # throw out one line because we're probably in the middle of it
-        urlfh.readline()
-    # set up the UrlCaller class
-    urls = urlfh.readlines(chunk)
-    UrlCaller.set_urllist(urls)
-    UrlCaller.set_urlfh(urlfh, chunk, position)
-    UrlCaller.set_starttime(starttime)
+    # if -l or -r was specified, start at that line or % way through the
+    # list; start is where to open_urllist() at and, if known, offset is the
+    # byte at which the first line we call starts
+    start = 0
+    offset = 0
+    if options.line > 1:
+        line = options.line - 1
+        offset = index.line_offset(args[0], line) if index else skip_lines(args[0], 0, line)
+        start = line_start(offset)
+    elif position:
+        if index:
+            offset = index.line_offset(args[0], int(index.lines * position / 100))
+            start = line_start(offset)
+        elif compression:
+            parser.error("-r on a compressed urllist needs a line index; write one with --build-index")
+        else:
+            start = int(float(os.stat(args[0]).st_size) * position / 100)
+            offset = None
+    if options.processes > 1 and compression and not index:
+        parser.error("--processes on a compressed urllist needs a line index; write one with --build-index")
 
     # print header
     print ""
     print "   About to start calling all these URLs."
-    print "   I'll print status every 10% or 100k lines"
-    print "   Press <return> at any time for current status."
+    if options.processes > 1:
+        print "   Each process will print status every 10% or 100k lines of its share."
+    else:
+        print "   I'll print status every 10% or 100k lines"
+        print "   Press <return> at any time for current status."
     print ""
-    print("Ok, starting %s%% of the way through the file." % int(position))
+    if options.line > 1:
+        print("Ok, starting at line %s of the file." % options.line)
+    else:
+        print("Ok, starting %s%% of the way through the file." % int(position))
 
-    # launch threads to go through the urllist
-    threads = {}
-    for i in range(num_threads):
-        uc = UrlCaller(options)
-        uc.start()
-        threads[i] = uc
-
-    # start up the status printing and timing thread
-    timer = TimingCollector()
-    timer.setDaemon(True)
-    timer.start()
-    status_printer = PrintStatus(timer)
-    status_printer.setDaemon(True)
-    status_printer.start()
-
-    # wait until we're done before joining the threads
-    # so that we can catch ctrl-c
-    try:
-        while len(UrlCaller.urllist) != 0:
-            time.sleep(0.5)  # 1/2 second is reasonably responsive
-    except KeyboardInterrupt:
-        #set postition to the end so that all the threads think they're done
-        urlfh.seek(0, os.SEEK_END)
-        UrlCaller.position = len(urls)
-
-    # pick up all the threads
-    for num in threads.iterkeys():
-        threads[num].join()
+    # the throughput of every process is sampled on the same seconds from here
+    TimingCollector.origin = monotonic()
+    if options.processes > 1:
+        if options.replay:
+            # every process replays relative to the first timestamp in the urllist
+            for line in open_urllist(args[0], start):
+                timestamp, url = Schedule.parse_line(line.strip())
+                if timestamp is not None:
+                    schedule.first = timestamp
+                    break
+        if schedule:
+            # leave the processes a moment to start
+            UrlCaller.schedule_start = monotonic() + 0.5
+        print("Splitting the urllist between %s processes." % options.processes)
+        shards = shard_urllist(args[0], index, start, offset, options.processes)
+        results, timer = call_urls_processes(options, args[0], shards, schedule)
+    else:
+        results, timer = call_urls(options, args[0], start, index.size if index else None, schedule)
 
     # calculate final stats and print summary
     endtime = datetime.datetime.now()
     exectime = endtime - starttime
-    print("Final summary: total: %s, failed: %s, execution time: %s" % (UrlCaller.tried, UrlCaller.failed, exectime))
-    UrlCaller.crunch_querydur_stats()
+    print("Final summary: total: %s, failed: %s, execution time: %s" % (results['tried'], results['failed'], exectime))
+    if results['connections']:
+        ConnectionPool.print_stats(*results['connections'])
+    UrlCaller.crunch_querydur_stats(results['durations'])
     timer.print_full_stats()
 
 if __name__ == '__main__':
@@ -0,0 +1,205 @@
+import gzip
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import geturls
+from geturls import Histogram, LineIndex
+
+class TestHistogram(unittest.TestCase):
+
+    # exact values, powers of two and their neighbours, and random ones up to past the largest bucket
+    def sample_values(self):
+        values = range(300)
+        for bits in range(7, 40):
+            values += [(1 << bits) - 1, 1 << bits, (1 << bits) + 1]
+        rand = random.Random(1)
+        values += [rand.randrange(1 << rand.randrange(1, 36)) for i in range(5000)]
+        return values
+
+    def test_buckets_contiguous(self):
+        last = (Histogram.MAX_SHIFT + 2) << (Histogram.SUB_BITS - 1)
+        self.assertEqual(Histogram.lowest(0), 0)
+        for i in range(last - 1):
+            self.assertEqual(Histogram.lowest(i + 1), Histogram.highest(i) + 1)
+            self.assertEqual(Histogram.index(Histogram.lowest(i)), i)
+            self.assertEqual(Histogram.index(Histogram.highest(i)), i)
+        self.assertEqual(len(Histogram().counts), last)
+
+    def test_values_within_bucket(self):
+        last = len(Histogram().counts) - 1
+        for value in self.sample_values():
+            index = Histogram.index(value)
+            if index == last:
+                self.assertGreaterEqual(value, Histogram.lowest(index))
+                continue
+            lowest, highest = Histogram.lowest(index), Histogram.highest(index)
+            self.assertTrue(lowest <= value <= highest, (value, lowest, highest))
+            # kept to within 1/64, as documented
+            self.assertLessEqual(highest - lowest, lowest / 64)
+
+    def test_largest_bucket(self):
+        last = len(Histogram().counts) - 1
+        self.assertEqual(Histogram.index(1 << 35), last)
+        self.assertEqual(Histogram.index(1 << 60), last)
+        # the largest bucket is also the top one of the values below 2^35
+        self.assertEqual(Histogram.lowest(last), (1 << 35) - (1 << 28))
+        self.assertLess(Histogram.index(Histogram.lowest(last) - 1), last)
+
+    def test_percentiles_bounds(self):
+        values = range(1, 10001)
+        random.Random(2).shuffle(values)
+        histogram = Histogram()
+        for value in values:
+            histogram.record(value)
+        percents = [0, 1, 50, 90, 99, 99.9, 100]
+        results = histogram.percentiles(percents)
+        self.assertEqual(len(results), len(percents))
+        for percent, result in zip(percents, results):
+            exact = max(int(math.ceil(len(values) * percent / 100.0)), 1)
+            # never below the exact value, and no further above it than its bucket
+            self.assertTrue(exact <= result <= exact + exact / 64, (percent, exact, result))
+        self.assertEqual(results[-1], 10000)
+        self.assertEqual(results, sorted(results))
+
+    def test_percentiles_capped_at_max(self):
+        histogram = Histogram()
+        histogram.record(1000)
+        # 1000 falls in the bucket up to 1007
+        self.assertEqual(Histogram.highest(Histogram.index(1000)), 1007)
+        self.assertEqual(histogram.percentiles([50, 100]), [1000, 1000])
+
+    def test_empty(self):
+        self.assertEqual(Histogram().percentiles([50, 99]), [0, 0])
+
+    def test_merge(self):
+        merged, first, second, both = Histogram(), Histogram(), Histogram(), Histogram()
+        for value in self.sample_values():
+            (first if value % 2 else second).record(value)
+            both.record(value)
+        merged.merge(first)
+        merged.merge(second)
+        self.assertEqual(merged.counts, both.counts)
+        self.assertEqual((merged.count, merged.max), (both.count, both.max))
+
+class TestUrllist(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='geturls-test')
+        rand = random.Random(3)
+        # lines of varied length, some of them comments or empty
+        self.lines = []
+        for i in range(500):
+            if i % 50 == 7:
+                self.lines.append('#comment %d\n' % i)
+            elif i % 50 == 8:
+                self.lines.append('\n')
+            else:
+                self.lines.append('http://127.0.0.1/%d/%s\n' % (i, 'x' * rand.randrange(60)))
+        self.offsets = [sum(len(line) for line in self.lines[:i]) for i in range(len(self.lines) + 1)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def urllist(self, name='urls.txt', compress=False):
+        path = os.path.join(self.dir, name)
+        fh = gzip.open(path, 'wb') if compress else open(path, 'wb')
+        fh.write(''.join(self.lines))
+        fh.close()
+        return path
+
+    # the lines a process given (start, end) reads, a small chunk at a time like UrlReader
+    def read_shard(self, filename, start, end):
+        urlfh = geturls.open_urllist(filename, start)
+        lines = []
+        chunk = geturls.read_urllist(urlfh, 64, end)
+        while chunk:
+            lines += chunk
+            chunk = geturls.read_urllist(urlfh, 64, end)
+        urlfh.close()
+        return lines
+
+    def test_compression(self):
+        self.assertEqual(geturls.urllist_compression(self.urllist()), None)
+        self.assertEqual(geturls.urllist_compression(self.urllist('urls.txt.gz', compress=True)), 'gzip')
+
+    def test_read_urllist_end(self):
+        filename = self.urllist()
+        # a line starting at end is the shard's last, one starting after it the next shard's first
+        end = self.offsets[10]
+        self.assertEqual(self.read_shard(filename, 0, end), self.lines[:11])
+        self.assertEqual(self.read_shard(filename, 0, end - 1), self.lines[:10])
+        self.assertEqual(self.read_shard(filename, end - 1, None), self.lines[10:])
+        self.assertEqual(self.read_shard(filename, end, None), self.lines[11:])
+
+    def test_shards_by_bytes(self):
+        filename = self.urllist()
+        for start in (0, 1, self.offsets[100] - 1, self.offsets[100] + 5):
+            expected = self.read_shard(filename, start, None)
+            for processes in (1, 2, 3, 7, 16):
+                shards = geturls.shard_urllist(filename, None, start, 0, processes)
+                self.assertEqual(len(shards), processes)
+                lines = []
+                for shard_start, end in shards:
+                    lines += self.read_shard(filename, shard_start, end)
+                self.assertEqual(lines, expected, (start, processes))
+
+    def check_index(self, filename):
+        index = LineIndex.build(filename, 7)
+        self.assertEqual((index.lines, index.size), (len(self.lines), self.offsets[-1]))
+        self.assertEqual(index.offsets, self.offsets[:-1:7])
+        loaded = LineIndex.load(filename)
+        self.assertEqual((loaded.every, loaded.lines, loaded.size, loaded.offsets),
+                         (index.every, index.lines, index.size, index.offsets))
+        for line in range(len(self.lines) + 3):
+            self.assertEqual(loaded.line_offset(filename, line), self.offsets[min(line, len(self.lines))])
+        return loaded
+
+    def check_shards(self, filename, index):
+        for line in (0, 1, 6, 7, 8, 250, 499):
+            offset = index.line_offset(filename, line)
+            for processes in (1, 2, 3, 5, 16, 100):
+                shards = geturls.shard_urllist(filename, index, geturls.line_start(offset), offset, processes)
+                self.assertEqual(len(shards), processes)
+                lines = []
+                for start, end in shards:
+                    shard = self.read_shard(filename, start, end)
+                    # shards are split at indexed lines
+                    if shard and start:
+                        self.assertIn(start + 1, index.offsets + [offset])
+                    lines += shard
+                self.assertEqual(lines, self.lines[line:], (line, processes))
+
+    def test_index(self):
+        filename = self.urllist()
+        self.check_shards(filename, self.check_index(filename))
+
+    def test_index_gzip(self):
+        filename = self.urllist('urls.txt.gz', compress=True)
+        # offsets are in the uncompressed urllist
+        self.check_shards(filename, self.check_index(filename))
+
+    def test_index_stale(self):
+        filename = self.urllist()
+        LineIndex.build(filename, 7)
+        self.lines.append('http://127.0.0.1/appended\n')
+        self.urllist()
+        self.assertIsNone(LineIndex.load(filename))
+
+    def test_no_index(self):
+        self.assertIsNone(LineIndex.load(self.urllist()))
+
+    def test_skip_lines(self):
+        filename = self.urllist()
+        for offset_line, lines in ((0, 0), (0, 10), (3, 4), (499, 1), (490, 50)):
+            self.assertEqual(geturls.skip_lines(filename, self.offsets[offset_line], lines),
+                             self.offsets[min(offset_line + lines, len(self.lines))])
+
+if __name__ == '__main__':
+    unittest.main()
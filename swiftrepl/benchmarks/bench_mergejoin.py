@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+# Micro-benchmark comparing the per-object list.index() lookup that
+# sync_container used to do against the diff_listings() merge-join, on
+# synthetic name-ordered container listings.
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import swiftrepl
+
+
+class FakeObject(object):
+    __slots__ = ('name', 'etag')
+
+    def __init__(self, name, etag):
+        self.name = name
+        self.etag = etag
+
+
+class FakeResults(object):
+    """A listing page, with the name index of cloudfiles' ObjectResults"""
+
+    def __init__(self, objects):
+        self._objects = objects
+        self._names = [obj.name for obj in objects]
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __getitem__(self, key):
+        return self._objects[key]
+
+    def index(self, value, *args):
+        return self._names.index(value, *args)
+
+
+def make_listings(count, missing, mismatched):
+    src, dst = [], []
+    for i in xrange(count):
+        name = u'%x/%02x/File_%09d.jpg' % (i % 16, i % 256, i)
+        etag = hashlib.md5(name.encode('utf-8')).hexdigest()
+        src.append(FakeObject(name, etag))
+        r = random.random()
+        if r < missing:
+            continue
+        elif r < missing + mismatched:
+            dst.append(FakeObject(name, etag[::-1]))
+        else:
+            dst.append(FakeObject(name, etag))
+    src.sort(key=lambda obj: obj.name)
+    dst.sort(key=lambda obj: obj.name)
+    return src, dst
+
+
+def page(listing, limit, marker):
+    """Return limit objects after marker, like a container GET"""
+    lo, hi = 0, len(listing)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if listing[mid].name <= marker:
+            lo = mid + 1
+        else:
+            hi = mid
+    return FakeResults(listing[lo:lo + limit])
+
+
+def index_join(src, dst, nobject, limit_max):
+    """The former sync_container loop: per-page fetch, list.index() per object"""
+    counts = dict.fromkeys(['missing', 'mismatch', 'identical', 'heads'], 0)
+    last = u''
+    dstobjects = None
+    while True:
+        srcobjects = page(src, nobject, last)
+        if len(srcobjects) == 0:
+            break
+        limit = nobject
+        while dstobjects is None or (len(dstobjects) >= limit and dstobjects[-1].name < srcobjects[-1].name):
+            dstobjects = page(dst, limit, last)
+            if len(dstobjects) == limit:
+                limit *= 2
+                if limit > limit_max:
+                    dstobjects = None
+                    break
+        for srcobj in srcobjects:
+            last = srcobj.name
+            if dstobjects is None:
+                # The real code did a HEAD per object here
+                counts['heads'] += 1
+                continue
+            try:
+                dstobj = dstobjects[dstobjects.index(srcobj.name)]
+            except ValueError:
+                counts['missing'] += 1
+            else:
+                if srcobj.etag != dstobj.etag:
+                    counts['mismatch'] += 1
+                else:
+                    counts['identical'] += 1
+        if len(srcobjects) < nobject:
+            break
+    return counts
+
+
+def paged(listing, limit):
+    """Stream a listing page by page, like iter_container_objects()"""
+    marker = u''
+    while True:
+        objects = page(listing, limit, marker)
+        for obj in objects:
+            yield obj
+        if len(objects) < limit:
+            break
+        marker = objects[-1].name
+
+
+def merge_join(src, dst, nobject):
+    counts = dict.fromkeys(['missing', 'mismatch', 'identical', 'heads'], 0)
+    for state, srcobj, dstobj in swiftrepl.diff_listings(paged(src, nobject), paged(dst, nobject)):
+        counts[state] += 1
+    return counts
+
+
+def timeit(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=1000000)
+    parser.add_argument('--missing', type=float, default=0.01,
+                        help='fraction of objects absent from the destination')
+    parser.add_argument('--mismatched', type=float, default=0.001,
+                        help='fraction of objects with a different etag')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    print "Generating %d-object listings..." % options.objects
+    src, dst = make_listings(options.objects, options.missing, options.mismatched)
+
+    old_time, old_counts = timeit(index_join, src, dst, swiftrepl.NOBJECT, swiftrepl.LIMIT_MAX)
+    new_time, new_counts = timeit(merge_join, src, dst, swiftrepl.NOBJECT)
+
+    for label, elapsed, counts in (('list.index', old_time, old_counts),
+                                   ('merge-join', new_time, new_counts)):
+        print ("%-11s %7.2fs  %9d obj/s  missing: %d, mismatch: %d, identical: %d, HEADs: %d" %
+               (label, elapsed, options.objects / elapsed, counts['missing'],
+                counts['mismatch'], counts['identical'], counts['heads']))
+    print "speedup: %.1fx" % (old_time / new_time)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+# End-to-end benchmark of swiftrepl replication passes against a pair of
+# in-process fake Swift clusters (see fakeswift.py). Every scenario is
+# seeded afresh and replicated with --once by a swiftrepl subprocess, for
+# each engine and each --setting; objects/s, MB/s and CPU per object are
+# those of the swiftrepl process alone.
+
+import argparse
+import os
+import random
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakeswift
+
+SWIFTREPL = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'swiftrepl.py')
+
+KIB = 1024
+MIB = 1024 * KIB
+
+
+def object_name(i):
+    # Hashed MediaWiki-style names, evenly spread over hex prefixes
+    digest = '%032x' % random.Random(i).getrandbits(128)
+    return u'%s/%s/Bench_file_%08d.jpg' % (digest[0], digest[:2], i)
+
+
+def containers(options):
+    return [u'bench-%02d' % i for i in range(options.containers)]
+
+
+def seed_small(options, src, dst):
+    """Many small objects, none of them on the destination yet"""
+    sizes = random.Random(0)
+    names = containers(options)
+    for i in range(options.objects):
+        src.seed(names[i % len(names)], object_name(i), sizes.randint(KIB, 16 * KIB), i)
+    for name in names:
+        dst.create_container(name)
+    return options.objects
+
+
+def seed_huge(options, src, dst):
+    """A few huge objects, none of them on the destination yet"""
+    for i in range(options.huge_objects):
+        src.seed(u'bench-huge', object_name(i), options.huge_size, i)
+    dst.create_container(u'bench-huge')
+    return options.huge_objects
+
+
+def seed_synced(options, src, dst):
+    """Many small objects, all but a fraction of them already replicated"""
+    sizes = random.Random(0)
+    changes = random.Random(1)
+    names = containers(options)
+    for i in range(options.objects):
+        container, name, size = names[i % len(names)], object_name(i), sizes.randint(KIB, 16 * KIB)
+        src.seed(container, name, size, i)
+        dice = changes.random()
+        if dice < options.synced:
+            dst.seed(container, name, size, i)
+        elif dice < (1 + options.synced) / 2:
+            # Mismatched rather than missing
+            dst.seed(container, name, size, i + options.objects)
+        else:
+            dst.create_container(container)
+    return options.objects
+
+
+def seed_deletes(options, src, dst):
+    """A destination holding every object, a source only the kept fraction"""
+    sizes = random.Random(0)
+    keep = random.Random(1)
+    names = containers(options)
+    for i in range(options.objects):
+        container, name, size = names[i % len(names)], object_name(i), sizes.randint(KIB, 16 * KIB)
+        dst.seed(container, name, size, i)
+        if keep.random() < 1 - options.orphans:
+            src.seed(container, name, size, i)
+        else:
+            src.create_container(container)
+    return options.objects
+
+
+# name: (seed function, swiftrepl arguments)
+SCENARIOS = {
+    'small': (seed_small, []),
+    'huge': (seed_huge, []),
+    'synced': (seed_synced, []),
+    'deletes': (seed_deletes, ['--sync-deletes']),
+}
+
+
+def check(scenario, src, dst):
+    """Count the objects the pass left out of sync, 0 if it did its job"""
+    bad = 0
+    for container, objects in src.containers.items():
+        dstobjects = dst.containers.get(container, {})
+        for name, record in objects.items():
+            dstrecord = dstobjects.get(name)
+            if dstrecord is None:
+                bad += 1
+            elif record['etag'] not in (dstrecord['etag'],
+                                        dstrecord['meta'].get('swiftrepl-source-etag')):
+                bad += 1
+        if scenario == 'deletes':
+            bad += len(set(dstobjects) - set(objects))
+    return bad
+
+
+def run(options, scenario, engine, setting):
+    seed, arguments = SCENARIOS[scenario]
+    clusters = []
+    for name in ('src', 'dst'):
+        clusters.append(fakeswift.Cluster(latency=options.latency, bandwidth=options.bandwidth,
+                                          error_rate=options.error_rate))
+    src, dst = clusters
+    objects = seed(options, src, dst)
+    servers = [fakeswift.start(cluster) for cluster in clusters]
+
+    config = tempfile.NamedTemporaryFile(prefix='swiftrepl-bench', suffix='.conf')
+    for name, server in zip(('src', 'dst'), servers):
+        config.write('[%s]\nusername = bench\napi_key = bench\nauth_url = http://127.0.0.1:%d/auth/v1.0\n' %
+                     (name, server.server_port))
+    config.flush()
+
+    command = [options.python, SWIFTREPL, '--config', config.name, '--once',
+               '--container-regexp', '^bench-', '--engine', engine]
+    command += arguments + shlex.split(setting)
+    log = tempfile.TemporaryFile()
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    status = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    config.close()
+
+    if status != 0:
+        log.seek(0)
+        sys.stderr.write(log.read()[-4096:])
+        result = 'exit %d' % status
+    else:
+        bad = check(scenario, src, dst)
+        result = 'ok' if bad == 0 else '%d bad' % bad
+    requests = sum(src.requests.values()) + sum(dst.requests.values())
+    print ("%-8s %-7s %-28s %8d %8.2f %10.1f %8.1f %10.3f %9d  %s" %
+           (scenario, engine, setting or '(defaults)', objects, elapsed, objects / elapsed,
+            dst.bytes_in / elapsed / MIB, cpu / objects * 1000, requests, result))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, may be given more than once (default: all)')
+    parser.add_argument('--engine', action='append', choices=['threads', 'gevent'],
+                        help='swiftrepl --engine, may be given more than once (default: both)')
+    parser.add_argument('--setting', action='append',
+                        help='extra swiftrepl arguments, e.g. "--copy-workers 64"; '
+                        'may be given more than once, every setting being run separately')
+    parser.add_argument('--objects', type=int, default=20000,
+                        help='objects of the small, synced and deletes scenarios')
+    parser.add_argument('--containers', type=int, default=4,
+                        help='containers the objects of those scenarios are spread over')
+    parser.add_argument('--huge-objects', type=int, default=4)
+    parser.add_argument('--huge-size', type=int, default=256 * MIB, metavar='BYTES')
+    parser.add_argument('--synced', type=float, default=0.99, metavar='FRACTION',
+                        help='objects already replicated in the synced scenario')
+    parser.add_argument('--orphans', type=float, default=0.5, metavar='FRACTION',
+                        help='destination objects gone from the source in the deletes scenario')
+    parser.add_argument('--latency', type=float, default=0, metavar='SECONDS',
+                        help='delay before the fake clusters answer each request')
+    parser.add_argument('--bandwidth', type=float, default=0, metavar='BYTES',
+                        help='bytes per second per connection the fake clusters send and receive')
+    parser.add_argument('--error-rate', type=float, default=0, metavar='FRACTION',
+                        help='requests the fake clusters fail with a 503')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to run swiftrepl with')
+    options = parser.parse_args()
+
+    engines = options.engine
+    if engines is None:
+        engines = ['threads']
+        try:
+            import gevent
+            engines.append('gevent')
+        except ImportError:
+            pass
+
+    print ("%-8s %-7s %-28s %8s %8s %10s %8s %10s %9s  %s" %
+           ('scenario', 'engine', 'setting', 'objects', 'seconds', 'objects/s', 'MB/s',
+            'CPU ms/obj', 'requests', 'check'))
+    for scenario in options.scenario or ['small', 'huge', 'synced', 'deletes']:
+        for engine in engines:
+            for setting in options.setting or ['']:
+                run(options, scenario, engine, setting)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
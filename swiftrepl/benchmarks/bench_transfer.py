@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# Throughput benchmark of swiftrepl's object transfer paths: GETs from a
+# local stand-in source server are streamed into PUTs to a local sink
+# server, through the former object_stream() generator (kept here as the
+# baseline) and through BodyCopier with and without splice(2).
+
+import argparse
+import BaseHTTPServer
+import httplib
+import multiprocessing
+import os
+import resource
+import SocketServer
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import cloudfiles.storage_object
+
+import swiftrepl
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SourceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers every GET with the same payload"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        payload = self.server.payload
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class SinkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Discards every PUT body"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        remaining = int(self.headers['Content-Length'])
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, 1048576))
+            if not data:
+                break
+            remaining -= len(data)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.send_header('Etag', 'd41d8cd98f00b204e9800998ecf8427e')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(handler, port, size):
+    server = Server(('127.0.0.1', port), handler)
+    server.payload = os.urandom(size)
+    server.serve_forever()
+
+
+def start_server(handler, size=0):
+    server = Server(('127.0.0.1', 0), handler)
+    port = server.server_port
+    server.server_close()
+    process = multiprocessing.Process(target=serve, args=(handler, port, size))
+    process.daemon = True
+    process.start()
+    # Wait for it to listen
+    for i in range(100):
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            conn.connect()
+            conn.close()
+            break
+        except Exception:
+            time.sleep(0.05)
+    return process, port
+
+
+class FakeConnection(object):
+    """The few cloudfiles Connection attributes send_object() uses"""
+    uri = '/v1/AUTH_bench'
+    token = 'bench'
+    user_agent = 'swiftrepl-bench'
+
+    def __init__(self, port):
+        self.connection = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+
+
+class FakeContainer(object):
+    name = 'bench'
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+def object_stream(response, chunksize=8192):
+    """The generator swiftrepl copied bodies through before BodyCopier"""
+    buff = response.read(chunksize)
+    while len(buff) > 0:
+        yield buff
+        buff = response.read(chunksize)
+    # I hate you httplib
+    buff = response.read()
+
+
+def transfer(method, srcport, dstport, size, count, chunksize):
+    srcconn = httplib.HTTPConnection('127.0.0.1', srcport, timeout=60)
+    dstcontainer = FakeContainer(FakeConnection(dstport))
+    for i in xrange(count):
+        record = {'name': 'object%d' % i, 'content_type': 'application/octet-stream',
+                  'bytes': size, 'last_modified': None, 'hash': None}
+        dstobj = cloudfiles.storage_object.Object(dstcontainer, object_record=record)
+        srcconn.request('GET', '/v1/AUTH_bench/bench/object%d' % i)
+        response = srcconn.getresponse()
+        if method == 'object_stream':
+            body = object_stream(response, chunksize=chunksize)
+        else:
+            body = swiftrepl.BodyCopier(response, chunksize, splice=(method == 'splice'))
+        swiftrepl.send_object(dstobj, body, {})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=64 * 1048576, help='object size in bytes')
+    parser.add_argument('--count', type=int, default=32, help='objects to transfer per method')
+    parser.add_argument('--chunk-size', type=int, default=262144)
+    options = parser.parse_args()
+
+    source, srcport = start_server(SourceHandler, options.size)
+    sink, dstport = start_server(SinkHandler)
+
+    methods = ['object_stream', 'readinto']
+    if swiftrepl.splice is not None:
+        methods.append('splice')
+
+    total = float(options.size) * options.count
+    print "Transferring %d x %d bytes, chunk size %d" % (options.count, options.size, options.chunk_size)
+    for method in methods:
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.time()
+        transfer(method, srcport, dstport, options.size, options.count, options.chunk_size)
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        print ("%-14s %8.1f MB/s  %6.2f CPU s/GB" %
+               (method, total / elapsed / 1048576, cpu / (total / 1073741824)))
+
+    source.terminate()
+    sink.terminate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,361 @@
+#!/usr/bin/python
+
+# A lightweight in-process stand-in for a Swift cluster, good enough for
+# swiftrepl to replicate from and to: v1.0 auth, account and container
+# listings with marker, limit, prefix and end_marker, container HEAD and
+# PUT, object GET (with Range), PUT, HEAD and DELETE, bulk delete and
+# static large object manifests. Latency, bandwidth and 503 errors can be
+# injected per cluster.
+#
+# Object bodies are never stored: seeded objects are generated from a
+# shared pseudo-random block, and PUT bodies are checksummed and dropped,
+# so large scenarios fit in memory. PUT objects can't be read back.
+
+import BaseHTTPServer
+import hashlib
+import json
+import random
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+BLOCK = ''.join(hashlib.md5(str(i)).digest() for i in xrange(65536))
+CHUNK = 65536
+
+
+def generate(variant, start, end):
+    """Yield bytes start to end of the content of a seeded object"""
+    offset = (variant * 7919 + start) % len(BLOCK)
+    while start < end:
+        piece = BLOCK[offset:offset + min(end - start, CHUNK)]
+        yield piece
+        start += len(piece)
+        offset = (offset + len(piece)) % len(BLOCK)
+
+
+def content_etag(variant, size):
+    md5 = hashlib.md5()
+    for piece in generate(variant, 0, size):
+        md5.update(piece)
+    return md5.hexdigest()
+
+
+def timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000000', time.gmtime())
+
+
+class Cluster(object):
+    """
+    The containers of a fake cluster, as dicts of object name to record,
+    plus request and byte counters. Names are unicode.
+    """
+
+    def __init__(self, latency=0, bandwidth=0, error_rate=0, bulk_delete=True):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.bulk_delete = bulk_delete
+        self.containers = {}
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = dict.fromkeys(['GET', 'HEAD', 'PUT', 'DELETE', 'POST'], 0)
+            self.errors = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def count(self, method, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.requests[method] += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def create_container(self, container):
+        with self.lock:
+            self.containers.setdefault(container, {})
+
+    def seed(self, container, name, size, variant):
+        """Add an object whose content generate(variant, 0, size) is"""
+        self.store(container, name, {'etag': content_etag(variant, size), 'bytes': size,
+                                     'variant': variant})
+
+    def store(self, container, name, record):
+        record.setdefault('content_type', 'application/octet-stream')
+        record.setdefault('last_modified', timestamp())
+        record.setdefault('meta', {})
+        with self.lock:
+            self.containers.setdefault(container, {})[name] = record
+
+    def delete(self, container, name):
+        with self.lock:
+            return self.containers.get(container, {}).pop(name, None) is not None
+
+    def listing(self, container, marker='', limit=10000, prefix='', end_marker=None):
+        with self.lock:
+            objects = self.containers[container]
+            names = sorted(name for name in objects
+                           if name > marker and name.startswith(prefix) and
+                           (end_marker is None or name < end_marker))[:limit]
+            return [dict(name=name, hash=objects[name]['etag'], bytes=objects[name]['bytes'],
+                         content_type=objects[name]['content_type'],
+                         last_modified=objects[name]['last_modified'])
+                    for name in names]
+
+    def usage(self, container):
+        with self.lock:
+            objects = self.containers[container]
+            return len(objects), sum(record['bytes'] for record in objects.itervalues())
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def handle_one_request(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        try:
+            self.wfile.flush()
+        except Exception:
+            pass
+
+    def reply(self, status, body='', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def throttle(self, start, nbytes):
+        """Sleep as long as moving nbytes since start takes at the cluster bandwidth"""
+        if self.cluster.bandwidth:
+            delay = start + float(nbytes) / self.cluster.bandwidth - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def parse(self):
+        """Split the request path into account, container and object name"""
+        url = urlparse.urlparse(self.path)
+        parts = url.path.split('/', 4)[2:]
+        parts = [urllib.unquote(part).decode('utf-8') for part in parts]
+        parts += [None] * (3 - len(parts))
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        parts = [part or None for part in parts]
+        return parts[1], parts[2], query
+
+    def begin(self):
+        """Inject the cluster's latency and errors; False if the request failed"""
+        self.cluster = self.server.cluster
+        if self.cluster.latency:
+            time.sleep(self.cluster.latency)
+        if self.cluster.error_rate and random.random() < self.cluster.error_rate:
+            with self.cluster.lock:
+                self.cluster.errors += 1
+            # The request body is left unread
+            self.close_connection = 1
+            self.reply(503, '', {'Connection': 'close'})
+            return False
+        return True
+
+    def do_GET(self):
+        if self.path.startswith('/auth'):
+            return self.reply(200, '', {
+                'X-Storage-Url': 'http://127.0.0.1:%d/v1/AUTH_bench' % self.server.server_port,
+                'X-Auth-Token': 'AUTH_tkbench'})
+        if not self.begin():
+            return
+        container, name, query = self.parse()
+        cluster = self.cluster
+        if container is None:
+            with cluster.lock:
+                names = sorted(cluster.containers)
+            names = [c for c in names if c > query.get('marker', '').decode('utf-8')]
+            names = names[:int(query.get('limit', 10000))]
+            body = json.dumps([dict(zip(('name', 'count', 'bytes'), (c,) + cluster.usage(c)))
+                               for c in names])
+            cluster.count(self.command, bytes_out=len(body))
+            return self.reply(200, body, {'Content-Type': 'application/json; charset=utf-8'})
+        if container not in cluster.containers:
+            cluster.count(self.command)
+            return self.reply(404)
+        if name is None:
+            count, used = cluster.usage(container)
+            headers = {'X-Container-Object-Count': str(count), 'X-Container-Bytes-Used': str(used)}
+            if self.command == 'HEAD':
+                cluster.count('HEAD')
+                return self.reply(204, '', headers)
+            end_marker = query.get('end_marker')
+            objects = cluster.listing(container, query.get('marker', '').decode('utf-8'),
+                                      int(query.get('limit', 10000)),
+                                      query.get('prefix', '').decode('utf-8'),
+                                      end_marker and end_marker.decode('utf-8'))
+            body = json.dumps(objects)
+            cluster.count(self.command, bytes_out=len(body))
+            headers['Content-Type'] = 'application/json; charset=utf-8'
+            return self.reply(200, body, headers)
+        return self.get_object(container, name, query)
+
+    do_HEAD = do_GET
+
+    def get_object(self, container, name, query):
+        cluster = self.cluster
+        record = cluster.containers[container].get(name)
+        if record is None:
+            cluster.count(self.command)
+            return self.reply(404)
+        headers = {'Etag': record['etag'], 'Content-Type': record['content_type'],
+                   'Last-Modified': record['last_modified']}
+        for key, value in record['meta'].items():
+            headers['X-Object-Meta-' + key] = value
+        if 'manifest' in record:
+            headers['X-Static-Large-Object'] = 'True'
+            if query.get('multipart-manifest') == 'get':
+                cluster.count(self.command)
+                return self.reply(200, json.dumps(record['manifest']), headers)
+        if self.command == 'HEAD':
+            cluster.count(self.command)
+            headers['Content-Length'] = str(record['bytes'])
+            self.send_response(200)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.end_headers()
+            return
+        if 'variant' not in record:
+            cluster.count(self.command)
+            return self.reply(501, 'body of a PUT object is not kept')
+
+        start, end, status = 0, record['bytes'], 200
+        if 'range' in self.headers:
+            first, last = self.headers['range'].split('=', 1)[1].split('-')
+            start, end, status = int(first), min(int(last) + 1, record['bytes']), 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, record['bytes'])
+        self.send_response(status)
+        headers['Content-Length'] = str(end - start)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        began, sent = time.time(), 0
+        for piece in generate(record['variant'], start, end):
+            self.wfile.write(piece)
+            sent += len(piece)
+            self.throttle(began, sent)
+        cluster.count(self.command, bytes_out=sent)
+
+    def read_body(self):
+        """Yield the request body in pieces, chunked or not"""
+        if 'content-length' in self.headers:
+            remaining = int(self.headers['content-length'])
+            while remaining > 0:
+                piece = self.rfile.read(min(remaining, CHUNK))
+                if not piece:
+                    break
+                remaining -= len(piece)
+                yield piece
+        else:
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                yield self.rfile.read(size)
+                self.rfile.readline()
+
+    def do_PUT(self):
+        if not self.begin():
+            return
+        container, name, query = self.parse()
+        cluster = self.cluster
+        if name is None:
+            cluster.count('PUT')
+            cluster.create_container(container)
+            return self.reply(201)
+        md5, received, began, data = hashlib.md5(), 0, time.time(), []
+        manifest = query.get('multipart-manifest') == 'put'
+        for piece in self.read_body():
+            md5.update(piece)
+            received += len(piece)
+            self.throttle(began, received)
+            if manifest:
+                data.append(piece)
+        cluster.count('PUT', bytes_in=received)
+        if container not in cluster.containers:
+            return self.reply(404)
+        meta = dict((key[len('x-object-meta-'):], value) for key, value in self.headers.items()
+                    if key.lower().startswith('x-object-meta-'))
+        record = {'etag': md5.hexdigest(), 'bytes': received, 'meta': meta,
+                  'content_type': self.headers.get('content-type', 'application/octet-stream')}
+        if manifest:
+            segments = []
+            for segment in json.loads(''.join(data)):
+                segcontainer, _, segname = segment['path'].lstrip('/').partition('/')
+                segrecord = cluster.containers.get(segcontainer, {}).get(segname)
+                if segrecord is None or segment.get('etag') not in (None, segrecord['etag']):
+                    return self.reply(400, 'Bad segment %s' % segment['path'].encode('utf-8'))
+                segments.append({'name': segment['path'], 'hash': segrecord['etag'],
+                                 'bytes': segrecord['bytes'],
+                                 'content_type': segrecord['content_type'],
+                                 'last_modified': segrecord['last_modified']})
+            record['manifest'] = segments
+            record['bytes'] = sum(segment['bytes'] for segment in segments)
+            record['etag'] = hashlib.md5(''.join(segment['hash'] for segment in segments)).hexdigest()
+        cluster.store(container, name, record)
+        self.reply(201, '', {'Etag': record['etag']})
+
+    def do_DELETE(self):
+        if not self.begin():
+            return
+        container, name, query = self.parse()
+        cluster = self.cluster
+        cluster.count('DELETE')
+        record = cluster.containers.get(container, {}).get(name)
+        if query.get('multipart-manifest') == 'delete' and record is not None:
+            if 'manifest' not in record:
+                return self.reply(400, 'Not an SLO manifest')
+            for segment in record['manifest']:
+                segcontainer, _, segname = segment['name'].lstrip('/').partition('/')
+                cluster.delete(segcontainer, segname)
+        self.reply(204 if cluster.delete(container, name) else 404)
+
+    def do_POST(self):
+        if not self.begin():
+            return
+        container, name, query = self.parse()
+        cluster = self.cluster
+        body = ''.join(self.read_body())
+        cluster.count('POST', bytes_in=len(body))
+        if 'bulk-delete' not in query or not cluster.bulk_delete:
+            return self.reply(204)
+        result = {'Number Deleted': 0, 'Number Not Found': 0, 'Errors': [],
+                  'Response Status': '200 OK', 'Response Body': ''}
+        for line in body.splitlines():
+            container, _, name = urllib.unquote(line.lstrip('/')).partition('/')
+            if cluster.delete(container.decode('utf-8'), name.decode('utf-8')):
+                result['Number Deleted'] += 1
+            else:
+                result['Number Not Found'] += 1
+        self.reply(200, json.dumps(result), {'Content-Type': 'application/json'})
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+def start(cluster):
+    """Serve cluster on a free local port from a daemon thread; returns the server"""
+    server = Server(('127.0.0.1', 0), Handler)
+    server.cluster = cluster
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
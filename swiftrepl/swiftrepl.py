@@ -3,49 +3,335 @@
 # Written by Mark Bergsma <mark@wikimedia.org>
 
 import argparse
+import bisect
+import calendar
 import collections
 import ConfigParser
+import copy
+import ctypes
+import ctypes.util
 import errno
+import gzip
 import httplib
+import json
+import os
 import random
 import re
+import resource
+import select
+import shutil
+import signal
 import socket
+import sqlite3
+import ssl
 import sys
+import tempfile
 import threading
 import time
 import traceback
+import zlib
 
 import cloudfiles
 import cloudfiles.errors
 from cloudfiles.utils import unicode_quote
 
-from Queue import Queue, LifoQueue, Empty, Full
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    splice = libc.splice
+    splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                       ctypes.c_size_t, ctypes.c_uint]
+    splice.restype = ctypes.c_ssize_t
+except (OSError, AttributeError, TypeError):
+    # Not Linux
+    splice = None
+
+from Queue import Full, Queue
 
 
 copy_headers = re.compile(r'^X-Content-Duration$', flags=re.IGNORECASE)
+# What follows <name>/slo/ in the names of the segments segment_prefix() makes
+segment_suffix = re.compile(r'^[^/]*/\d+/\d+/\d{8}$')
 
 NOBJECT = 1000
 LIMIT_MAX = 10000
+LISTING_RANGES = 16  # --listing-partitions ranges listed at once
+
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+F_SETPIPE_SZ = 1031
+
+# diff_listings() and diff_modified_since() states
+MISSING, MISMATCH, IDENTICAL, ORPHANED = 'missing', 'mismatch', 'identical', 'orphaned'
+MODIFIED, UNCHANGED = 'modified', 'unchanged'
+
+# --report records, the state column being 'summary' for per-container totals
+REPORT_OBJECT_FIELDS = ('state', 'container', 'name', 'etag', 'bytes', 'last_modified')
+REPORT_SUMMARY_FIELDS = ('state', 'container', 'missing', 'missing_bytes', 'mismatch', 'mismatch_bytes',
+                         'orphaned', 'orphaned_bytes', 'identical', 'identical_bytes', 'skipped')
 
 src = {}
 dst = {}
 options = None
+progress_fd = None
+dstindex = None
+segmentpool = None
+workqueue = None
 containers = []
 
-class WorkingConnectionPool(cloudfiles.connection.ConnectionPool):
-    def __init__(self, username=None, api_key=None, **kwargs):
-        self.connargs = dict(kwargs)
-        self.connargs.update({'username': username, 'api_key': api_key})
-        self.timeout = kwargs.get('timeout', 5)
-        poolsize = kwargs.get('poolsize', 10)
-        Queue.__init__(self, poolsize)
-
-def connect(params):
-    return WorkingConnectionPool(username=(params['username'] or None),
-                                 api_key=(params['api_key'] or None),
-                                 authurl=params['auth_url'],
-                                 timeout=60,
-                                 poolsize=options.threads * 4)
+def http_idle(http):
+    """Whether an httplib connection can take a new request right away"""
+    if http._HTTPConnection__state != httplib._CS_IDLE:
+        return False
+    response = http._HTTPConnection__response
+    if response is not None and not response.isclosed():
+        return False
+    if http.sock is None:
+        # Not connected (any more), the next request will connect
+        return True
+    try:
+        # An idle keep-alive connection has nothing to read, unless the
+        # server closed it or sent something unexpected
+        readable = select.select([http.sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
+
+def is_congestion(error):
+    """Whether an exception means the cluster is overloaded"""
+    if isinstance(error, socket.timeout):
+        return True
+    return is_congestion_status(getattr(error, 'status', None))
+
+def is_congestion_status(status):
+    return status is not None and (status >= 500 or status in (429, 498))
+
+def backoff(attempt, base=0.5, cap=30):
+    """Sleep a random time of up to base * 2**attempt, and at most cap, seconds"""
+    time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+class KeepAlivePool(object):
+    """
+    A bounded, thread-safe pool of keep-alive connections.
+
+    At most size connections exist at any time, and get() blocks while they
+    are all in use. Idle connections are handed out most recently used
+    first, after a liveness check; they are retired after max_requests
+    uses, max_age seconds since creation or max_idle seconds unused.
+    Connections that failed mid-request must be given back with discard().
+    Subclasses implement create(), close() and alive().
+
+    The number of connections in use at once is further limited AIMD-style:
+    the limit halves (at most once per latency_target seconds) on every
+    congested() call, and grows by about one per limit connections given
+    back with put() within latency_target seconds. Checkouts can also be
+    rate limited to rate per second, and limit_rate() throttles the bytes
+    transferred to byterate per second.
+    """
+    def __init__(self, name, size, max_age=600, max_idle=30, max_requests=1000,
+                 rate=0, byterate=0, latency_target=2.0):
+        self.name = name
+        self.size = size
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.max_requests = max_requests
+        self.latency_target = latency_target
+        self.requests = TokenBucket(rate) if rate > 0 else None
+        self.bytes = TokenBucket(byterate) if byterate > 0 else None
+        self.cond = threading.Condition()
+        self.idle = []
+        self.info = {}
+        self.open = 0
+        self.limit = float(size)
+        self.last_decrease = 0
+        self.stats = dict.fromkeys(['created', 'reused', 'discarded', 'waits', 'congested'], 0)
+        self.stats['wait_time'] = 0.0
+
+    def get(self):
+        if self.requests is not None:
+            self.requests.take()
+        start = time.time()
+        waited = False
+        conn = None
+        with self.cond:
+            # Connections in use, below the congestion limit
+            while self.open - len(self.idle) >= int(self.limit):
+                waited = True
+                self.cond.wait()
+            while conn is None:
+                while self.idle:
+                    conn, lastused = self.idle.pop()
+                    if time.time() - lastused <= self.max_idle and self.alive(conn):
+                        self.info[id(conn)][1] += 1
+                        self.info[id(conn)][2] = time.time()
+                        self.stats['reused'] += 1
+                        break
+                    self.retire(conn)
+                    conn = None
+                else:
+                    if self.open < self.size:
+                        self.open += 1
+                        break
+                    waited = True
+                    self.cond.wait()
+            if waited:
+                self.stats['waits'] += 1
+                self.stats['wait_time'] += time.time() - start
+        if conn is not None:
+            return self.prepare(conn)
+
+        try:
+            conn = self.create()
+        except:
+            with self.cond:
+                self.open -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.info[id(conn)] = [time.time(), 1, time.time()]
+            self.stats['created'] += 1
+        return conn
+
+    def put(self, conn):
+        with self.cond:
+            created, requests, checkout = self.info[id(conn)]
+            if time.time() - checkout <= self.latency_target and self.limit < self.size:
+                self.limit = min(self.size, self.limit + 1 / self.limit)
+            if requests >= self.max_requests or time.time() - created > self.max_age:
+                self.retire(conn)
+            else:
+                self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def congested(self):
+        """Back off after a 5xx, 498, 429 or timeout from this cluster"""
+        with self.cond:
+            self.stats['congested'] += 1
+            if time.time() - self.last_decrease >= self.latency_target:
+                self.limit = max(1.0, self.limit / 2)
+                self.last_decrease = time.time()
+
+    def limit_rate(self, requests=0, nbytes=0):
+        """Wait for the rate limits to allow requests more requests and nbytes more bytes"""
+        if requests and self.requests is not None:
+            self.requests.take(requests)
+        if nbytes and self.bytes is not None:
+            self.bytes.take(nbytes)
+
+    def discard(self, conn):
+        """Give back a connection that must not be reused"""
+        with self.cond:
+            self.retire(conn)
+            self.cond.notify()
+
+    def retire(self, conn):
+        # Called with self.cond held
+        self.open -= 1
+        self.stats['discarded'] += 1
+        del self.info[id(conn)]
+        try:
+            self.close(conn)
+        except Exception:
+            pass
+
+    def prepare(self, conn):
+        return conn
+
+    def print_stats(self):
+        with self.cond:
+            print ("POOL: %s open: %d/%d, limit: %d, created: %d, reused: %d, discarded: %d, "
+                   "waited: %d (%.1fs), congested: %d" %
+                   (self.name, self.open, self.size, self.limit, self.stats['created'],
+                    self.stats['reused'], self.stats['discarded'], self.stats['waits'],
+                    self.stats['wait_time'], self.stats['congested']))
+
+class SwiftConnectionPool(KeepAlivePool):
+    """
+    A pool of cloudfiles connections sharing a single auth token.
+
+    Only the first connection authenticates; the others are copies of it
+    with a connection of their own, so creating one costs a TCP handshake
+    but no auth round-trip. The token is refreshed every token_lifetime
+    seconds, or earlier through reauthenticate() after a 401.
+    """
+    def __init__(self, name, size, token_lifetime=3600, rate=0, byterate=0, latency_target=2.0,
+                 **connargs):
+        KeepAlivePool.__init__(self, name, size, rate=rate, byterate=byterate,
+                               latency_target=latency_target)
+        self.connargs = connargs
+        self.token_lifetime = token_lifetime
+        self.authlock = threading.Lock()
+        self.template = None
+        self.token_time = 0
+
+    def authenticate(self):
+        # Called with self.authlock held
+        if self.template is None:
+            self.template = cloudfiles.connection.Connection(**self.connargs)
+        else:
+            self.template._authenticate()
+        self.token_time = time.time()
+
+    def reauthenticate(self, conn):
+        """Get a new token, unless conn's token has been replaced already"""
+        with self.authlock:
+            if self.template is None or conn.token == self.template.token:
+                self.authenticate()
+        self.prepare(conn)
+
+    def create(self):
+        with self.authlock:
+            if self.template is None or time.time() - self.token_time > self.token_lifetime:
+                self.authenticate()
+            conn = copy.copy(self.template)
+        conn.http_connect()
+        return conn
+
+    def prepare(self, conn):
+        if time.time() - self.token_time > self.token_lifetime:
+            with self.authlock:
+                if time.time() - self.token_time > self.token_lifetime:
+                    self.authenticate()
+        template = self.template
+        if conn.token != template.token:
+            conn.token = template.token
+            if conn.connection_args != template.connection_args:
+                conn.connection_args = template.connection_args
+                conn.http_connect()
+        return conn
+
+    def alive(self, conn):
+        return http_idle(conn.connection)
+
+    def close(self, conn):
+        conn.connection.close()
+
+class HTTPConnectionPool(KeepAlivePool):
+    """A pool of plain httplib connections to a single host"""
+    def __init__(self, name, size, host, port=80, timeout=10, **kwargs):
+        KeepAlivePool.__init__(self, name, size, **kwargs)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def create(self):
+        return httplib.HTTPConnection(self.host, port=self.port, timeout=self.timeout)
+
+    def alive(self, conn):
+        return http_idle(conn)
+
+    def close(self, conn):
+        conn.close()
+
+def connect(name, params):
+    return SwiftConnectionPool(name, options.pool_size,
+                               token_lifetime=options.token_lifetime,
+                               rate=getattr(options, name + '_rate'),
+                               byterate=getattr(options, name + '_bandwidth'),
+                               latency_target=options.latency_target,
+                               username=(params['username'] or None),
+                               api_key=(params['api_key'] or None),
+                               authurl=params['auth_url'],
+                               timeout=60)
 
 def varnish_rewrite(obj):
     match = re.match(r'^(?P<proj>[^\-]+)-(?P<lang>[^\-]+)-(?P<repo>[^\-]+)-(?P<zone>[^\-\.]+)(\..*)?$', obj.container.name)
@@ -64,46 +350,178 @@ def varnish_object_stream_prepare(obj):
         'If-Cached': obj.etag
     }
 
+    pool = varnish_pool(host)
+    connection = pool.get()
     try:
-        varnish_object_stream_prepare.queue
-    except AttributeError:
-        varnish_object_stream_prepare.queue = LifoQueue(maxsize=256)
-
-    try:
-        connection, t = varnish_object_stream_prepare.queue.get(False)
-        if time.time() - t > 3:
-            raise Empty()
-    except Empty:
-        connection = httplib.HTTPConnection(host, port=80, timeout=10)
-
-    connection.request('GET', uri, None, headers)
-    response = connection.getresponse()
+        connection.request('GET', uri, None, headers)
+        response = connection.getresponse()
+    except:
+        pool.discard(connection)
+        raise
     if response.status < 200 or response.status > 299:
         buff = response.read()
-        try:
-            varnish_object_stream_prepare.queue.put((connection, time.time()), False)
-        except Full:
-            del connection
+        pool.put(connection)
         raise cloudfiles.errors.ResponseError(response.status, response.reason)
     return response, connection
 
-def object_stream_prepare(obj, hdrs=None):
+def varnish_pool(host):
+    """Return the connection pool for a Varnish host"""
+    with varnish_pool.lock:
+        try:
+            return varnish_pool.pools[host]
+        except KeyError:
+            pool = varnish_pool.pools[host] = HTTPConnectionPool('varnish-' + host, 256, host,
+                                                                 port=80, timeout=10, max_idle=3)
+            return pool
+varnish_pool.lock = threading.Lock()
+varnish_pool.pools = {}
+
+def object_stream_prepare(obj, hdrs=None, parms=None):
     obj._name_check()
     response = obj.container.conn.make_request('GET',
                                                path=[obj.container.name,
-                                                     obj.name], hdrs=hdrs)
+                                                     obj.name], hdrs=hdrs, parms=parms)
     if response.status < 200 or response.status > 299:
         buff = response.read()
         raise cloudfiles.errors.ResponseError(response.status, response.reason)
     return response
 
-def object_stream(response, chunksize=8192):
-    buff = response.read(chunksize)
-    while len(buff) > 0:
-        yield buff
-        buff = response.read(chunksize)
-    # I hate you httplib
-    buff = response.read()
+class BodyCopier(object):
+    """
+    Copies a source response body to a destination connection.
+
+    Where the body can be read straight off the source socket (a plain,
+    non-chunked response with nothing buffered by httplib), it is received
+    into a reusable per-thread buffer with recv_into() and written from
+    there, or with splice=True moved between the sockets through a pipe by
+    the kernel without entering userspace at all. Anything else falls back
+    to response.read(). Every chunk moved is counted against the byte rate
+    limits of the connection pools given, so that they hold while the body
+    is moving.
+    """
+    local = threading.local()
+
+    def __init__(self, response, chunksize=65536, splice=False, connpools=()):
+        self.response = response
+        self.chunksize = chunksize
+        self.splice = splice
+        self.connpools = connpools
+
+    def limit_rate(self, n):
+        for connpool in self.connpools:
+            connpool.limit_rate(nbytes=n)
+
+    def buffer(self):
+        buf = getattr(self.local, 'buf', None)
+        if buf is None or len(buf) != self.chunksize:
+            buf = self.local.buf = bytearray(self.chunksize)
+        return memoryview(buf)
+
+    def pipe(self):
+        pipe = getattr(self.local, 'pipe', None)
+        if pipe is None:
+            pipe = self.local.pipe = os.pipe()
+            try:
+                import fcntl
+                fcntl.fcntl(pipe[1], F_SETPIPE_SZ, self.chunksize)
+            except (ImportError, IOError):
+                pass
+        return pipe
+
+    def source_socket(self):
+        response = self.response
+        fp = response.fp
+        if (response.chunked or response.length is None or fp is None or
+                not hasattr(fp, '_sock') or fp._rbuf.getvalue()):
+            return None
+        return fp._sock
+
+    def copy_to(self, http):
+        """
+        Write the body to http, yielding the number of bytes written after
+        every step
+        """
+        if http.sock is None:
+            http.connect()
+        # Don't let Nagle hold back the body until the headers are ACKed
+        http.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        srcsock = self.source_socket()
+        if srcsock is None:
+            buff = self.response.read(self.chunksize)
+            while len(buff) > 0:
+                http.send(buff)
+                self.limit_rate(len(buff))
+                yield len(buff)
+                buff = self.response.read(self.chunksize)
+            # I hate you httplib
+            self.response.read()
+            return
+
+        if (self.splice and splice is not None and
+                not isinstance(srcsock, ssl.SSLSocket) and
+                not isinstance(http.sock, ssl.SSLSocket)):
+            copier = self.splice_from(srcsock, http.sock)
+        else:
+            copier = self.recv_from(srcsock, http.sock)
+        for n in copier:
+            self.response.length -= n
+            self.limit_rate(n)
+            yield n
+
+        if self.response.length == 0:
+            # Let httplib finish the response so the connection can be reused
+            self.response.read()
+        else:
+            self.response.close()
+
+    def recv_from(self, srcsock, dstsock):
+        view = self.buffer()
+        while self.response.length > 0:
+            n = srcsock.recv_into(view, min(self.response.length, len(view)))
+            if n == 0:
+                break
+            dstsock.sendall(view[:n])
+            yield n
+
+    def splice_from(self, srcsock, dstsock):
+        rpipe, wpipe = self.pipe()
+        srcfd, dstfd = srcsock.fileno(), dstsock.fileno()
+        while self.response.length > 0:
+            n = self.splice_fd(srcsock, srcfd, wpipe, min(self.response.length, self.chunksize),
+                               SPLICE_F_MOVE)
+            if n == 0:
+                break
+            # Only hint that more is coming while it is, or the kernel would
+            # hold back the tail of the body
+            flags = SPLICE_F_MOVE
+            if self.response.length > n:
+                flags |= SPLICE_F_MORE
+            pending = n
+            while pending > 0:
+                pending -= self.splice_fd(dstsock, rpipe, dstfd, pending, flags)
+            yield n
+
+    def splice_fd(self, sock, fdin, fdout, count, flags):
+        """
+        splice() count bytes from fdin to fdout, waiting for sock (whichever
+        end is a socket in timeout mode, and therefore non-blocking) as needed
+        """
+        while True:
+            n = splice(fdin, None, fdout, None, count, flags)
+            if n >= 0:
+                return n
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err != errno.EAGAIN:
+                raise socket.error(err, os.strerror(err))
+            if sock.fileno() == fdin:
+                ready = select.select([sock], [], [], sock.gettimeout())[0]
+            else:
+                ready = select.select([], [sock], [], sock.gettimeout())[1]
+            if not ready:
+                raise socket.timeout('timed out')
 
 def copy_metadata(response, dstobj, headers={}):
     global copy_headers
@@ -119,7 +537,10 @@ def copy_metadata(response, dstobj, headers={}):
 def send_object(dstobj, iterable, headers={}):
     """
     Imported and modified from cloudfiles.storage_object.Object.send,
-    to allow specifying custom headers
+    to allow specifying custom headers.
+
+    iterable is either an iterable of data chunks, or a BodyCopier writing
+    to the destination connection itself.
     """
     assert dstobj.size is not None
 
@@ -142,9 +563,13 @@ def send_object(dstobj, iterable, headers={}):
     response = None
     transferred = 0
     try:
-        for chunk in iterable:
-            http.send(chunk)
-            transferred += len(chunk)
+        if isinstance(iterable, BodyCopier):
+            for n in iterable.copy_to(http):
+                transferred += n
+        else:
+            for chunk in iterable:
+                http.send(chunk)
+                transferred += len(chunk)
         # If the generator didn't yield enough data, stop, drop, and roll.
         if transferred < dstobj.size:
             # possible cause: source's container listing has different size than actual file
@@ -166,15 +591,25 @@ def send_object(dstobj, iterable, headers={}):
         if hdr[0].lower() == 'etag':
             dstobj._etag = hdr[1]
 
-def replicate_object(srcobj, dstobj, srcconnpool, dstconnpool):
-    # Replace the connections
-    srcobj.container.conn = srcconnpool.get()
-    dstobj.container.conn = dstconnpool.get()
-
+def replicate_object(srcobj, dstobj, srcconnpool, dstconnpool, segment=True):
     self = replicate_object
 
+    if segment and options.segment_threshold and srcobj.size >= options.segment_threshold:
+        if replicate_segmented(srcobj, dstobj, srcconnpool, dstconnpool):
+            return
+
+    manifest = None
     try:
-        for i in range(3):
+        for i in range(options.retries):
+            if i > 0:
+                backoff(i - 1)
+            # Replace the connections
+            srcobj.container.conn = srcconnpool.get()
+            dstobj.container.conn = dstconnpool.get()
+            connection = None
+            broken = True
+            # The cluster the current request goes to
+            pool = srcconnpool
             try:
                 self.count += 1
                 connection = None
@@ -182,89 +617,1058 @@ def replicate_object(srcobj, dstobj, srcconnpool, dstconnpool):
                     # Try Varnish first
                     try:
                         response, connection = varnish_object_stream_prepare(srcobj)
-                        self.hits += 1
+                        if is_manifest(response):
+                            # Varnish serves large objects flattened
+                            varnish_pool(connection.host).discard(connection)
+                            connection = None
+                        else:
+                            self.hits += 1
                     except:
                         connection = None
                 if not options.use_varnish or connection is None:
-                    # Start source GET request
-                    response = object_stream_prepare(srcobj)
-
-                dstobj.content_type = srcobj.content_type
+                    # Start source GET request, for the manifest itself if
+                    # the object is a large object
+                    start = time.time()
+                    response = object_stream_prepare(srcobj, parms={'multipart-manifest': 'get'})
+                    metrics.observe('get_first_byte', srcobj.container.name, time.time() - start)
+
+                pool = dstconnpool
+                # Objects queued from a report come without their content type
+                dstobj.content_type = srcobj.content_type or response.getheader('content-type')
                 dstobj.etag = srcobj.etag
                 dstobj.last_modified = srcobj.last_modified
                 dstobj.size = srcobj.size
                 dstobj.metadata = dict(srcobj.metadata)
                 headers = {}
                 copy_metadata(response, dstobj, headers)
-                send_object(dstobj, object_stream(response, chunksize=65536), headers)
-
-                if connection is not None:
-                    try:
-                        varnish_object_stream_prepare.queue.put((connection, time.time()), False)
-                    except Full:
-                        del connection
+                if response.getheader('x-static-large-object', '').lower() == 'true':
+                    manifest = json.loads(response.read())
+                    broken = False
+                    break
+                if response.getheader('x-object-manifest') is not None:
+                    # Dynamic large objects are copied as the manifest
+                    # object, and their segments as regular objects
+                    headers['X-Object-Manifest'] = response.getheader('x-object-manifest')
+                start = time.time()
+                # The object's bytes cross both clusters
+                send_object(dstobj, BodyCopier(response, options.chunk_size, options.splice,
+                                               (srcconnpool, dstconnpool)), headers)
+                metrics.observe('put_complete', dstobj.container.name, time.time() - start)
+                metrics.count('copied', srcobj.container.name)
+                if dstindex is not None:
+                    dstindex.put(dstobj.container.name, dstobj.name, dstobj._etag or srcobj.etag,
+                                 srcobj.size, format_last_modified(time.time()) + '.000000')
+                metrics.count('bytes', srcobj.container.name, srcobj.size)
+                broken = False
 
             except httplib.CannotSendRequest as e:
-                srcobj.container.conn = srcconnpool.get()
-                dstobj.container.conn = dstconnpool.get()
+                metrics.error(srcobj.container.name, e)
                 continue
             except (AttributeError, socket.error, httplib.ResponseNotReady, httplib.BadStatusLine) as e:
                 # httplib bug?
-                time.sleep(1)
+                metrics.error(srcobj.container.name, e)
+                if is_congestion(e):
+                    pool.congested()
                 continue
             except cloudfiles.errors.ResponseError as e:
-                if e.status == 404:
+                # Both connections are done with their responses
+                broken = False
+                metrics.error(srcobj.container.name, e)
+                if e.status == 401:
+                    # Token expired, we can't tell which one
+                    srcconnpool.reauthenticate(srcobj.container.conn)
+                    dstconnpool.reauthenticate(dstobj.container.conn)
+                    continue
+                elif e.status == 404:
                     # File was deleted
                     pass
+                elif is_congestion(e):
+                    pool.congested()
+                    continue
                 else:
                     print "Error occurred, skipping"
                     print e
                     # FIXME
                 break
             except Exception as e:
+                metrics.error(srcobj.container.name, e)
                 continue
             else:
                 break
+            finally:
+                # Connections that failed mid-request can't be trusted again
+                for connpool, conn in ((srcconnpool, srcobj.container.conn),
+                                       (dstconnpool, dstobj.container.conn),
+                                       (connection is not None and varnish_pool(connection.host), connection)):
+                    if conn is None:
+                        continue
+                    if broken:
+                        connpool.discard(conn)
+                    else:
+                        connpool.put(conn)
+                srcobj.container.conn, dstobj.container.conn = None, None
         else:
             print >> sys.stderr, "Repeated error in replicate_object"
             raise
-        srcconnpool.put(srcobj.container.conn)
-        dstconnpool.put(dstobj.container.conn)
+        if manifest is not None:
+            replicate_manifest(srcobj, dstobj, manifest, headers, srcconnpool, dstconnpool)
     finally:
-        srcobj.container.conn, dstobj.container.conn = None, None
-
         if self.count % 100 == 0:
             pct = lambda x, y: y != 0 and int(float(x) / y * 100) or 0
             print ("VARNISH: %d/%d (%d%%)" %
                    (self.hits, self.count, pct(self.hits, self.count)))
+            srcconnpool.print_stats()
+            dstconnpool.print_stats()
 # FIXME initialize
 replicate_object.count = 0
 replicate_object.hits = 0
 
 
-def get_container_objects(container, limit, marker, connpool):
+def is_manifest(response):
+    """Whether a GET or HEAD response is for a static or dynamic large object"""
+    return (response.getheader('x-static-large-object', '').lower() == 'true' or
+            response.getheader('x-object-manifest') is not None)
+
+def head_object(obj, connpool):
+    """HEAD an object, returning the response, or None if it doesn't exist"""
+    conn = connpool.get()
+    try:
+        response = conn.make_request('HEAD', [obj.container.name, obj.name])
+        response.read()
+    except:
+        connpool.discard(conn)
+        raise
+    connpool.put(conn)
+    if response.status == 404:
+        return None
+    if not 200 <= response.status < 300:
+        raise cloudfiles.errors.ResponseError(response.status, response.reason)
+    return response
+
+def put_manifest(dstobj, segments, headers, dstconnpool):
+    """PUT a static large object manifest listing segments"""
+    body = json.dumps(segments)
+    headers = dict(headers)
+    headers.update(dstobj._make_headers())
+    # The manifest's own size and etag don't apply
+    for header in ('Content-Length', 'ETag'):
+        headers.pop(header, None)
+    conn = dstconnpool.get()
+    try:
+        response = conn.make_request('PUT', [dstobj.container.name, dstobj.name], data=body,
+                                     hdrs=headers, parms={'multipart-manifest': 'put'})
+        response.read()
+    except:
+        dstconnpool.discard(conn)
+        raise
+    dstconnpool.put(conn)
+    if not 200 <= response.status < 300:
+        raise cloudfiles.errors.ResponseError(response.status, response.reason)
+    dstobj._etag = response.getheader('etag', '').strip('"')
+
+def segment_container(conn, name):
+    """Return a cloudfiles container, creating it if needed"""
+    try:
+        return conn.get_container(name)
+    except cloudfiles.errors.NoSuchContainer:
+        create_container(conn, name)
+        return conn.get_container(name)
+
+def replicate_manifest(srcobj, dstobj, manifest, headers, srcconnpool, dstconnpool):
+    """
+    Replicate a static large object as such: copy the segments listed in
+    its manifest that the destination lacks, then PUT the manifest
+    """
+    srcconn, dstconn = srcconnpool.get(), dstconnpool.get()
+    try:
+        srccontainers, dstcontainers = {}, {}
+        jobs = []
+        for segment in manifest:
+            container_name, _, name = segment['name'].lstrip('/').partition('/')
+            if container_name not in srccontainers:
+                srccontainers[container_name] = srcconn.get_container(container_name)
+                dstcontainers[container_name] = segment_container(dstconn, container_name)
+            record = {'name': name, 'hash': segment['hash'], 'bytes': segment['bytes'],
+                      'content_type': segment.get('content_type'),
+                      'last_modified': segment.get('last_modified')}
+            srcseg = cloudfiles.storage_object.Object(srccontainers[container_name], object_record=record)
+            dstseg = cloudfiles.storage_object.Object(dstcontainers[container_name], object_record=dict(record))
+            jobs.append((ensure_segment, (srcseg, dstseg, srcconnpool, dstconnpool)))
+    finally:
+        srcconnpool.put(srcconn)
+        dstconnpool.put(dstconn)
+    segmentpool.run(jobs)
+
+    segments = []
+    for segment in manifest:
+        entry = {'path': segment['name'], 'etag': segment['hash'], 'size_bytes': segment['bytes']}
+        if 'range' in segment:
+            entry['range'] = segment['range']
+        segments.append(entry)
+    put_manifest(dstobj, segments, headers, dstconnpool)
+    metrics.count('manifests', srcobj.container.name)
+    if dstindex is not None:
+        dstindex.put(dstobj.container.name, dstobj.name, srcobj.etag, srcobj.size,
+                     format_last_modified(time.time()) + '.000000')
+    print "Replicated manifest %s/%s with %d segments" % (
+        srcobj.container.name, srcobj.name.encode("ascii", errors="ignore"), len(segments))
+
+def ensure_segment(srcseg, dstseg, srcconnpool, dstconnpool):
+    response = head_object(dstseg, dstconnpool)
+    if response is None or response.getheader('etag', '').strip('"') != srcseg.etag:
+        srcseg.container = copy.copy(srcseg.container)
+        dstseg.container = copy.copy(dstseg.container)
+        # Copied whole, as a segmented copy wouldn't have the etag the manifest lists
+        replicate_object(srcseg, dstseg, srcconnpool, dstconnpool, segment=False)
+
+def segment_prefix(srcobj):
+    """Segment names depend on the source version and the segment size"""
+    return u'%s/slo/%s/%d/%d/' % (srcobj.name, srcobj.last_modified, srcobj.size, options.segment_size)
+
+def delete_object(connpool, container_name, name, parms=None):
+    """DELETE an object, returning False if it was already gone"""
+    conn = connpool.get()
+    try:
+        response = conn.make_request('DELETE', [container_name, name], parms=parms)
+        response.read()
+    except:
+        connpool.discard(conn)
+        raise
+    connpool.put(conn)
+    if response.status == 404:
+        return False
+    if not 200 <= response.status < 300:
+        raise cloudfiles.errors.ResponseError(response.status, response.reason)
+    return True
+
+def delete_stale_segments(srcobj, segcontainer, dstconnpool):
+    """
+    Delete the segments of the earlier versions of srcobj from segcontainer,
+    once the manifest of this version replaced theirs
+    """
+    prefix = srcobj.name + u'/slo/'
+    current = segment_prefix(srcobj)
+    stale = [obj.name for obj in
+             iter_container_objects(segcontainer, '', dstconnpool, prefix=prefix.encode("utf-8"))
+             if not obj.name.startswith(current) and segment_suffix.match(obj.name[len(prefix):])]
+    try:
+        for name in stale:
+            delete_object(dstconnpool, segcontainer.name, name)
+    except Exception as e:
+        metrics.error(srcobj.container.name, e)
+        print >> sys.stderr, "Deleting stale segments of %s/%s: %s" % (srcobj.container.name,
+            srcobj.name.encode("ascii", errors="ignore"), e)
+        return
+    if stale:
+        metrics.count('deleted', segcontainer.name, len(stale))
+        print "Deleted %d stale segments of %s/%s" % (len(stale), srcobj.container.name,
+            srcobj.name.encode("ascii", errors="ignore"))
+
+def segmented_copies(objects, dstconnpool):
+    """
+    The names of those of objects, listed on the destination, that are
+    replicate_segmented() copies, to be deleted along with their segments
+    """
+    if not options.segment_threshold:
+        return set()
+    names = set()
+    for obj in objects:
+        if obj.size >= options.segment_threshold:
+            response = head_object(obj, dstconnpool)
+            if response is not None and response.getheader('x-object-meta-swiftrepl-source-etag'):
+                names.add(obj.name)
+    return names
+
+def segmented_copy_current(srcobj, dstobj, dstconnpool):
+    """Whether dstobj is a segmented copy of this version of srcobj"""
+    response = head_object(dstobj, dstconnpool)
+    return (response is not None and
+            response.getheader('x-object-meta-swiftrepl-source-etag') == srcobj.etag)
+
+def replicate_segmented(srcobj, dstobj, srcconnpool, dstconnpool):
+    """
+    Copy a large object as parallel ranged GETs into the segments of a
+    static large object, in the <container>_segments container.
+
+    Segments named after this version of the object that already exist,
+    from an interrupted copy, are kept, and those of earlier versions are
+    deleted once the manifest is replaced. The manifest records the source
+    etag in its metadata, for the comparison in sync_container(). Returns
+    False, without copying anything, if the source is a manifest itself.
+    """
+    response = head_object(srcobj, srcconnpool)
+    if response is None:
+        return True
+    if is_manifest(response):
+        return False
+
+    dstobj.content_type = srcobj.content_type or response.getheader('content-type')
+    dstobj.metadata = dict(srcobj.metadata)
+    headers = {}
+    copy_metadata(response, dstobj, headers)
+    dstobj.metadata['Swiftrepl-Source-Etag'] = srcobj.etag
+
+    dstconn = dstconnpool.get()
+    try:
+        segcontainer = segment_container(dstconn, dstobj.container.name + '_segments')
+    finally:
+        dstconnpool.put(dstconn)
+    prefix = segment_prefix(srcobj)
+    existing = dict((obj.name, obj) for obj in
+                    iter_container_objects(segcontainer, '', dstconnpool, prefix=prefix.encode("utf-8")))
+
+    segments = []
+    jobs = []
+    for start in range(0, srcobj.size, options.segment_size):
+        end = min(srcobj.size, start + options.segment_size) - 1
+        record = {'name': prefix + '%08d' % len(segments), 'hash': None, 'bytes': end - start + 1,
+                  'content_type': None, 'last_modified': None}
+        segobj = cloudfiles.storage_object.Object(segcontainer, object_record=record)
+        done = existing.get(segobj.name)
+        if done is not None and done.size == segobj.size:
+            segobj._etag = done.etag
+        else:
+            jobs.append((copy_range, (srcobj, segobj, start, end, srcconnpool, dstconnpool)))
+        segments.append(segobj)
+    if existing:
+        print "Resuming %s/%s: %d/%d segments done" % (srcobj.container.name,
+            srcobj.name.encode("ascii", errors="ignore"), len(segments) - len(jobs), len(segments))
+    segmentpool.run(jobs)
+
+    put_manifest(dstobj, [{'path': u'/%s/%s' % (segcontainer.name, segobj.name),
+                           'etag': segobj.etag, 'size_bytes': segobj.size}
+                          for segobj in segments], headers, dstconnpool)
+    metrics.count('copied', srcobj.container.name)
+    metrics.count('segmented', srcobj.container.name)
+    if dstindex is not None:
+        dstindex.put(dstobj.container.name, dstobj.name, srcobj.etag, srcobj.size,
+                     format_last_modified(time.time()) + '.000000')
+    print "Copied %s/%s in %d segments" % (srcobj.container.name,
+        srcobj.name.encode("ascii", errors="ignore"), len(segments))
+    delete_stale_segments(srcobj, segcontainer, dstconnpool)
+    return True
+
+def copy_range(srcobj, segobj, start, end, srcconnpool, dstconnpool):
+    """Copy bytes start to end of srcobj into the segment object segobj"""
+    # Jobs of the same object run in parallel, each on its own container
+    srcobj = copy.copy(srcobj)
+    srcobj.container = copy.copy(srcobj.container)
+    segobj.container = copy.copy(segobj.container)
+    for i in range(options.retries):
+        if i > 0:
+            backoff(i - 1)
+        srcobj.container.conn = srcconnpool.get()
+        segobj.container.conn = dstconnpool.get()
+        broken = True
+        pool = srcconnpool
+        try:
+            start_time = time.time()
+            response = object_stream_prepare(srcobj, hdrs={'Range': 'bytes=%d-%d' % (start, end)})
+            metrics.observe('get_first_byte', srcobj.container.name, time.time() - start_time)
+            if response.status != 206:
+                raise cloudfiles.errors.ResponseError(response.status, 'Range not satisfied')
+            pool = dstconnpool
+            start_time = time.time()
+            send_object(segobj, BodyCopier(response, options.chunk_size, options.splice,
+                                           (srcconnpool, dstconnpool)), {})
+            metrics.observe('put_complete', segobj.container.name, time.time() - start_time)
+            metrics.count('bytes', srcobj.container.name, segobj.size)
+            broken = False
+            return
+        except Exception as e:
+            metrics.error(srcobj.container.name, e)
+            if is_congestion(e):
+                pool.congested()
+            error = e
+        finally:
+            for connpool, conn in ((srcconnpool, srcobj.container.conn),
+                                   (dstconnpool, segobj.container.conn)):
+                if broken:
+                    connpool.discard(conn)
+                else:
+                    connpool.put(conn)
+            srcobj.container.conn, segobj.container.conn = None, None
+    print >> sys.stderr, "Repeated error copying %s bytes %d-%d" % (
+        srcobj.name.encode("ascii", errors="ignore"), start, end)
+    raise error
+
+class SegmentPool(object):
+    """
+    Threads copying the segments of large objects. run() returns once all
+    of its jobs are done, raising the first error any of them raised; when
+    called from one of the workers, as for nested manifests, it runs the
+    jobs inline so that they can't end up waiting for each other.
+    """
+    def __init__(self, workers):
+        self.queue = Queue()
+        self.local = threading.local()
+        for i in range(workers):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+    def run(self, jobs):
+        if getattr(self.local, 'worker', False):
+            for function, args in jobs:
+                function(*args)
+            return
+        batch = CopyBatch()
+        for job in jobs:
+            batch.add()
+            self.queue.put((job, batch))
+        batch.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def worker(self):
+        self.local.worker = True
+        while True:
+            (function, args), batch = self.queue.get()
+            error = None
+            try:
+                function(*args)
+            except Exception as e:
+                print >> sys.stderr, e, traceback.format_exc()
+                error = e
+            finally:
+                batch.done(error)
+
+
+class CopyBatch(object):
+    """
+    Tracks the outstanding copy jobs submitted by one sync_container() pass,
+    and the first error any of them raised. With a limit, add() blocks while
+    that many jobs are outstanding.
+    """
+    def __init__(self, limit=0):
+        self.cond = threading.Condition()
+        self.limit = limit
+        self.pending = 0
+        self.error = None
+
+    def add(self):
+        with self.cond:
+            while self.limit and self.pending >= self.limit:
+                self.cond.wait(1)
+            self.pending += 1
+
+    def done(self, error=None):
+        with self.cond:
+            self.pending -= 1
+            if error is not None and self.error is None:
+                self.error = error
+            self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            while self.pending > 0:
+                self.cond.wait(1)
+
+class CopyWorkerPool(object):
+    """
+    A fixed set of threads replicating objects from a bounded job queue.
+
+    The workers share the source and destination connection pools; submit()
+    blocks while the queue is full, so the listing can never run more than
+    backlog objects ahead of the copies.
+    """
+    def __init__(self, srcconnpool, dstconnpool, workers, backlog):
+        self.srcconnpool = srcconnpool
+        self.dstconnpool = dstconnpool
+        self.queue = Queue(maxsize=backlog)
+        for i in range(workers):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+    def submit(self, srcobj, dstobj, batch):
+        # replicate_object() swaps connections in and out of the objects'
+        # containers, so give each job containers of its own
+        srcobj.container = copy.copy(srcobj.container)
+        dstobj.container = copy.copy(dstobj.container)
+        batch.add()
+        self.queue.put((srcobj, dstobj, batch))
+
+    def worker(self):
+        while True:
+            srcobj, dstobj, batch = self.queue.get()
+            error = None
+            try:
+                replicate_object(srcobj, dstobj, self.srcconnpool, self.dstconnpool)
+            except Exception as e:
+                print >> sys.stderr, e, traceback.format_exc()
+                error = e
+            finally:
+                batch.done(error)
+                self.queue.task_done()
+
+class SharedResponseFile(object):
+    """
+    Stands in for a socket in httplib.HTTPResponse, so that consecutive
+    pipelined responses are all parsed from the same buffered file
+    """
+    def __init__(self, fp):
+        self.fp = fp
+
+    def makefile(self, mode, bufsize=None):
+        return self.fp
+
+class HeadEngine(object):
+    """
+    Bulk object existence checks through pipelined HEAD requests.
+
+    head() splits the names into runs of depth, and each of the worker
+    threads writes a whole run on one keep-alive connection of connpool
+    before reading the responses back, in order. Runs interrupted by a
+    connection error, a 401 or a server that closes the connection are
+    resumed on a fresh connection from the first unanswered name, giving up
+    after retries attempts in a row without progress.
+    """
+    def __init__(self, connpool, workers, depth, retries=3):
+        self.connpool = connpool
+        self.depth = depth
+        self.retries = retries
+        self.queue = Queue()
+        for i in range(workers):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+    def head(self, container_name, names):
+        """Return a dict mapping those of names that exist to their etags"""
+        etags = {}
+        batch = CopyBatch()
+        for i in range(0, len(names), self.depth):
+            batch.add()
+            self.queue.put((container_name, names[i:i + self.depth], etags, batch))
+        batch.wait()
+        if batch.error is not None:
+            raise batch.error
+        return etags
+
+    def worker(self):
+        while True:
+            container_name, names, etags, batch = self.queue.get()
+            error = None
+            try:
+                failures = 0
+                while names:
+                    left = self.head_run(container_name, names, etags)
+                    if len(left) == len(names):
+                        failures += 1
+                        if failures >= self.retries:
+                            raise IOError("HEAD of %d objects in %s failed %d times" %
+                                          (len(names), container_name, failures))
+                        backoff(failures - 1)
+                    names = left
+            except Exception as e:
+                print >> sys.stderr, e, traceback.format_exc()
+                error = e
+            finally:
+                batch.done(error)
+
+    def head_run(self, container_name, names, etags):
+        """Pipeline one run of HEADs, returning the names left unanswered"""
+        conn = self.connpool.get()
+        http = conn.connection
+        answered = 0
+        reusable = False
+        try:
+            # The checkout itself accounted for one request
+            self.connpool.limit_rate(requests=len(names) - 1)
+            if http.sock is None:
+                http.connect()
+            host = http.host
+            if http.port != http.default_port:
+                host = '%s:%d' % (host, http.port)
+            requests = []
+            for name in names:
+                path = '/%s/%s/%s' % (conn.uri.rstrip('/'), unicode_quote(container_name),
+                                      unicode_quote(name))
+                requests.append('HEAD %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: %s\r\n'
+                                'X-Auth-Token: %s\r\n\r\n' % (path, host, conn.user_agent, conn.token))
+            start = time.time()
+            http.sock.sendall(''.join(requests))
+
+            fp = http.sock.makefile('rb')
+            for name in names:
+                response = httplib.HTTPResponse(SharedResponseFile(fp), method='HEAD')
+                response.begin()
+                # Each response's latency runs from the end of the one before,
+                # not from the start of the pipeline
+                now = time.time()
+                metrics.observe(self.connpool.name + '_head', container_name, now - start)
+                start = now
+                if response.status == 401:
+                    self.connpool.reauthenticate(conn)
+                    break
+                elif response.status == 404:
+                    pass
+                elif 200 <= response.status < 300:
+                    etags[name] = response.getheader('etag')
+                else:
+                    print >> sys.stderr, "HEAD %s/%s: %d %s" % (container_name,
+                        name.encode("ascii", errors="ignore"), response.status, response.reason)
+                    if is_congestion_status(response.status):
+                        self.connpool.congested()
+                    break
+                answered += 1
+                if response.will_close:
+                    break
+            else:
+                # Only reuse the connection if nothing is left unread
+                reusable = not fp._rbuf.getvalue()
+        except (socket.error, IOError, httplib.HTTPException) as e:
+            print >> sys.stderr, "HEAD pipeline to %s interrupted: %r" % (container_name, e)
+            metrics.error(container_name, e)
+            if is_congestion(e):
+                self.connpool.congested()
+        finally:
+            if reusable:
+                self.connpool.put(conn)
+            else:
+                self.connpool.discard(conn)
+        return names[answered:]
+
+class TokenBucket(object):
+    """
+    Limits an operation to rate per second, allowing bursts of up to burst.
+
+    take() reserves its tokens right away and sleeps until they would have
+    been available, so concurrent callers queue up fairly.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, n=1):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class BulkDeleter(object):
+    """
+    Deletes objects in batches of batch_size through the bulk-delete
+    middleware, falling back to single DELETEs spread over workers threads
+    when the cluster doesn't support it, or for the objects a bulk request
+    failed to remove. Static large objects are deleted one at a time with
+    their segments, which bulk deletes leave behind. Deletes are limited to
+    rate objects per second overall, unless rate is 0.
+    """
+    def __init__(self, connpool, workers, batch_size, rate=0):
+        self.connpool = connpool
+        self.batch_size = batch_size
+        self.bucket = TokenBucket(rate) if rate > 0 else None
+        self.bulk = True
+        self.queue = Queue()
+        for i in range(workers):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+    def delete(self, container_name, names, manifests=False):
+        """
+        Delete names from container_name, raising the first error; with
+        manifests, names are static large objects to delete with their
+        segments
+        """
+        for i in range(0, len(names), self.batch_size):
+            batch = names[i:i + self.batch_size]
+            if self.bucket is not None:
+                self.bucket.take(len(batch))
+            if self.bulk and not manifests:
+                batch = self.bulk_delete(container_name, batch)
+            if batch:
+                self.single_delete(container_name, batch,
+                                   {'multipart-manifest': 'delete'} if manifests else None)
+
+    def bulk_delete(self, container_name, names):
+        """
+        Delete names with one bulk request, returning those left over.
+        Overloaded or failing clusters are retried with backoff; only a
+        successful response that isn't the middleware's turns bulk deletes
+        off for good.
+        """
+        body = '\n'.join('/%s/%s' % (unicode_quote(container_name), unicode_quote(name))
+                         for name in names)
+        for i in range(options.retries):
+            if i > 0:
+                backoff(i - 1)
+            conn = self.connpool.get()
+            start = time.time()
+            try:
+                response = conn.make_request('POST', data=body, parms={'bulk-delete': ''},
+                                             hdrs={'Content-Type': 'text/plain',
+                                                   'Accept': 'application/json'})
+                data = response.read()
+            except Exception as e:
+                self.connpool.discard(conn)
+                metrics.error(container_name, e)
+                if is_congestion(e):
+                    self.connpool.congested()
+                error = e
+                continue
+            self.connpool.put(conn)
+            metrics.observe('bulk_delete', container_name, time.time() - start)
+            if is_congestion_status(response.status):
+                error = cloudfiles.errors.ResponseError(response.status, response.reason)
+                metrics.error(container_name, error)
+                self.connpool.congested()
+                continue
+            break
+        else:
+            print >> sys.stderr, "Repeated error in bulk_delete"
+            raise error
+
+        if not 200 <= response.status < 300:
+            # Rejected, e.g. as too large, but the next batch may not be
+            print >> sys.stderr, "Bulk delete in %s failed (%d %s), using single DELETEs" % (
+                container_name, response.status, response.reason)
+            return names
+        try:
+            result = json.loads(data)
+        except ValueError:
+            result = None
+        if not isinstance(result, dict) or 'Number Deleted' not in result:
+            # Without the middleware the POST is an account metadata update
+            print >> sys.stderr, ("Bulk delete unsupported (%d %s), using single DELETEs" %
+                                  (response.status, response.reason))
+            self.bulk = False
+            return names
+
+        failed = set(path for path, status in result.get('Errors', []))
+        metrics.count('deleted', container_name, result['Number Deleted'])
+        for path, status in result.get('Errors', []):
+            metrics.count('errors', container_name, kind='bulk_delete')
+        if failed:
+            print >> sys.stderr, "Bulk delete in %s: %s, %d errors" % (
+                container_name, result.get('Response Status'), len(failed))
+        return [name for name in names
+                if '/%s/%s' % (unicode_quote(container_name), unicode_quote(name)) in failed]
+
+    def single_delete(self, container_name, names, parms=None):
+        batch = CopyBatch()
+        for name in names:
+            batch.add()
+            self.queue.put((container_name, name, parms, batch))
+        batch.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def worker(self):
+        while True:
+            container_name, name, parms, batch = self.queue.get()
+            error = None
+            conn = self.connpool.get()
+            start = time.time()
+            try:
+                response = conn.make_request('DELETE', [container_name, name], parms=parms)
+                response.read()
+                if response.status != 404 and not 200 <= response.status < 300:
+                    raise cloudfiles.errors.ResponseError(response.status, response.reason)
+                self.connpool.put(conn)
+                metrics.observe('delete', container_name, time.time() - start)
+                if response.status != 404:
+                    metrics.count('deleted', container_name)
+            except Exception as e:
+                self.connpool.discard(conn)
+                metrics.error(container_name, e)
+                if is_congestion(e):
+                    self.connpool.congested()
+                print >> sys.stderr, e, traceback.format_exc()
+                error = e
+            finally:
+                batch.done(error)
+
+class DeleteReport(object):
+    """Records deleted, or with --dry-run to-be-deleted, objects as TSV"""
+    def __init__(self, path):
+        self.fp = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, container_name, names):
+        lines = ''.join('%s\t%s\n' % (container_name.encode("utf-8"), name.encode("utf-8"))
+                        for name in names)
+        with self.lock:
+            self.fp.write(lines)
+            self.fp.flush()
+
+def tsv_escape(value):
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
 
+def tsv_unescape(value):
+    return re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n'}.get(m.group(1), m.group(1)), value)
+
+class DiffReport(object):
+    """
+    Writes the per-container totals of a --report pass, and with names set
+    every missing, mismatched and orphaned object, as TSV or JSON lines;
+    gzip-compressed if path ends in .gz
+    """
+    def __init__(self, path, fmt='tsv', names=False):
+        if path.endswith('.gz'):
+            self.fp = gzip.open(path, 'wb')
+        else:
+            self.fp = open(path, 'wb')
+        self.fmt = fmt
+        self.names = names
+        self.lock = threading.Lock()
+        self.totals = collections.Counter()
+        if fmt == 'tsv':
+            self.fp.write('#%s\n#%s\n' % ('\t'.join(REPORT_OBJECT_FIELDS), '\t'.join(REPORT_SUMMARY_FIELDS)))
+
+    def format(self, fields, values):
+        if self.fmt == 'json':
+            return json.dumps(collections.OrderedDict(zip(fields, values)), separators=(',', ':')) + '\n'
+        values = [value.encode("utf-8") if isinstance(value, unicode) else str(value) for value in values]
+        return '\t'.join(tsv_escape(value) for value in values) + '\n'
+
+    def objects(self, buf, container_name, entries):
+        """
+        Record a list of (state, obj) entries of a container in buf, a
+        temporary file that summary() commits to the report
+        """
+        buf.write(''.join(self.format(REPORT_OBJECT_FIELDS,
+                                      (state, container_name, obj.name, obj.etag, obj.size, obj.last_modified))
+                          for state, obj in entries))
+
+    def summary(self, container_name, counts, buf=None):
+        """
+        Record a container's totals along with the entries buffered in buf,
+        so that a container retried after an error is only reported once
+        """
+        line = self.format(REPORT_SUMMARY_FIELDS,
+                           ['summary', container_name] + [counts[field] for field in REPORT_SUMMARY_FIELDS[2:]])
+        with self.lock:
+            if buf is not None:
+                buf.seek(0)
+                shutil.copyfileobj(buf, self.fp)
+            self.fp.write(line)
+            # Keep what was written so far readable, should the pass be cut short
+            if isinstance(self.fp, gzip.GzipFile):
+                self.fp.flush(zlib.Z_SYNC_FLUSH)
+            else:
+                self.fp.flush()
+            self.totals.update(counts)
+            self.totals['containers'] += 1
+
+    def close(self):
+        self.fp.close()
+        totals = self.totals
+        print ("REPORT: %d containers, missing: %d (%d bytes), mismatch: %d (%d bytes), "
+               "orphaned: %d (%d bytes), identical: %d (%d bytes), skipped %d" %
+               tuple(totals[field] for field in ('containers',) + REPORT_SUMMARY_FIELDS[2:]))
+
+def read_report(path):
+    """Yield the records of a --report file as dicts, whatever its format"""
+    with open(path, 'rb') as fp:
+        compressed = fp.read(2) == '\x1f\x8b'
+    fp = gzip.open(path, 'rb') if compressed else open(path, 'rb')
+    try:
+        for line in fp:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                yield json.loads(line)
+                continue
+            values = [tsv_unescape(value).decode("utf-8") for value in line.split('\t')]
+            fields = REPORT_SUMMARY_FIELDS if values[0] == 'summary' else REPORT_OBJECT_FIELDS
+            if len(values) != len(fields):
+                raise ValueError('%s: malformed report line %r' % (path, line))
+            yield dict(zip(fields, values))
+    finally:
+        fp.close()
+
+def load_work_queue(paths):
+    """
+    Read the missing and mismatched objects out of --report files, as a
+    dict of container name to a list of (name, etag, bytes, last_modified)
+    """
+    queue = collections.OrderedDict()
+    for path in paths:
+        for record in read_report(path):
+            if record['state'] in (MISSING, MISMATCH):
+                queue.setdefault(record['container'], []).append(
+                    (record['name'], record['etag'], int(record['bytes']), record['last_modified']))
+    return queue
+
+class Metrics(object):
+    """
+    Counters and latency histograms, broken down by container.
+
+    Counters are keyed by name, container and an optional kind, such as the
+    error kind. Latencies are kept per phase and container in buckets
+    growing by powers of two from 1ms, the last one catching everything
+    from about a minute up. emit() appends a JSON line with everything to
+    json_path and rewrites textfile_path in the Prometheus text format.
+    """
+    buckets = [0.001 * 2 ** i for i in range(17)]
+
+    def __init__(self, json_path=None, textfile_path=None):
+        self.json_path = json_path
+        self.textfile_path = textfile_path
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.latencies = {}
+
+    def count(self, name, container, n=1, kind=None):
+        with self.lock:
+            self.counters[name, container, kind] += n
+
+    def error(self, container, e):
+        self.count('errors', container, kind=error_kind(e))
+
+    def observe(self, phase, container, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.latencies.get((phase, container))
+            if histogram is None:
+                histogram = self.latencies[phase, container] = [0] * (len(self.buckets) + 2)
+            histogram[i] += 1
+            histogram[-1] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return (dict(self.counters),
+                    dict((key, list(histogram)) for key, histogram in self.latencies.iteritems()))
+
+    def quantile(self, histogram, q):
+        """The bucket upper bound below which a fraction q of the samples fall"""
+        total = sum(histogram[:-1])
+        seen = 0
+        for bound, n in zip(self.buckets + [float('inf')], histogram):
+            seen += n
+            if seen >= q * total:
+                return bound
+        return float('inf')
+
+    def json_quantile(self, histogram, q):
+        """quantile(), null rather than inf, which isn't valid JSON, past the last bucket"""
+        bound = self.quantile(histogram, q)
+        return None if bound == float('inf') else bound
+
+    def emit(self):
+        counters, latencies = self.snapshot()
+        if self.json_path:
+            record = {
+                'time': time.time(),
+                'pid': os.getpid(),
+                'counters': [dict(name=name, container=container, kind=kind, value=value)
+                             for (name, container, kind), value in sorted(counters.iteritems())],
+                'latency': [dict(phase=phase, container=container, count=sum(histogram[:-1]),
+                                 sum=histogram[-1], p50=self.json_quantile(histogram, 0.5),
+                                 p90=self.json_quantile(histogram, 0.9),
+                                 p99=self.json_quantile(histogram, 0.99))
+                            for (phase, container), histogram in sorted(latencies.iteritems())],
+            }
+            with open(self.json_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if self.textfile_path:
+            self.write_textfile(counters, latencies)
+
+    def write_textfile(self, counters, latencies):
+        label = lambda value: value.encode("utf-8").replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        lines = []
+        for name in sorted(set(key[0] for key in counters)):
+            lines.append('# TYPE swiftrepl_%s_total counter' % name)
+            for (counter, container, kind), value in sorted(counters.iteritems()):
+                if counter != name:
+                    continue
+                labels = 'container="%s"' % label(container)
+                if kind is not None:
+                    labels += ',kind="%s"' % label(kind)
+                lines.append('swiftrepl_%s_total{%s} %d' % (name, labels, value))
+        lines.append('# TYPE swiftrepl_latency_seconds histogram')
+        for (phase, container), histogram in sorted(latencies.iteritems()):
+            labels = 'phase="%s",container="%s"' % (phase, label(container))
+            cumulative = 0
+            for bound, n in zip(self.buckets + ['+Inf'], histogram):
+                cumulative += n
+                lines.append('swiftrepl_latency_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+            lines.append('swiftrepl_latency_seconds_sum{%s} %f' % (labels, histogram[-1]))
+            lines.append('swiftrepl_latency_seconds_count{%s} %d' % (labels, cumulative))
+
+        # Replace the file atomically, so the collector never reads half of it
+        dirname = os.path.dirname(os.path.abspath(self.textfile_path))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.swiftrepl-metrics')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.chmod(tmp, 0644)
+            os.rename(tmp, self.textfile_path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.emit()
+            except Exception as e:
+                print >> sys.stderr, e, traceback.format_exc()
+
+def error_kind(e):
+    """A short, bounded description of an exception for the error counters"""
+    status = getattr(e, 'status', None)
+    if status is not None:
+        return 'http_%d' % status
+    if isinstance(e, socket.timeout):
+        return 'timeout'
+    if isinstance(e, socket.error):
+        return 'socket'
+    return type(e).__name__
+
+metrics = Metrics()
+
+
+def get_container_objects(container, limit, marker, connpool, end_marker=None, prefix=None):
+
+    parms = {}
+    if end_marker is not None:
+        parms['end_marker'] = end_marker
+    if prefix is not None:
+        parms['prefix'] = prefix
     container.conn = connpool.get()
     try:
         objects = None
-        for i in range(3):
+        for i in range(options.retries):
+            if i > 0:
+                backoff(i - 1)
+            start = time.time()
             try:
-                objects = container.get_objects(limit=limit, marker=marker)
+                objects = container.get_objects(limit=limit, marker=marker, **parms)
+                metrics.observe(connpool.name + '_listing', container.name, time.time() - start)
+                metrics.count('listed', container.name, len(objects), kind=connpool.name)
             except AttributeError as e:
                 # httplib bug?
                 continue
             except socket.timeout as e:
+                connpool.congested()
+                metrics.error(container.name, e)
                 continue
             except socket.error as e:
+                metrics.error(container.name, e)
                 if e.errno == errno.EAGAIN:
                     continue
                 else:
                     print >> sys.stderr, e, traceback.format_exc()
                     continue
             except httplib.ResponseNotReady as e:
-                time.sleep(1)
                 continue
             except Exception as e:
+                if is_congestion(e):
+                    connpool.congested()
+                metrics.error(container.name, e)
                 print >> sys.stderr, e, traceback.format_exc()
                 continue
             else:
@@ -285,142 +1689,577 @@ def create_container(dstconn, name):
     else:
         print "Created container", name
 
-def sync_container(srccontainer, srcconnpool, dstconnpool, filename_regexp):
-
-    last = ''
-    hits, processed, gets, skipped = 0, 0, 0, 0
-
-    dstconn = dstconnpool.get()
-    try:
+class CheckpointStore(object):
+    """
+    Persistent listing markers and counters, per mode and container.
+
+    A checkpoint records the last object name a sync pass has fully
+    processed, so an interrupted or abandoned pass can continue from there
+    rather than re-listing the whole container. The store is a JSON file,
+    replaced atomically at most every save_interval seconds as checkpoints
+    change, and by flush(); with no path it is kept in memory. Changes
+    lost in between only make a pass redo some work. load is True to load
+    all the saved checkpoints, or the modes to load and keep, the others
+    being started over.
+    """
+    def __init__(self, path, load=True, save_interval=10):
+        self.path = path
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.checkpoints = {}
+        self.dirty = False
+        self.saved = time.time()
+        if load and path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.checkpoints = json.load(f)
+            if load is not True:
+                self.checkpoints = dict((mode, checkpoints) for mode, checkpoints in self.checkpoints.items()
+                                        if mode in load)
+
+    def get(self, mode, container):
+        """Return the checkpoint dict of a container, empty if there is none"""
+        with self.lock:
+            return dict(self.checkpoints.get(mode, {}).get(container, {}))
+
+    def update(self, mode, container, marker=None, **values):
+        with self.lock:
+            checkpoint = dict(values, time=time.time())
+            if marker is not None:
+                checkpoint['marker'] = marker.decode("utf-8")
+            self.checkpoints.setdefault(mode, {})[container] = checkpoint
+            self._changed()
+
+    def clear(self, mode, container):
+        with self.lock:
+            if self.checkpoints.get(mode, {}).pop(container, None) is not None:
+                self._changed()
+
+    def reset(self, containers):
+        """Forget the checkpoints of the given container names, in all modes"""
+        with self.lock:
+            for checkpoints in self.checkpoints.values():
+                for container in containers:
+                    checkpoints.pop(container, None)
+            self._save()
+
+    def flush(self):
+        """Save the changes made since the last save, if any"""
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def _changed(self):
+        self.dirty = True
+        if time.time() - self.saved >= self.save_interval:
+            self._save()
+
+    def _save(self):
+        self.saved = time.time()
+        if self.path is None:
+            self.dirty = False
+            return
+        fd, tmppath = tempfile.mkstemp(prefix='.swiftrepl-checkpoint-',
+                                       dir=os.path.dirname(os.path.abspath(self.path)))
         try:
-            dstcontainer = dstconn.get_container(srccontainer.name)
-        except cloudfiles.errors.NoSuchContainer as e:
-            create_container(dstconn, srccontainer.name)
-            dstcontainer = dstconn.get_container(srccontainer.name)
-    finally:
-        dstconnpool.put(dstconn)
-        dstconn = None
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.checkpoints, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmppath, self.path)
+        except:
+            os.unlink(tmppath)
+            raise
+        self.dirty = False
 
-    dstobjects = None
+class DestinationIndex(object):
+    """
+    A local SQLite index of the objects in the destination cluster: name,
+    etag, size and last_modified, per container.
+
+    Copies and deletes update it as they happen, through buffered writes
+    flushed every flush_every changes and before every read. A container's
+    index is trusted for reconcile_every passes; the pass after that lists
+    the destination for real and replaces the indexed objects with what
+    it finds, via reconcile().
+    """
+    def __init__(self, path, reconcile_every=24, flush_every=1000):
+        self.reconcile_every = reconcile_every
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.pending = []
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS objects (container TEXT NOT NULL, '
+                        'name TEXT NOT NULL, etag TEXT, bytes INTEGER, last_modified TEXT, '
+                        'PRIMARY KEY (container, name))')
+        # passes is NULL until a reconciling pass has completed
+        self.db.execute('CREATE TABLE IF NOT EXISTS containers (container TEXT PRIMARY KEY, '
+                        'passes INTEGER)')
+
+    def fresh(self, container_name):
+        """Whether the next pass over container_name may use the index"""
+        with self.lock:
+            row = self.db.execute('SELECT passes FROM containers WHERE container = ?',
+                                  (container_name,)).fetchone()
+        return row is not None and row[0] is not None and row[0] < self.reconcile_every
+
+    def put(self, container_name, name, etag, size, last_modified):
+        self.change(('put', container_name, name, etag, size, last_modified))
+
+    def delete(self, container_name, names):
+        for name in names:
+            self.change(('delete', container_name, name))
+
+    def change(self, change):
+        with self.lock:
+            self.pending.append(change)
+            if len(self.pending) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        # Called with self.lock held
+        if not self.pending:
+            return
+        self.db.execute('BEGIN')
+        for change in self.pending:
+            if change[0] == 'put':
+                self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)', change[1:])
+            else:
+                self.db.execute('DELETE FROM objects WHERE container = ? AND name = ?', change[1:])
+        self.db.execute('COMMIT')
+        self.pending = []
+
+    def iter_objects(self, container, marker, limit=NOBJECT):
+        """
+        Yield the indexed objects of container after marker, in listing
+        order, as if from iter_container_objects()
+        """
+        marker = marker.decode("utf-8")
+        while True:
+            with self.lock:
+                self._flush()
+                rows = self.db.execute('SELECT name, etag, bytes, last_modified FROM objects '
+                                       'WHERE container = ? AND name > ? ORDER BY name LIMIT ?',
+                                       (container.name, marker, limit)).fetchall()
+            for name, etag, size, last_modified in rows:
+                object_record = {'name': name, 'hash': etag, 'bytes': size,
+                                 'last_modified': last_modified, 'content_type': None}
+                yield cloudfiles.storage_object.Object(container, object_record=object_record)
+            if len(rows) < limit:
+                break
+            marker = rows[-1][0]
+
+    def reconcile(self, container, objects, marker):
+        """
+        Pass through a real listing of container after marker, replacing
+        the indexed objects after marker with it
+        """
+        with self.lock:
+            self._flush()
+            self.db.execute('BEGIN')
+            self.db.execute('DELETE FROM objects WHERE container = ? AND name > ?',
+                            (container.name, marker.decode("utf-8")))
+            self.db.execute('INSERT OR REPLACE INTO containers VALUES (?, NULL)', (container.name,))
+            self.db.execute('COMMIT')
+        for obj in objects:
+            self.put(container.name, obj.name, obj.etag, obj.size, obj.last_modified)
+            yield obj
+
+    def finish_pass(self, container_name, reconciled):
+        with self.lock:
+            self._flush()
+            if reconciled:
+                self.db.execute('INSERT OR REPLACE INTO containers VALUES (?, 0)', (container_name,))
+            else:
+                self.db.execute('UPDATE containers SET passes = passes + 1 WHERE container = ?',
+                                (container_name,))
+
+def iter_container_objects(container, marker, connpool, limit=NOBJECT, end_marker=None, prefix=None):
+    """
+    Yield all objects in a container after marker, in listing (name) order,
+    fetching one page of limit objects at a time
+    """
     while True:
-        srcobjects = get_container_objects(srccontainer, limit=NOBJECT, marker=last, connpool=srcconnpool)
-
-        limit = NOBJECT
-        while dstobjects is None or (len(dstobjects) >= limit and dstobjects[-1].name < srcobjects[-1].name):
-            dstobjects = get_container_objects(dstcontainer, limit=limit, marker=last, connpool=dstconnpool)
-            if len(dstobjects) == limit:
-                limit *= 2
-                if limit > LIMIT_MAX:
-                    dstobjects = None
+        objects = get_container_objects(container, limit=limit, marker=marker, connpool=connpool,
+                                        end_marker=end_marker, prefix=prefix)
+        for obj in objects:
+            yield obj
+        if len(objects) < limit:
+            break
+        marker = objects[-1].name.encode("utf-8")
+
+class ListingPrefetcher(object):
+    """
+    Iterates over a container's objects like iter_container_objects(),
+    while a thread lists up to depth pages ahead of the consumer.
+
+    The thread starts once iterating begins, or earlier with start(), so
+    that listings abandoned before their first page leave none behind;
+    errors it gives up on are raised by the iterator, and closing the
+    iterator early stops the thread.
+    """
+    def __init__(self, container, marker, connpool, depth, limit=NOBJECT, end_marker=None):
+        # The thread swaps connections in and out of its container
+        self.container = copy.copy(container)
+        self.marker = marker
+        self.connpool = connpool
+        self.limit = limit
+        self.end_marker = end_marker
+        self.pages = Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.fetch)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def fetch(self):
+        marker = self.marker
+        try:
+            while not self.stopped.is_set():
+                objects = get_container_objects(self.container, self.limit, marker,
+                                                self.connpool, self.end_marker)
+                self.put(objects)
+                if len(objects) < self.limit:
                     break
+                marker = objects[-1].name.encode("utf-8")
+            self.put(None)
+        except Exception as e:
+            self.put(e)
 
-        for srcobj in srcobjects:
-            objname = srcobj.name.encode("ascii", errors="ignore")
-            if filename_regexp is not None and not filename_regexp.match(objname):
-                skipped += 1
-                continue
-            processed += 1
-            last = srcobj.name.encode("utf-8")
-            msg = "%s\t%s\t%s\t%s\t%s" % (srccontainer.name, srcobj.etag, srcobj.size, objname, srcobj.last_modified)
+    def put(self, page):
+        while not self.stopped.is_set():
             try:
-                if dstobjects is not None:
-                    dstobj = dstobjects[dstobjects.index(srcobj.name)]
-                else:
-                    gets += 1
-                    dstcontainer.conn = dstconnpool.get()
-                    try:
-                        dstobj = dstcontainer.get_object(srcobj.name)
-                    finally:
-                        dstconnpool.put(dstcontainer.conn)
-                        dstcontainer.conn = None
-            except (ValueError, cloudfiles.errors.NoSuchObject) as e:
-                #print msg
-                #print "Destination does not have %s, syncing" % objname
-                object_record = dict.fromkeys(['content_type', 'bytes', 'last_modified', 'hash'], None)
-                object_record['name'] = srcobj.name
-                dstobj = cloudfiles.storage_object.Object(dstcontainer, object_record=object_record)
-            else:
-                if srcobj.etag != dstobj.etag:
-                    print "%s\t%s\tE-Tag mismatch: %s/%s, syncing" % (srccontainer.name, objname, srcobj.etag, dstobj.etag)
-                else:
-                    # Object already exists
-                    hits += 1
-                    continue
+                self.pages.put(page, timeout=1)
+                return
+            except Full:
+                pass
 
-            replicate_object(srcobj, dstobj, srcconnpool, dstconnpool)
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                page = self.pages.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                for obj in page:
+                    yield obj
+        finally:
+            self.stopped.set()
+
+def partition_boundaries(partitions):
+    """
+    Split the name space in partitions ranges at hex prefixes, for containers
+    whose object names start with an evenly distributed hex hash
+    """
+    width = len('%x' % (partitions - 1))
+    return ['%0*x' % (width, i) for i in range(1, partitions)]
 
-        pct = lambda x, y: y != 0 and int(float(x) / y * 100) or 0
-        print ("STATS: %s processed: %d/%d (%d%%), hit rate: %d%%, skipped %d/%d (%d%%)" %
-               (srccontainer.name,
-                processed, srccontainer.object_count,
-                pct(processed, srccontainer.object_count),
-                pct(hits, processed),
-                skipped, srccontainer.object_count,
-                pct(skipped, srccontainer.object_count),
-                ))
+def list_partitioned(container, marker, connpool, depth, boundaries):
+    """
+    Yield a container's objects after marker in listing order, listing up to
+    LISTING_RANGES of the ranges between boundaries in parallel, the next
+    range starting as the earliest one is used up.
+
+    Range i covers the names above boundary i - 1 and up to and including
+    boundary i, so the ranges cover all names whatever they look like.
+    As object names can't contain NUL, the boundary followed by \\x01 is
+    the exclusive end_marker right after the boundary itself.
+    """
+    ranges = []
+    lower = ''
+    for boundary in boundaries + [None]:
+        end_marker = None if boundary is None else boundary + '\x01'
+        if end_marker is None or end_marker > marker:
+            ranges.append((max(lower, marker), end_marker))
+        lower = boundary
+    ranges.reverse()
+    listings = collections.deque()
+    try:
+        while ranges or listings:
+            while ranges and len(listings) < LISTING_RANGES:
+                start, end_marker = ranges.pop()
+                listings.append(ListingPrefetcher(container, start, connpool, depth,
+                                                  end_marker=end_marker))
+                listings[-1].start()
+            for obj in listings[0]:
+                yield obj
+            listings.popleft()
+    finally:
+        for listing in listings:
+            listing.stopped.set()
+
+def list_container_objects(container, marker, connpool):
+    """Yield a container's objects after marker, as --listing-* configure"""
+    if options.listing_partitions > 1:
+        return list_partitioned(container, marker, connpool, max(options.listing_prefetch, 1),
+                                partition_boundaries(options.listing_partitions))
+    elif options.listing_prefetch > 0:
+        return iter(ListingPrefetcher(container, marker, connpool, options.listing_prefetch))
+    else:
+        return iter_container_objects(container, marker=marker, connpool=connpool)
 
-        if len(srcobjects) < NOBJECT:
-            break
+def diff_listings(srcobjects, dstobjects, orphans=False):
+    """
+    Merge-join two name-ordered object listings in a single pass.
 
-    print "FINISHED:", srccontainer.name
+    Yields a (state, srcobj, dstobj) tuple for every source object, where
+    state is one of MISSING, MISMATCH or IDENTICAL and dstobj is None for
+    missing objects. Destination objects absent from the source are skipped,
+    or with orphans set, yielded as (ORPHANED, None, dstobj).
+    """
+    dstiter = iter(dstobjects)
+    dstobj = next(dstiter, None)
+    for srcobj in srcobjects:
+        while dstobj is not None and dstobj.name < srcobj.name:
+            if orphans:
+                yield ORPHANED, None, dstobj
+            dstobj = next(dstiter, None)
+        if dstobj is None or dstobj.name != srcobj.name:
+            yield MISSING, srcobj, None
+            continue
+        elif srcobj.etag != dstobj.etag:
+            yield MISMATCH, srcobj, dstobj
+        else:
+            yield IDENTICAL, srcobj, dstobj
+        dstobj = next(dstiter, None)
+    while orphans and dstobj is not None:
+        yield ORPHANED, None, dstobj
+        dstobj = next(dstiter, None)
 
-def sync_deletes_slow(srccontainer, srcconnpool, dstconnpool):
+def diff_modified_since(srcobjects, since):
+    """
+    Classify source objects by last_modified alone, for incremental passes.
 
-    dstconn = dstconnpool.get()
+    Yields (MODIFIED, srcobj, None) for objects modified after the since
+    listing timestamp, which still have to be checked against the
+    destination, and (UNCHANGED, srcobj, None) for all others.
+    """
+    for srcobj in srcobjects:
+        if srcobj.last_modified > since:
+            yield MODIFIED, srcobj, None
+        else:
+            yield UNCHANGED, srcobj, None
+
+def resolve_modified(diff, dstcontainer, heads, filename_regexp=None, window=NOBJECT):
+    """
+    Resolve the MODIFIED entries of an incremental diff against the
+    destination, window objects at a time, with one bulk HEAD per window.
+
+    Entries come out in listing order, with MODIFIED replaced by MISSING,
+    MISMATCH or IDENTICAL and the destination object filled in. Objects
+    the filename_regexp excludes are passed through unresolved.
+    """
+    pending = []
+    names = []
+    for entry in diff:
+        state, srcobj, dstobj = entry
+        pending.append(entry)
+        if state == MODIFIED and (filename_regexp is None or
+                                  filename_regexp.match(srcobj.name.encode("ascii", errors="ignore"))):
+            names.append(srcobj.name)
+        if len(names) >= window:
+            for entry in resolve_window(pending, names, dstcontainer, heads):
+                yield entry
+            pending, names = [], []
+    for entry in resolve_window(pending, names, dstcontainer, heads):
+        yield entry
+
+def resolve_window(pending, names, dstcontainer, heads):
+    etags = heads.head(dstcontainer.name, names) if names else {}
+    names = set(names)
+    for state, srcobj, dstobj in pending:
+        if state == MODIFIED and srcobj.name in names:
+            etag = etags.get(srcobj.name)
+            if etag is None:
+                state = MISSING
+            else:
+                object_record = dict.fromkeys(['content_type', 'bytes', 'last_modified'], None)
+                object_record.update(name=srcobj.name, hash=etag)
+                dstobj = cloudfiles.storage_object.Object(dstcontainer, object_record=object_record)
+                state = MISMATCH if srcobj.etag != etag else IDENTICAL
+        yield state, srcobj, dstobj
+
+def refresh_container(container, connpool):
+    """Update a container's object count and bytes used with a fresh HEAD"""
+    conn = connpool.get()
     try:
-        dstcontainer = dstconn.get_container(srccontainer.name)
-    except cloudfiles.errors.NoSuchContainer as e:
-        # Destination container doesn't exist; nothing to delete
-        return
+        fresh = conn.get_container(container.name)
     finally:
-        dstconnpool.put(dstconn)
+        connpool.put(conn)
+    container.object_count, container.size_used = fresh.object_count, fresh.size_used
 
-    srccontainer.conn = srcconnpool.get()
-    try:
-        last = ''
-        deletes, processed = 0, 0
-        while True:
-            dstobjects = get_container_objects(dstcontainer, limit=NOBJECT, marker=last, connpool=dstconnpool)
-            for dstobj in dstobjects:
-                processed += 1
-                srccontainer.conn = srcconnpool.get()
-                try:
-                    srcobj = srccontainer.get_object(dstobj.name)   # Does a HEAD
-                except cloudfiles.errors.NoSuchObject as e:
-                    # File was deleted on the source
-                    print "Deleting object", dstobj.name.encode("ascii", errors="ignore")
+def parse_last_modified(last_modified):
+    """Convert a container listing last_modified to seconds since the epoch"""
+    return calendar.timegm(time.strptime(last_modified[:19], '%Y-%m-%dT%H:%M:%S'))
 
-                    deletes += 1
-                    dstcontainer.conn = dstconnpool.get()
-                    try:
-                        dstcontainer.delete_object(dstobj.name)
-                    finally:
-                        dstconnpool.put(dstcontainer.conn)
-                        dstcontainer.conn = None
+def format_last_modified(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp))
 
-            last = dstobj.name.encode("utf-8")
+def sync_container(srccontainer, srcconnpool, dstconnpool, filename_regexp, copypool=None,
+                   checkpoints=None, dstheads=None):
 
-            pct = lambda x, y: y != 0 and int(float(x) / y * 100) or 0
-            print ("STATS: %s processed: %d/%d (%d%%), deleted: %d" %
-                   (srccontainer.name,
-                    processed, dstcontainer.object_count,
-                    pct(processed, dstcontainer.object_count),
-                    deletes))
+    last = ''
+    hits, processed, skipped, listed, gets = 0, 0, 0, 0, 0
+    newest = ''
+
+    checkpoint = None
+    if checkpoints is not None:
+        checkpoint = checkpoints.get('sync', srccontainer.name)
+        if checkpoint:
+            last = checkpoint['marker'].encode("utf-8")
+            hits, processed, skipped = checkpoint['hits'], checkpoint['processed'], checkpoint['skipped']
+            newest = checkpoint.get('newest', '')
+            print "Resuming %s after %s" % (srccontainer.name, checkpoint['marker'].encode("ascii", errors="ignore"))
+
+    # In incremental mode, only compare objects modified since the newest
+    # last_modified of the previous pass, and skip containers whose object
+    # count and size haven't changed at all; every options.full_verify_every
+    # passes, compare everything regardless
+    since = None
+    if options.incremental:
+        hwm = checkpoints.get('incremental', srccontainer.name)
+        refresh_container(srccontainer, srcconnpool)
+        full_verify = not hwm or hwm['passes'] + 1 >= options.full_verify_every
+        if (not full_verify and not checkpoint and
+                hwm['object_count'] == srccontainer.object_count and
+                hwm['bytes_used'] == srccontainer.size_used):
+            checkpoints.update('incremental', srccontainer.name, **dict(hwm, passes=hwm['passes'] + 1))
+            print "UNCHANGED:", srccontainer.name
+            report_progress(srccontainer, processed=srccontainer.object_count,
+                            hits=srccontainer.object_count, finished=1)
+            return
+        if not full_verify:
+            since = format_last_modified(parse_last_modified(hwm['last_modified']) - options.incremental_slack)
 
-            if len(dstobjects) < NOBJECT:
-                break
-        print "FINISHED:", srccontainer.name
+    dstconn = dstconnpool.get()
+    try:
+        try:
+            dstcontainer = dstconn.get_container(srccontainer.name)
+        except cloudfiles.errors.NoSuchContainer as e:
+            create_container(dstconn, srccontainer.name)
+            dstcontainer = dstconn.get_container(srccontainer.name)
     finally:
-        srcconnpool.put(srccontainer.conn)
-        srccontainer.conn = None
+        dstconnpool.put(dstconn)
+        dstconn = None
+
+    batch = CopyBatch(options.container_concurrency)
+    srcobjects = list_container_objects(srccontainer, last, srcconnpool)
+    reconciled = False
+    if since is None:
+        if dstindex is not None and not options.incremental and dstindex.fresh(srccontainer.name):
+            dstobjects = dstindex.iter_objects(dstcontainer, marker=last)
+        else:
+            dstobjects = list_container_objects(dstcontainer, last, dstconnpool)
+            if dstindex is not None:
+                dstobjects = dstindex.reconcile(dstcontainer, dstobjects, marker=last)
+                reconciled = True
+        diff = diff_listings(srcobjects, dstobjects)
+    else:
+        diff = resolve_modified(diff_modified_since(srcobjects, since), dstcontainer,
+                                dstheads, filename_regexp)
+
+    for state, srcobj, dstobj in diff:
+        listed += 1
+        last = srcobj.name.encode("utf-8")
+        newest = max(newest, srcobj.last_modified)
+        objname = srcobj.name.encode("ascii", errors="ignore")
+        if filename_regexp is not None and not filename_regexp.match(objname):
+            skipped += 1
+        else:
+            processed += 1
+            metrics.count('compared', srccontainer.name)
+            if since is not None and srcobj.last_modified > since:
+                gets += 1
+            if (state == MISMATCH and options.segment_threshold and
+                    srcobj.size >= options.segment_threshold and
+                    segmented_copy_current(srcobj, dstobj, dstconnpool)):
+                state = IDENTICAL
+            if state in (IDENTICAL, UNCHANGED):
+                hits += 1
+            else:
+                if state == MISSING:
+                    #print "Destination does not have %s, syncing" % objname
+                    object_record = dict.fromkeys(['content_type', 'bytes', 'last_modified', 'hash'], None)
+                    object_record['name'] = srcobj.name
+                    dstobj = cloudfiles.storage_object.Object(dstcontainer, object_record=object_record)
+                else:
+                    print "%s\t%s\tE-Tag mismatch: %s/%s, syncing" % (srccontainer.name, objname, srcobj.etag, dstobj.etag)
+
+                if copypool is None:
+                    replicate_object(srcobj, dstobj, srcconnpool, dstconnpool)
+                else:
+                    if batch.error is not None:
+                        # Give up on the container, as the serial path does
+                        batch.wait()
+                        raise batch.error
+                    copypool.submit(srcobj, dstobj, batch)
+
+        if listed % NOBJECT == 0:
+            print_sync_stats(srccontainer, processed, hits, skipped)
+
+            if checkpoints is not None and listed % (NOBJECT * options.checkpoint_interval) == 0:
+                # Everything up to last must have been copied first
+                batch.wait()
+                if dstindex is not None:
+                    dstindex.flush()
+                if batch.error is None:
+                    checkpoints.update('sync', srccontainer.name, last, hits=hits,
+                                       processed=processed, skipped=skipped, newest=newest)
+
+    batch.wait()
+    if batch.error is not None:
+        raise batch.error
+
+    if listed % NOBJECT != 0:
+        print_sync_stats(srccontainer, processed, hits, skipped)
+
+    if dstindex is not None:
+        dstindex.finish_pass(srccontainer.name, reconciled)
+    if checkpoints is not None:
+        checkpoints.clear('sync', srccontainer.name)
+    if options.incremental:
+        if hwm:
+            newest = max(newest, hwm['last_modified'])
+        checkpoints.update('incremental', srccontainer.name, last_modified=newest,
+                           object_count=srccontainer.object_count,
+                           bytes_used=srccontainer.size_used,
+                           passes=(0 if since is None else hwm['passes'] + 1))
+    if since is not None:
+        print "INCREMENTAL: %s modified since %s: %d" % (srccontainer.name, since, gets)
+    report_progress(srccontainer, processed=processed, hits=hits, skipped=skipped, finished=1)
+    print "FINISHED:", srccontainer.name
 
-def sync_deletes(srccontainer, srcconnpool, dstconnpool, filename_regexp):
+def print_sync_stats(srccontainer, processed, hits, skipped):
+    pct = lambda x, y: y != 0 and int(float(x) / y * 100) or 0
+    print ("STATS: %s processed: %d/%d (%d%%), hit rate: %d%%, skipped %d/%d (%d%%)" %
+           (srccontainer.name,
+            processed, srccontainer.object_count,
+            pct(processed, srccontainer.object_count),
+            pct(hits, processed),
+            skipped, srccontainer.object_count,
+            pct(skipped, srccontainer.object_count),
+            ))
+    report_progress(srccontainer, processed=processed, hits=hits, skipped=skipped)
+
+def sync_deletes(srccontainer, srcconnpool, dstconnpool, filename_regexp, checkpoints=None,
+                 srcheads=None, deleter=None, report=None):
 
     dstconn = dstconnpool.get()
     try:
         dstcontainer = dstconn.get_container(srccontainer.name)
     except cloudfiles.errors.NoSuchContainer as e:
         # Destination container doesn't exist; nothing to delete
+        report_progress(srccontainer, finished=1)
         return
     finally:
         dstconnpool.put(dstconn)
@@ -430,7 +2269,15 @@ def sync_deletes(srccontainer, srcconnpool, dstconnpool, filename_regexp):
     srclimit = int(srclimit * 1.2)
 
     last = ''
-    deletes, processed, skipped = 0, 0, 0
+    deletes, processed, skipped, pages = 0, 0, 0, 0
+
+    if checkpoints is not None:
+        checkpoint = checkpoints.get('deletes', srccontainer.name)
+        if checkpoint:
+            last = checkpoint['marker'].encode("utf-8")
+            deletes, processed, skipped = checkpoint['deletes'], checkpoint['processed'], checkpoint['skipped']
+            print "Resuming %s after %s" % (srccontainer.name, checkpoint['marker'].encode("ascii", errors="ignore"))
+
     while True:
 
         dstobjects = get_container_objects(dstcontainer, limit=dstlimit, marker=last, connpool=dstconnpool)
@@ -445,44 +2292,170 @@ def sync_deletes(srccontainer, srcconnpool, dstconnpool, filename_regexp):
         srcset = set([obj.name for obj in srcobjects])
         diff = dstset - srcset
 
+        candidates = []
         for dstname in diff:
             if filename_regexp is not None and not filename_regexp.match(dstname):
                 skipped += 1
                 continue
-            # do a HEAD to make sure it's gone
-            srccontainer.conn = srcconnpool.get()
-            try:
-                srcobj = srccontainer.get_object(dstname)   # Does a HEAD
-            except cloudfiles.errors.NoSuchObject as e:
-                # File was deleted on the source
-                print "Deleting object", dstname.encode("ascii", errors="ignore")
-
-                deletes += 1
-                dstcontainer.conn = dstconnpool.get()
-                try:
-                    dstcontainer.delete_object(dstname)
-                finally:
-                    dstconnpool.put(dstcontainer.conn)
-                    dstcontainer.conn = None
-            finally:
-                srcconnpool.put(srccontainer.conn)
-                srccontainer.conn = None
+            candidates.append(dstname)
+
+        # HEAD the candidates to make sure they're gone from the source
+        present = srcheads.head(srccontainer.name, candidates) if candidates else {}
+        orphans = sorted(name for name in candidates if name not in present)
+
+        for dstname in orphans:
+            print "%s object" % ("Would delete" if options.dry_run else "Deleting"), \
+                dstname.encode("ascii", errors="ignore")
+        if orphans and not options.dry_run:
+            manifests = segmented_copies([obj for obj in dstobjects if obj.name in orphans],
+                                         dstconnpool)
+            deleter.delete(dstcontainer.name, [name for name in orphans if name not in manifests])
+            deleter.delete(dstcontainer.name, sorted(manifests), manifests=True)
+            if dstindex is not None:
+                dstindex.delete(dstcontainer.name, orphans)
+        if report is not None:
+            report.write(dstcontainer.name, orphans)
+        deletes += len(orphans)
 
         last = dstobjects[-1].name.encode("utf-8")
         processed += len(dstobjects)
+        pages += 1
+
+        if checkpoints is not None and pages % options.checkpoint_interval == 0:
+            checkpoints.update('deletes', srccontainer.name, last,
+                               deletes=deletes, processed=processed, skipped=skipped)
 
         pct = lambda x, y: y != 0 and int(float(x) / y * 100) or 0
-        print ("STATS: %s processed: %d/%d (%d%%), deleted: %d, skipped %d/%d (%d%%)" %
+        print ("STATS: %s processed: %d/%d (%d%%), %s: %d, skipped %d/%d (%d%%)" %
                (srccontainer.name,
                 processed, dstcontainer.object_count,
                 pct(processed, dstcontainer.object_count),
-                deletes,
+                "would delete" if options.dry_run else "deleted", deletes,
                 skipped, dstcontainer.object_count,
                 pct(skipped, dstcontainer.object_count),
                 ))
+        report_progress(dstcontainer, processed=processed, deletes=deletes, skipped=skipped)
 
         if len(dstobjects) < dstlimit:
             break
+
+    if checkpoints is not None:
+        checkpoints.clear('deletes', srccontainer.name)
+    report_progress(dstcontainer, processed=processed, deletes=deletes, skipped=skipped, finished=1)
+    print "FINISHED:", srccontainer.name
+
+def sync_report(srccontainer, srcconnpool, dstconnpool, filename_regexp, report):
+    """
+    Diff a container like sync_container does, but only record what is
+    missing from, mismatched on and orphaned on the destination in report
+    """
+    dstconn = dstconnpool.get()
+    try:
+        dstcontainer = dstconn.get_container(srccontainer.name)
+    except cloudfiles.errors.NoSuchContainer as e:
+        # Everything is missing
+        dstcontainer = None
+    finally:
+        dstconnpool.put(dstconn)
+
+    srcobjects = list_container_objects(srccontainer, '', srcconnpool)
+    dstobjects = []
+    if dstcontainer is not None:
+        dstobjects = list_container_objects(dstcontainer, '', dstconnpool)
+
+    counts = collections.Counter()
+    entries = []
+    listed = 0
+    # Entries only reach the report along with the summary, so that a retry
+    # after an error part way through doesn't report them twice
+    buf = tempfile.TemporaryFile()
+    try:
+        for state, srcobj, dstobj in diff_listings(srcobjects, dstobjects, orphans=True):
+            obj = srcobj or dstobj
+            if filename_regexp is not None and not filename_regexp.match(obj.name.encode("ascii", errors="ignore")):
+                if srcobj is not None:
+                    counts['skipped'] += 1
+                continue
+            if (state == MISMATCH and options.segment_threshold and
+                    srcobj.size >= options.segment_threshold and
+                    segmented_copy_current(srcobj, dstobj, dstconnpool)):
+                state = IDENTICAL
+            counts[state] += 1
+            counts[state + '_bytes'] += obj.size
+            if report.names and state != IDENTICAL:
+                entries.append((state, obj))
+                if len(entries) >= NOBJECT:
+                    report.objects(buf, srccontainer.name, entries)
+                    entries = []
+            if srcobj is not None:
+                listed += 1
+                if listed % NOBJECT == 0:
+                    print_sync_stats(srccontainer, listed - counts['skipped'],
+                                     counts[IDENTICAL], counts['skipped'])
+
+        report.objects(buf, srccontainer.name, entries)
+        report.summary(srccontainer.name, counts, buf)
+    finally:
+        buf.close()
+    print ("REPORT: %s missing: %d (%d bytes), mismatch: %d (%d bytes), orphaned: %d (%d bytes)" %
+           (srccontainer.name, counts[MISSING], counts[MISSING + '_bytes'],
+            counts[MISMATCH], counts[MISMATCH + '_bytes'], counts[ORPHANED], counts[ORPHANED + '_bytes']))
+    report_progress(srccontainer, processed=listed - counts['skipped'], hits=counts[IDENTICAL],
+                    skipped=counts['skipped'], finished=1)
+    print "FINISHED:", srccontainer.name
+
+def sync_queue(srccontainer, srcconnpool, dstconnpool, filename_regexp, copypool, work):
+    """
+    Copy the objects of srccontainer in work, a list of (name, etag, bytes,
+    last_modified) as load_work_queue() returns, without listing anything
+    """
+    dstconn = dstconnpool.get()
+    try:
+        try:
+            dstcontainer = dstconn.get_container(srccontainer.name)
+        except cloudfiles.errors.NoSuchContainer as e:
+            create_container(dstconn, srccontainer.name)
+            dstcontainer = dstconn.get_container(srccontainer.name)
+    finally:
+        dstconnpool.put(dstconn)
+
+    batch = CopyBatch(options.container_concurrency)
+    processed, skipped = 0, 0
+    pct = lambda x, y: y != 0 and int(float(x) / y * 100) or 0
+    for name, etag, size, last_modified in work:
+        if filename_regexp is not None and not filename_regexp.match(name.encode("ascii", errors="ignore")):
+            skipped += 1
+            continue
+        processed += 1
+        metrics.count('compared', srccontainer.name)
+        srcobj = cloudfiles.storage_object.Object(srccontainer, object_record={
+            'name': name, 'hash': etag, 'bytes': size, 'last_modified': last_modified, 'content_type': None})
+        object_record = dict.fromkeys(['content_type', 'bytes', 'last_modified', 'hash'], None)
+        object_record['name'] = name
+        dstobj = cloudfiles.storage_object.Object(dstcontainer, object_record=object_record)
+
+        if copypool is None:
+            replicate_object(srcobj, dstobj, srcconnpool, dstconnpool)
+        else:
+            if batch.error is not None:
+                batch.wait()
+                raise batch.error
+            copypool.submit(srcobj, dstobj, batch)
+
+        if processed % NOBJECT == 0:
+            print "STATS: %s copied: %d/%d (%d%%), skipped %d" % \
+                (srccontainer.name, processed, len(work), pct(processed, len(work)), skipped)
+            report_progress(srccontainer, processed=processed, skipped=skipped)
+
+    batch.wait()
+    if batch.error is not None:
+        raise batch.error
+    if dstindex is not None:
+        dstindex.flush()
+
+    print "STATS: %s copied: %d/%d (%d%%), skipped %d" % \
+        (srccontainer.name, processed, len(work), pct(processed, len(work)), skipped)
+    report_progress(srccontainer, processed=processed, skipped=skipped, finished=1)
     print "FINISHED:", srccontainer.name
 
 def replicator_thread(*args, **kwargs):
@@ -495,10 +2468,22 @@ def replicator_thread(*args, **kwargs):
 
             if options.sync_deletes:
                 sync_deletes(container, kwargs['srcconnpool'],
-                        kwargs['dstconnpool'], kwargs['filename_regexp'])
+                        kwargs['dstconnpool'], kwargs['filename_regexp'],
+                        kwargs['checkpoints'], kwargs['srcheads'],
+                        kwargs['deleter'], kwargs['report'])
+            elif options.report:
+                sync_report(container, kwargs['srcconnpool'],
+                        kwargs['dstconnpool'], kwargs['filename_regexp'],
+                        kwargs['diffreport'])
+            elif workqueue is not None:
+                sync_queue(container, kwargs['srcconnpool'],
+                        kwargs['dstconnpool'], kwargs['filename_regexp'],
+                        kwargs['copypool'], workqueue[container.name])
             else:
                 sync_container(container, kwargs['srcconnpool'],
-                        kwargs['dstconnpool'], kwargs['filename_regexp'])
+                        kwargs['dstconnpool'], kwargs['filename_regexp'],
+                        kwargs['copypool'], kwargs['checkpoints'],
+                        kwargs['dstheads'])
 
             if not options.once:  # once
                 containers.append(container)
@@ -509,6 +2494,157 @@ def replicator_thread(*args, **kwargs):
             containers.append(container)
 
 
+def use_gevent():
+    """
+    Run the replicator threads and worker pools as greenlets, with the
+    socket, ssl, select and time.sleep calls underneath httplib and
+    cloudfiles made cooperative, so that one process can keep thousands of
+    copies in flight
+    """
+    from gevent import monkey
+    monkey.patch_all()
+    # Recreate the objects that were instantiated before patching
+    varnish_pool.lock = threading.Lock()
+    BodyCopier.local = threading.local()
+    metrics.lock = threading.Lock()
+
+def raise_nofile_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        if hard != resource.RLIM_INFINITY:
+            needed = min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+
+def container_shard(name, shards):
+    """Deterministically assign a container to one of shards workers"""
+    return (zlib.crc32(name.encode("utf-8")) & 0xffffffff) % shards
+
+def report_progress(container, **counters):
+    """Send a container's counters to the supervisor, if there is one"""
+    if progress_fd is not None:
+        record = dict(counters, container=container.name, objects=container.object_count)
+        # Short enough for a single atomic write to the pipe
+        os.write(progress_fd, json.dumps(record) + '\n')
+
+class ShardSupervisor(object):
+    """
+    Forks one worker process per shard, restarts any that die, and prints
+    aggregated STATS lines from the progress records the workers write to
+    their pipes.
+
+    With --once, workers that exit successfully are done; otherwise every
+    exit is a failure. Workers that die within min_uptime seconds of
+    starting are restarted after restart_delay seconds.
+    """
+    def __init__(self, processes, target, interval=30, min_uptime=60, restart_delay=10):
+        self.processes = processes
+        self.target = target
+        self.interval = interval
+        self.min_uptime = min_uptime
+        self.restart_delay = restart_delay
+        self.workers = {}   # read fd -> [shard, pid, started, buffered]
+        self.restarts = []  # (time, shard)
+        self.progress = {}  # container -> latest record
+        self.restart_count = 0
+
+    def start(self, shard):
+        rfd, wfd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            global progress_fd
+            os.close(rfd)
+            for fd in self.workers:
+                os.close(fd)
+            progress_fd = wfd
+            code = 1
+            try:
+                code = self.target((shard, self.processes)) or 0
+            except SystemExit as e:
+                code = e.code or 0
+                if not isinstance(code, int):
+                    print >> sys.stderr, code
+                    code = 1
+            except:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        os.close(wfd)
+        self.workers[rfd] = [shard, pid, time.time(), '']
+        print "Started worker %d for shard %d/%d" % (pid, shard, self.processes)
+
+    def reap(self, rfd):
+        shard, pid, started, buffered = self.workers.pop(rfd)
+        os.close(rfd)
+        pid, status = os.waitpid(pid, 0)
+        if options.once and os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            print "Worker %d for shard %d/%d finished" % (pid, shard, self.processes)
+            return
+        print >> sys.stderr, "Worker %d for shard %d/%d died (status %d), restarting" % (
+            pid, shard, self.processes, status)
+        self.restart_count += 1
+        delay = self.restart_delay if time.time() - started < self.min_uptime else 0
+        self.restarts.append((time.time() + delay, shard))
+
+    def read(self, rfd):
+        data = os.read(rfd, 65536)
+        if not data:
+            self.reap(rfd)
+            return
+        worker = self.workers[rfd]
+        lines = (worker[3] + data).split('\n')
+        worker[3] = lines.pop()
+        for line in lines:
+            record = json.loads(line)
+            self.progress[record['container']] = record
+
+    def print_stats(self):
+        pct = lambda x, y: y != 0 and int(float(x) / y * 100) or 0
+        records = self.progress.values()
+        total = lambda key: sum(record.get(key, 0) for record in records)
+        objects, processed, hits = total('objects'), total('processed'), total('hits')
+        print ("STATS: all shards processed: %d/%d (%d%%), hit rate: %d%%, skipped: %d, "
+               "deleted: %d, finished: %d/%d containers, workers: %d/%d, restarts: %d" %
+               (processed, objects, pct(processed, objects), pct(hits, processed),
+                total('skipped'), total('deletes'), total('finished'), len(records),
+                len(self.workers), self.processes, self.restart_count))
+
+    def run(self):
+        for shard in range(self.processes):
+            self.start(shard)
+        last_stats = time.time()
+        try:
+            while self.workers or self.restarts:
+                now = time.time()
+                for when, shard in [restart for restart in self.restarts if restart[0] <= now]:
+                    self.restarts.remove((when, shard))
+                    self.start(shard)
+                if self.workers:
+                    readable = select.select(list(self.workers), [], [], 1)[0]
+                    for rfd in readable:
+                        self.read(rfd)
+                else:
+                    time.sleep(1)
+                if time.time() - last_stats >= self.interval:
+                    self.print_stats()
+                    last_stats = time.time()
+        finally:
+            for shard, pid, started, buffered in self.workers.values():
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        self.print_stats()
+
+def supervise(processes, container_regexp, filename_regexp):
+    target = lambda shard: replicate(container_regexp, filename_regexp, shard)
+    ShardSupervisor(processes, target).run()
+
+
 def parse_config(config_path):
     config = ConfigParser.SafeConfigParser()
     config.read(config_path)
@@ -524,18 +2660,110 @@ def parse_config(config_path):
 
 
 def main():
-    global options, containers, src, dst
+    global options, containers, src, dst, workqueue
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', dest='config', default='swiftrepl.conf')
     parser.add_argument('--shuffle', '-r', dest='shuffle', action='store_true', default=False)
     parser.add_argument('--threads', '-t', dest='threads', type=int, default=16)
+    parser.add_argument('--engine', dest='engine', choices=['threads', 'gevent'], default='threads',
+                        help='run threads and workers as OS threads or as gevent greenlets')
+    parser.add_argument('--processes', dest='processes', type=int, default=1,
+                        help='fork this many workers, each replicating a fixed shard of the containers')
+    parser.add_argument('--copy-workers', dest='copy_workers', type=int, default=16,
+                        help='threads copying objects, shared by all containers; 0 copies serially')
+    parser.add_argument('--copy-backlog', dest='copy_backlog', type=int, default=None,
+                        help='maximum copy jobs queued ahead of the workers (default: 4 per worker)')
+    parser.add_argument('--container-concurrency', dest='container_concurrency', type=int, default=0,
+                        metavar='COPIES', help='maximum copies in flight per container, 0 for no limit')
+    parser.add_argument('--segment-threshold', dest='segment_threshold', type=int, default=0, metavar='BYTES',
+                        help='copy objects of at least BYTES as static large objects, 0 never to; '
+                        'with --sync-deletes, delete such copies along with their segments')
+    parser.add_argument('--segment-size', dest='segment_size', type=int, default=256 * 1024 * 1024,
+                        metavar='BYTES', help='size of the segments of large object copies')
+    parser.add_argument('--segment-workers', dest='segment_workers', type=int, default=4,
+                        help='threads copying large object segments in parallel')
+    parser.add_argument('--pool-size', dest='pool_size', type=int, default=None,
+                        help='maximum connections per cluster (default: 2 per thread and copy worker)')
+    parser.add_argument('--token-lifetime', dest='token_lifetime', type=int, default=3600, metavar='SECONDS',
+                        help='re-authenticate after SECONDS even without a 401')
+    parser.add_argument('--head-workers', dest='head_workers', type=int, default=4,
+                        help='threads checking object existence in incremental and --sync-deletes mode')
+    parser.add_argument('--head-depth', dest='head_depth', type=int, default=32, metavar='REQUESTS',
+                        help='HEAD requests pipelined on each connection at once')
+    parser.add_argument('--src-rate', dest='src_rate', type=float, default=0, metavar='REQUESTS',
+                        help='maximum requests per second to the source cluster, 0 for no limit')
+    parser.add_argument('--dst-rate', dest='dst_rate', type=float, default=0, metavar='REQUESTS',
+                        help='maximum requests per second to the destination cluster, 0 for no limit')
+    parser.add_argument('--src-bandwidth', dest='src_bandwidth', type=float, default=0, metavar='BYTES',
+                        help='maximum bytes per second read from the source cluster, 0 for no limit')
+    parser.add_argument('--dst-bandwidth', dest='dst_bandwidth', type=float, default=0, metavar='BYTES',
+                        help='maximum bytes per second written to the destination cluster, 0 for no limit')
+    parser.add_argument('--latency-target', dest='latency_target', type=float, default=2.0, metavar='SECONDS',
+                        help='grow the per-cluster concurrency while requests complete within SECONDS')
+    parser.add_argument('--retries', dest='retries', type=int, default=5,
+                        help='attempts per object copy or listing page, with jittered exponential backoff')
     parser.add_argument('--use-varnish', dest='use_varnish', action='store_true', default=False)
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=262144, metavar='BYTES',
+                        help='size of the per-thread object transfer buffer')
+    parser.add_argument('--splice', dest='splice', action='store_true', default=False,
+                        help='move object data between sockets with splice(2) where possible')
     parser.add_argument('--once', '-o', dest='once', action='store_true', default=False)
     parser.add_argument('--sync-deletes', '-d', dest='sync_deletes', action='store_true', default=False)
+    parser.add_argument('--delete-batch', dest='delete_batch', type=int, default=1000, metavar='OBJECTS',
+                        help='objects per bulk-delete request')
+    parser.add_argument('--delete-rate', dest='delete_rate', type=float, default=1000, metavar='OBJECTS',
+                        help='maximum objects deleted per second, 0 for no limit')
+    parser.add_argument('--delete-workers', dest='delete_workers', type=int, default=8,
+                        help='threads issuing single DELETEs where bulk delete is unavailable')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+                        help='with --sync-deletes, only report what would be deleted')
+    parser.add_argument('--delete-report', dest='delete_report', metavar='FILE',
+                        help='append the container and name of every deleted object to FILE')
+    parser.add_argument('--report', dest='report', metavar='FILE',
+                        help='only diff the selected containers, and write what is missing, mismatched '
+                        'and orphaned to FILE (gzip-compressed if FILE ends in .gz)')
+    parser.add_argument('--report-format', dest='report_format', choices=['tsv', 'json'], default='tsv',
+                        help='write the report as TSV or as JSON lines')
+    parser.add_argument('--report-names', dest='report_names', action='store_true', default=False,
+                        help='list every missing, mismatched and orphaned object in the report, '
+                        'not only per-container totals')
+    parser.add_argument('--work-queue', dest='work_queue', metavar='FILE', action='append',
+                        help='only copy the missing and mismatched objects listed in a --report-names '
+                        'report FILE; may be given more than once')
+    parser.add_argument('--dest-index', dest='dest_index', metavar='FILE',
+                        help='diff against a local SQLite index of the destination kept in FILE')
+    parser.add_argument('--index-reconcile-every', dest='index_reconcile_every', type=int, default=24,
+                        metavar='PASSES', help='list the destination for real every PASSES passes')
+    parser.add_argument('--listing-prefetch', dest='listing_prefetch', type=int, default=2, metavar='PAGES',
+                        help='list up to PAGES pages ahead of the comparison, 0 to list inline')
+    parser.add_argument('--listing-partitions', dest='listing_partitions', type=int, default=1,
+                        metavar='N', help='list N hex-prefix ranges of each container in parallel '
+                        '(1, 16 or 256, for names starting with a hash)')
+    parser.add_argument('--metrics-json', dest='metrics_json', metavar='FILE',
+                        help='append counters and latency percentiles to FILE as JSON lines')
+    parser.add_argument('--metrics-textfile', dest='metrics_textfile', metavar='FILE',
+                        help='write counters and latency histograms to FILE in the Prometheus text format')
+    parser.add_argument('--metrics-interval', dest='metrics_interval', type=int, default=60, metavar='SECONDS',
+                        help='emit metrics every SECONDS')
     parser.add_argument('--container-set', dest='container_set', metavar='SET')
     parser.add_argument('--container-regexp', dest='container_regexp', metavar='REGEXP')
     parser.add_argument('--filename-regexp', dest='filename_regexp', metavar='REGEXP')
+    parser.add_argument('--checkpoint', dest='checkpoint', metavar='FILE',
+                        help='record per-container listing markers in FILE')
+    parser.add_argument('--checkpoint-interval', dest='checkpoint_interval', type=int, default=10,
+                        metavar='PAGES', help='save checkpoints every PAGES listing pages')
+    parser.add_argument('--resume', dest='resume', action='store_true', default=False,
+                        help='continue from the markers saved in the checkpoint file')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', default=False,
+                        help='skip unchanged containers and only compare objects modified since the last pass; '
+                        'with --checkpoint, the last pass of an earlier run counts, with or without --resume')
+    parser.add_argument('--full-verify-every', dest='full_verify_every', type=int, default=24, metavar='PASSES',
+                        help='in incremental mode, compare all objects every PASSES passes')
+    parser.add_argument('--incremental-slack', dest='incremental_slack', type=int, default=3600, metavar='SECONDS',
+                        help='also compare objects up to SECONDS older than the last pass high-water mark')
+    parser.add_argument('--reset-checkpoints', dest='reset_checkpoints', action='store_true', default=False,
+                        help='forget the checkpoints of the selected containers and exit')
     options = parser.parse_args()
 
     src, dst, container_sets = parse_config(options.config)
@@ -561,8 +2789,109 @@ def main():
         except re.error as e:
             parser.error('cannot compile %r: %r' % (options.filename_regexp, e))
 
-    srcconnpool = connect(src)
-    dstconnpool = connect(dst)
+    if (options.resume or options.reset_checkpoints) and not options.checkpoint:
+        parser.error('--resume and --reset-checkpoints require --checkpoint')
+    if options.checkpoint_interval < 1:
+        parser.error('checkpoint-interval must be at least 1')
+    if options.incremental and options.sync_deletes:
+        parser.error('--incremental only applies to copy passes, not --sync-deletes')
+    if options.full_verify_every < 1:
+        parser.error('full-verify-every must be at least 1')
+
+    if options.chunk_size < 1:
+        parser.error('chunk-size must be positive')
+    if options.splice and splice is None:
+        parser.error('--splice is not supported on this platform')
+
+    if options.copy_workers < 0:
+        parser.error('copy-workers must not be negative')
+    if options.segment_threshold < 0 or options.segment_size < 1 or options.segment_workers < 1:
+        parser.error('segment-threshold must not be negative, segment-size and segment-workers positive')
+    if options.container_concurrency < 0:
+        parser.error('container-concurrency must not be negative')
+    if options.engine == 'gevent':
+        if options.splice:
+            parser.error('--splice blocks the gevent hub, use --engine threads')
+        try:
+            import gevent
+        except ImportError as e:
+            parser.error('--engine gevent requires gevent: %s' % e)
+    if options.processes < 1:
+        parser.error('processes must be at least 1')
+    if min(options.src_rate, options.dst_rate, options.src_bandwidth, options.dst_bandwidth) < 0:
+        parser.error('rates and bandwidths must not be negative')
+    if options.latency_target <= 0 or options.retries < 1:
+        parser.error('latency-target must be positive and retries at least 1')
+    if options.listing_prefetch < 0:
+        parser.error('listing-prefetch must not be negative')
+    if options.listing_partitions not in [16 ** i for i in range(3)]:
+        parser.error('listing-partitions must be 1, 16 or 256')
+    if options.index_reconcile_every < 1:
+        parser.error('index-reconcile-every must be at least 1')
+    if options.metrics_interval < 1:
+        parser.error('metrics-interval must be at least 1')
+    if options.copy_backlog is None:
+        options.copy_backlog = options.copy_workers * 4
+    if options.head_workers < 1 or options.head_depth < 1:
+        parser.error('head-workers and head-depth must be at least 1')
+    if options.delete_batch < 1 or options.delete_workers < 1:
+        parser.error('delete-batch and delete-workers must be at least 1')
+    if options.delete_rate < 0:
+        parser.error('delete-rate must not be negative')
+    if (options.dry_run or options.delete_report) and not options.sync_deletes:
+        parser.error('--dry-run and --delete-report require --sync-deletes')
+    if options.report_names and not options.report:
+        parser.error('--report-names requires --report')
+    if (options.report or options.work_queue) and (options.sync_deletes or options.incremental):
+        parser.error('--report and --work-queue do not apply to --sync-deletes or --incremental passes')
+    if options.report and options.work_queue:
+        parser.error('use only one of --report or --work-queue')
+    if options.work_queue:
+        try:
+            workqueue = load_work_queue(options.work_queue)
+        except (IOError, ValueError, KeyError) as e:
+            parser.error('cannot load work queue: %s' % e)
+    if options.report or options.work_queue:
+        # Both are a single pass over the containers
+        options.once = True
+    if options.reset_checkpoints:
+        # Workers that reset their checkpoints are done, not to be restarted
+        options.once = True
+    if options.report:
+        options.copy_workers = 0
+    if not (options.incremental or options.sync_deletes):
+        options.head_workers = 0
+    if not options.sync_deletes:
+        options.delete_workers = 0
+    helpers = options.copy_workers + options.head_workers + options.delete_workers + options.segment_workers
+    if options.pool_size is None:
+        options.pool_size = (options.threads + helpers) * 2
+    # Every thread may hold a connection of each cluster at once
+    if options.pool_size < options.threads + helpers:
+        parser.error('pool-size must be at least threads + copy-workers + segment-workers '
+                     '(+ head-workers and delete-workers where used)')
+
+    if options.processes > 1:
+        return supervise(options.processes, container_regexp, filename_regexp)
+    return replicate(container_regexp, filename_regexp)
+
+
+def replicate(container_regexp, filename_regexp, shard=None):
+    """
+    Replicate the containers matching container_regexp, or with shard set
+    to (index, count), only those of them container_shard() assigns to
+    shard index
+    """
+    global containers, dstindex, segmentpool
+
+    if options.engine == 'gevent':
+        use_gevent()
+
+    # Connections of both clusters, Varnish and some slack
+    raise_nofile_limit(options.pool_size * 2 + 256 + 64)
+
+    srcconnpool = connect('src', src)
+    dstconnpool = connect('dst', dst)
 
     srcconn = srcconnpool.get()
 
@@ -578,26 +2907,109 @@ def main():
 
     containerlist = [container for container in containers
                      if re.match(container_regexp, container.name)]
+
+    if workqueue is not None:
+        containerlist = [container for container in containerlist
+                         if container.name in workqueue]
+
+    checkpoint_path = options.checkpoint
+    index_path = options.dest_index
+    report_path = options.report
+    if shard is not None:
+        containerlist = [container for container in containerlist
+                         if container_shard(container.name, shard[1]) == shard[0]]
+        # One file per shard, so that workers never share one
+        if checkpoint_path:
+            checkpoint_path = '%s.%d' % (checkpoint_path, shard[0])
+        if index_path:
+            index_path = '%s.%d' % (index_path, shard[0])
+        if report_path:
+            root, ext = os.path.splitext(report_path)
+            report_path = '%s.%d%s' % (root, shard[0], ext)
+    if index_path:
+        dstindex = DestinationIndex(index_path, options.index_reconcile_every)
+
+    checkpoints = None
+    if options.checkpoint:
+        # Without --resume, start over and overwrite previous markers, but
+        # keep the high-water marks of incremental passes
+        load = options.resume or options.reset_checkpoints
+        if not load and options.incremental:
+            load = ['incremental']
+        checkpoints = CheckpointStore(checkpoint_path, load=load)
+        if options.reset_checkpoints:
+            checkpoints.reset([container.name for container in containerlist])
+            print "Reset checkpoints of %d containers" % len(containerlist)
+            return
+    elif options.incremental:
+        # Keep the high-water marks in memory only
+        checkpoints = CheckpointStore(None)
+
     if options.shuffle:
         random.shuffle(containerlist)
 
     containers = collections.deque(containerlist)
     srcconnpool.put(srcconn)
 
+    segmentpool = SegmentPool(options.segment_workers)
+
+    copypool = None
+    if options.copy_workers > 0:
+        copypool = CopyWorkerPool(srcconnpool, dstconnpool,
+                                  options.copy_workers, options.copy_backlog)
+
+    dstheads = srcheads = deleter = report = diffreport = None
+    if options.incremental:
+        dstheads = HeadEngine(dstconnpool, options.head_workers, options.head_depth)
+    if options.sync_deletes:
+        srcheads = HeadEngine(srcconnpool, options.head_workers, options.head_depth)
+        deleter = BulkDeleter(dstconnpool, options.delete_workers, options.delete_batch,
+                              options.delete_rate)
+        if options.delete_report:
+            report = DeleteReport(options.delete_report)
+    if report_path:
+        diffreport = DiffReport(report_path, options.report_format, options.report_names)
+
+    metrics.json_path = options.metrics_json
+    metrics.textfile_path = options.metrics_textfile
+    if metrics.textfile_path and shard is not None:
+        # The textfile collector merges every *.prom file in its directory
+        root, ext = os.path.splitext(metrics.textfile_path)
+        metrics.textfile_path = '%s.%d%s' % (root, shard[0], ext)
+    if metrics.json_path or metrics.textfile_path:
+        t = threading.Thread(target=metrics.run, args=(options.metrics_interval,))
+        t.daemon = True
+        t.start()
+
     # Start threads
+    threads = []
     for i in range(options.threads):
         t = threading.Thread(target=replicator_thread,
                              kwargs={'srcconnpool': srcconnpool,
                                      'dstconnpool': dstconnpool,
-                                     'filename_regexp': filename_regexp})
+                                     'filename_regexp': filename_regexp,
+                                     'copypool': copypool,
+                                     'checkpoints': checkpoints,
+                                     'dstheads': dstheads,
+                                     'srcheads': srcheads,
+                                     'deleter': deleter,
+                                     'report': report,
+                                     'diffreport': diffreport})
         t.daemon = True
         t.start()
+        threads.append(t)
 
-    for thread in threading.enumerate():
-        if thread is threading.currentThread():
-            continue
+    for thread in threads:
         thread.join()
 
+    if checkpoints is not None:
+        checkpoints.flush()
+    if diffreport is not None:
+        diffreport.close()
+
+    if metrics.json_path or metrics.textfile_path:
+        metrics.emit()
+
 
 if __name__ == '__main__':
     sys.exit(main())
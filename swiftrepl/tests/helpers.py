@@ -0,0 +1,114 @@
+# Shared fixtures of the swiftrepl tests: the module under test, and
+# swiftrepl runs against a pair of in-process fake Swift clusters.
+
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import fakeswift
+import swiftrepl
+
+SWIFTREPL = os.path.join(ROOT, 'swiftrepl.py')
+
+MIB = 1024 * 1024
+
+
+def seed_manifest(cluster, container, name, segments):
+    """
+    Add a static large object made of segments, a list of (container,
+    name, size, variant) seeded along with it
+    """
+    entries = []
+    for segcontainer, segname, size, variant in segments:
+        cluster.seed(segcontainer, segname, size, variant)
+        record = cluster.containers[segcontainer][segname]
+        entries.append({'name': u'/%s/%s' % (segcontainer, segname), 'hash': record['etag'],
+                        'bytes': size, 'content_type': record['content_type'],
+                        'last_modified': record['last_modified']})
+    cluster.store(container, name, {
+        'etag': hashlib.md5(''.join(entry['hash'] for entry in entries)).hexdigest(),
+        'bytes': sum(entry['bytes'] for entry in entries), 'manifest': entries})
+
+
+class ReplicationTestCase(unittest.TestCase):
+    """
+    Runs swiftrepl.py as a subprocess between two fake clusters, self.src
+    and self.dst, which the tests seed and inspect
+    """
+    timeout = 60
+
+    def setUp(self):
+        self.src = fakeswift.Cluster()
+        self.dst = fakeswift.Cluster()
+        self.servers = [fakeswift.start(cluster) for cluster in (self.src, self.dst)]
+        self.config = tempfile.NamedTemporaryFile(prefix='swiftrepl-test', suffix='.conf')
+        for name, server in zip(('src', 'dst'), self.servers):
+            self.config.write('[%s]\nusername = test\napi_key = test\n'
+                              'auth_url = http://127.0.0.1:%d/auth/v1.0\n' % (name, server.server_port))
+        self.config.flush()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.config.close()
+
+    def replicate(self, *args):
+        """Run swiftrepl with args, failing the test if it doesn't exit 0 in time"""
+        command = [sys.executable, SWIFTREPL, '--config', self.config.name] + list(args)
+        log = tempfile.TemporaryFile()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        timer = threading.Timer(self.timeout, process.kill)
+        timer.start()
+        try:
+            status = process.wait()
+        finally:
+            timer.cancel()
+        log.seek(0)
+        output = log.read()
+        self.assertEqual(status, 0, 'swiftrepl exited with %d:\n%s' % (status, output[-4096:]))
+        return output
+
+
+class ClusterTestCase(unittest.TestCase):
+    """
+    Calls swiftrepl in-process against a fake cluster, self.cluster, through
+    the connection pool self.connpool; options holds the swiftrepl.options
+    the tests need
+    """
+    options = {'retries': 2, 'segment_threshold': 0, 'segment_size': MIB}
+
+    def setUp(self):
+        self.saved_options = swiftrepl.options
+        swiftrepl.options = argparse.Namespace(**self.options)
+        self.cluster = fakeswift.Cluster()
+        self.server = fakeswift.start(self.cluster)
+        self.connpool = swiftrepl.SwiftConnectionPool(
+            'src', 4, username='test', api_key='test',
+            authurl='http://127.0.0.1:%d/auth/v1.0' % self.server.server_port, timeout=10)
+
+    def tearDown(self):
+        # Let the server threads of idle keep-alive connections finish
+        for conn, lastused in self.connpool.idle:
+            self.connpool.close(conn)
+        if self.connpool.template is not None:
+            self.connpool.close(self.connpool.template)
+        self.server.shutdown()
+        self.server.server_close()
+        swiftrepl.options = self.saved_options
+
+    def container(self, name):
+        conn = self.connpool.get()
+        try:
+            return conn.get_container(name)
+        finally:
+            self.connpool.put(conn)
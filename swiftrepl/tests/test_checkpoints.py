@@ -0,0 +1,83 @@
+import os
+import re
+import shutil
+import tempfile
+
+import unittest
+
+from helpers import ReplicationTestCase, swiftrepl
+
+
+class TestCheckpointStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'checkpoints.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reload(self):
+        store = swiftrepl.CheckpointStore(self.path, save_interval=0)
+        store.update('sync', u'bench-a', u'F\xe9le_01.jpg'.encode('utf-8'), hits=1, processed=2, skipped=0)
+        store.update('incremental', u'bench-a', last_modified=u'2016-01-01T00:00:00.000000', passes=3)
+        store.update('sync', u'bench-b', 'b', hits=0, processed=0, skipped=0)
+        store.clear('sync', u'bench-b')
+
+        reloaded = swiftrepl.CheckpointStore(self.path)
+        checkpoint = reloaded.get('sync', u'bench-a')
+        self.assertEqual(checkpoint['marker'], u'F\xe9le_01.jpg')
+        self.assertEqual(checkpoint['processed'], 2)
+        self.assertEqual(reloaded.get('incremental', u'bench-a')['passes'], 3)
+        self.assertEqual(reloaded.get('sync', u'bench-b'), {})
+
+    def test_load_modes(self):
+        store = swiftrepl.CheckpointStore(self.path, save_interval=0)
+        store.update('sync', u'bench-a', 'a', hits=0, processed=0, skipped=0)
+        store.update('incremental', u'bench-a', passes=1)
+        reloaded = swiftrepl.CheckpointStore(self.path, load=['incremental'])
+        self.assertEqual(reloaded.get('sync', u'bench-a'), {})
+        self.assertEqual(reloaded.get('incremental', u'bench-a')['passes'], 1)
+        self.assertEqual(swiftrepl.CheckpointStore(self.path, load=False).get('incremental', u'bench-a'), {})
+
+    def test_atomic_rewrite(self):
+        store = swiftrepl.CheckpointStore(self.path, save_interval=0)
+        store.update('sync', u'bench-a', 'a', processed=1)
+        # A save that fails half way leaves the previous file, and no temporary one
+        self.assertRaises(TypeError, store.update, 'sync', u'bench-a', 'b', processed=object())
+        self.assertEqual(os.listdir(self.tmpdir), ['checkpoints.json'])
+        self.assertEqual(swiftrepl.CheckpointStore(self.path).get('sync', u'bench-a')['marker'], u'a')
+
+    def test_saves_batched(self):
+        store = swiftrepl.CheckpointStore(self.path, save_interval=3600)
+        for i in range(100):
+            store.update('sync', u'bench-%02d' % i, 'a', processed=i)
+            store.clear('sync', u'bench-%02d' % i)
+            store.update('incremental', u'bench-%02d' % i, passes=1)
+        self.assertFalse(os.path.exists(self.path))
+        store.flush()
+        reloaded = swiftrepl.CheckpointStore(self.path)
+        self.assertEqual(reloaded.get('incremental', u'bench-99')['passes'], 1)
+        self.assertEqual(reloaded.get('sync', u'bench-99'), {})
+
+
+class TestResetCheckpoints(ReplicationTestCase):
+    timeout = 30
+
+    def setUp(self):
+        ReplicationTestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        ReplicationTestCase.tearDown(self)
+
+    def test_sharded_reset_exits(self):
+        # Without --once, workers that reset their checkpoints are still done
+        for i in range(4):
+            self.src.seed(u'bench-%d' % i, u'File.jpg', 1024, i)
+        output = self.replicate('--container-regexp', '^bench-', '--processes', '2',
+                                '--checkpoint', os.path.join(self.tmpdir, 'checkpoints.json'),
+                                '--reset-checkpoints')
+        self.assertEqual(len(re.findall(r'Worker \d+ for shard \d/2 finished', output)), 2)
+        self.assertNotIn('restarting', output)
@@ -0,0 +1,51 @@
+from helpers import ClusterTestCase, fakeswift, swiftrepl
+
+
+class FlakyHandler(fakeswift.Handler):
+    """Fails the first server.failures bulk deletes with a 503"""
+
+    def do_POST(self):
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            body = ''.join(self.read_body())
+            self.server.cluster.count('POST', bytes_in=len(body))
+            return self.reply(503)
+        fakeswift.Handler.do_POST(self)
+
+
+class TestBulkDeleter(ClusterTestCase):
+    options = dict(ClusterTestCase.options, retries=4)
+
+    def setUp(self):
+        ClusterTestCase.setUp(self)
+        self.names = [u'F\xe9le_%02d.jpg' % i for i in range(25)]
+        for i, name in enumerate(self.names):
+            self.cluster.seed(u'bench-a', name, 10, i)
+        self.deleter = swiftrepl.BulkDeleter(self.connpool, 2, 10)
+
+    def test_bulk(self):
+        self.cluster.reset_counters()
+        self.deleter.delete(u'bench-a', self.names[:20])
+        self.assertEqual(sorted(self.cluster.containers[u'bench-a']), self.names[20:])
+        self.assertEqual(self.cluster.requests['POST'], 2)
+        self.assertEqual(self.cluster.requests['DELETE'], 0)
+
+    def test_server_errors_retried(self):
+        self.server.RequestHandlerClass = FlakyHandler
+        self.server.failures = 2
+        self.cluster.reset_counters()
+        self.deleter.delete(u'bench-a', self.names)
+        self.assertTrue(self.deleter.bulk)
+        self.assertEqual(self.cluster.containers[u'bench-a'], {})
+        self.assertEqual(self.cluster.requests['POST'], 5)
+        self.assertEqual(self.cluster.requests['DELETE'], 0)
+
+    def test_unsupported(self):
+        # Without the middleware, the POST succeeds without a JSON body
+        self.cluster.bulk_delete = False
+        self.cluster.reset_counters()
+        self.deleter.delete(u'bench-a', self.names)
+        self.assertFalse(self.deleter.bulk)
+        self.assertEqual(self.cluster.containers[u'bench-a'], {})
+        self.assertEqual(self.cluster.requests['POST'], 1)
+        self.assertEqual(self.cluster.requests['DELETE'], 25)
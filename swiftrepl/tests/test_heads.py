@@ -0,0 +1,29 @@
+from helpers import ClusterTestCase, swiftrepl
+
+
+class TestHeadEngine(ClusterTestCase):
+
+    def setUp(self):
+        ClusterTestCase.setUp(self)
+        self.names = [u'F\xe9le_%02d.jpg' % i for i in range(20)]
+        for i, name in enumerate(self.names[::2]):
+            self.cluster.seed(u'bench-a', name, 10, i)
+        self.saved_metrics = swiftrepl.metrics
+        swiftrepl.metrics = swiftrepl.Metrics()
+
+    def tearDown(self):
+        swiftrepl.metrics = self.saved_metrics
+        ClusterTestCase.tearDown(self)
+
+    def test_head(self):
+        etags = swiftrepl.HeadEngine(self.connpool, 2, 5).head(u'bench-a', self.names)
+        self.assertEqual(etags, dict((name, self.cluster.containers[u'bench-a'][name]['etag'])
+                                     for name in self.names[::2]))
+
+    def test_latency_per_request(self):
+        # Responses later in a pipeline don't count the ones before them
+        self.cluster.latency = 0.05
+        swiftrepl.HeadEngine(self.connpool, 1, 10).head(u'bench-a', self.names[:10])
+        histogram = swiftrepl.metrics.latencies['src_head', u'bench-a']
+        self.assertEqual(sum(histogram[:-1]), 10)
+        self.assertLess(histogram[-1], 10 * 0.05 * 2)
@@ -0,0 +1,134 @@
+import collections
+
+import unittest
+
+from helpers import ClusterTestCase, swiftrepl
+
+Entry = collections.namedtuple('Entry', 'name etag')
+
+
+def listing(*names, **etags):
+    """A listing of names in the order given, each with etag 'x' unless in etags"""
+    return [Entry(name, etags.get(name, 'x')) for name in names]
+
+
+def swift_order(names):
+    """Sort names as Swift lists them, by their UTF-8 encoding"""
+    return sorted(names, key=lambda name: name.encode('utf-8'))
+
+
+class TestDiffListings(unittest.TestCase):
+
+    def diff(self, srcobjects, dstobjects, orphans=False):
+        return [(state, (srcobj or dstobj).name)
+                for state, srcobj, dstobj in swiftrepl.diff_listings(srcobjects, dstobjects, orphans)]
+
+    def test_states_in_order(self):
+        srcobjects = listing(u'a', u'b', u'c', u'e', u'g')
+        dstobjects = listing(u'b', u'c', u'd', u'f', u'g', u'h', c='y')
+        self.assertEqual(self.diff(srcobjects, dstobjects), [
+            (swiftrepl.MISSING, u'a'), (swiftrepl.IDENTICAL, u'b'), (swiftrepl.MISMATCH, u'c'),
+            (swiftrepl.MISSING, u'e'), (swiftrepl.IDENTICAL, u'g')])
+        self.assertEqual(self.diff(srcobjects, dstobjects, orphans=True), [
+            (swiftrepl.MISSING, u'a'), (swiftrepl.IDENTICAL, u'b'), (swiftrepl.MISMATCH, u'c'),
+            (swiftrepl.ORPHANED, u'd'), (swiftrepl.MISSING, u'e'), (swiftrepl.ORPHANED, u'f'),
+            (swiftrepl.IDENTICAL, u'g'), (swiftrepl.ORPHANED, u'h')])
+
+    def test_empty(self):
+        self.assertEqual(self.diff(listing(u'a', u'b'), []),
+                         [(swiftrepl.MISSING, u'a'), (swiftrepl.MISSING, u'b')])
+        self.assertEqual(self.diff([], listing(u'a', u'b'), orphans=True),
+                         [(swiftrepl.ORPHANED, u'a'), (swiftrepl.ORPHANED, u'b')])
+        self.assertEqual(self.diff([], listing(u'a')), [])
+
+    def test_unicode_order(self):
+        # Upper before lower case, and BMP characters before astral ones
+        # which a UTF-16 comparison would put before U+E000 and up
+        names = swift_order([u'Zebra.jpg', u'apple.jpg', u'\xe9t\xe9.jpg', u'\u4e2d.png',
+                             u'\ufb01le.jpg', u'\U0001f600.gif', u'caf\xe9.jpg', u'cafe.jpg'])
+        self.assertEqual(sorted(names), names)
+        dstnames = [name for i, name in enumerate(names) if i % 2] + [u'\U0001f601.gif']
+        diff = self.diff(listing(*names), listing(*swift_order(dstnames)), orphans=True)
+        self.assertEqual(diff, [(swiftrepl.IDENTICAL if i % 2 else swiftrepl.MISSING, name)
+                                for i, name in enumerate(names)] +
+                         [(swiftrepl.ORPHANED, u'\U0001f601.gif')])
+
+    def test_iterators(self):
+        # Listings are consumed once, in a single pass
+        srcobjects = iter(listing(u'a', u'b'))
+        dstobjects = iter(listing(u'b', u'c'))
+        self.assertEqual(self.diff(srcobjects, dstobjects, orphans=True), [
+            (swiftrepl.MISSING, u'a'), (swiftrepl.IDENTICAL, u'b'), (swiftrepl.ORPHANED, u'c')])
+
+
+class TestListPartitioned(ClusterTestCase):
+    # Names at, around and beyond the boundaries of 16 partitions
+    names = swift_order([u'0', u'00ff', u'1', u'1 a', u'1-', u'10', u'1\xe9', u'1\x01', u'2', u'9zz',
+                         u'a', u'aa', u'e\uffff', u'f', u'f0', u'ff', u'g', u'Z', u'zz', u'\xe9',
+                         u'\U0001f600'])
+
+    def setUp(self):
+        ClusterTestCase.setUp(self)
+        for i, name in enumerate(self.names):
+            self.cluster.seed(u'bench-a', name, 10, i)
+
+    def test_boundaries(self):
+        self.assertEqual(swiftrepl.partition_boundaries(2), ['1'])
+        self.assertEqual(swiftrepl.partition_boundaries(16), ['%x' % i for i in range(1, 16)])
+        self.assertEqual(swiftrepl.partition_boundaries(256)[:2], ['01', '02'])
+        self.assertEqual(len(swiftrepl.partition_boundaries(256)), 255)
+
+    def list_names(self, marker, partitions):
+        objects = swiftrepl.list_partitioned(self.container(u'bench-a'), marker, self.connpool, 2,
+                                             swiftrepl.partition_boundaries(partitions))
+        return [obj.name for obj in objects]
+
+    def test_lists_everything_once(self):
+        for partitions in (2, 16, 256):
+            self.assertEqual(self.list_names('', partitions), self.names)
+
+    def test_marker(self):
+        # A marker resumes after itself, whichever range it falls in
+        for marker in (u'1', u'1 a', u'10', u'aa', u'f', u'zz'):
+            expected = [name for name in self.names if name.encode('utf-8') > marker.encode('utf-8')]
+            self.assertEqual(self.list_names(marker.encode('utf-8'), 16), expected)
+
+    def test_end_marker(self):
+        listing = swiftrepl.ListingPrefetcher(self.container(u'bench-a'), '1', self.connpool, 2,
+                                              limit=2, end_marker='f')
+        self.assertEqual([obj.name for obj in listing],
+                         [name for name in self.names if u'1' < name < u'f'])
+        objects = swiftrepl.iter_container_objects(self.container(u'bench-a'), '', self.connpool,
+                                                   limit=2, end_marker='1\x01')
+        self.assertEqual([obj.name for obj in objects], [u'0', u'00ff', u'1'])
+
+
+
+class TestListingPrefetcher(ClusterTestCase):
+
+    def setUp(self):
+        ClusterTestCase.setUp(self)
+        for i in range(25):
+            self.cluster.seed(u'bench-a', u'File_%02d.jpg' % i, 10, i)
+
+    def test_lists_everything(self):
+        listing = swiftrepl.ListingPrefetcher(self.container(u'bench-a'), '', self.connpool, 2, limit=10)
+        self.assertEqual([obj.name for obj in listing], [u'File_%02d.jpg' % i for i in range(25)])
+
+    def test_no_thread_until_iterated(self):
+        # A listing dropped before its first page must not leave a thread behind
+        container = self.container(u'bench-a')
+        self.cluster.reset_counters()
+        listing = swiftrepl.ListingPrefetcher(container, '', self.connpool, 2, limit=10)
+        iter(listing)
+        self.assertIsNone(listing.thread)
+        self.assertEqual(self.cluster.requests['GET'], 0)
+
+    def test_close_stops_thread(self):
+        listing = swiftrepl.ListingPrefetcher(self.container(u'bench-a'), '', self.connpool, 1, limit=10)
+        objects = iter(listing)
+        self.assertEqual(next(objects).name, u'File_00.jpg')
+        objects.close()
+        self.assertTrue(listing.stopped.is_set())
+        listing.thread.join(5)
+        self.assertFalse(listing.thread.is_alive())
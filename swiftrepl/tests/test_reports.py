@@ -0,0 +1,95 @@
+import collections
+import os
+import shutil
+import tempfile
+
+import unittest
+
+from helpers import ReplicationTestCase, swiftrepl
+
+Entry = collections.namedtuple('Entry', 'name etag size last_modified')
+
+
+class TestDiffReport(unittest.TestCase):
+    entries = [
+        (swiftrepl.MISSING, Entry(u'Plain.jpg', 'a' * 32, 1024, u'2016-01-01T00:00:00.000000')),
+        (swiftrepl.MISMATCH, Entry(u'F\xe9le \u4e2d\U0001f600.png', 'b' * 32, 0, u'2016-01-02T00:00:00.000000')),
+        (swiftrepl.ORPHANED, Entry(u'Tab\tnew\nline\\n back\\slash', 'c' * 32, 7, u'2016-01-03T00:00:00.000000')),
+    ]
+    counts = collections.Counter(missing=1, missing_bytes=1024, mismatch=1, orphaned=1, orphaned_bytes=7)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_report(self, filename, fmt):
+        path = os.path.join(self.tmpdir, filename)
+        report = swiftrepl.DiffReport(path, fmt, names=True)
+        for container_name in (u'bench-a', u'b\xe9nch-b'):
+            buf = tempfile.TemporaryFile()
+            report.objects(buf, container_name, self.entries)
+            report.summary(container_name, self.counts, buf)
+        report.close()
+        return path
+
+    def check_round_trip(self, filename, fmt):
+        records = list(swiftrepl.read_report(self.write_report(filename, fmt)))
+        self.assertEqual(len(records), 2 * (len(self.entries) + 1))
+        for container_name, chunk in ((u'bench-a', records[:4]), (u'b\xe9nch-b', records[4:])):
+            for (state, entry), record in zip(self.entries, chunk):
+                self.assertEqual((record['state'], record['container'], record['name'], record['etag'],
+                                  int(record['bytes']), record['last_modified']),
+                                 (state, container_name, entry.name, entry.etag, entry.size,
+                                  entry.last_modified))
+            summary = chunk[-1]
+            self.assertEqual((summary['state'], summary['container']), ('summary', container_name))
+            for field in swiftrepl.REPORT_SUMMARY_FIELDS[2:]:
+                self.assertEqual(int(summary[field]), self.counts[field])
+
+    def test_tsv(self):
+        self.check_round_trip('report.tsv', 'tsv')
+
+    def test_tsv_gzip(self):
+        self.check_round_trip('report.tsv.gz', 'tsv')
+
+    def test_json(self):
+        self.check_round_trip('report.json', 'json')
+
+    def test_json_gzip(self):
+        self.check_round_trip('report.json.gz', 'json')
+
+    def test_malformed(self):
+        path = os.path.join(self.tmpdir, 'report.tsv')
+        with open(path, 'wb') as fp:
+            fp.write('missing\tbench-a\tPlain.jpg\n')
+        self.assertRaises(ValueError, list, swiftrepl.read_report(path))
+
+    def test_work_queue(self):
+        # Only missing and mismatched objects are queued, across reports
+        queue = swiftrepl.load_work_queue([self.write_report('report.tsv.gz', 'tsv'),
+                                           self.write_report('report.json', 'json')])
+        self.assertEqual(queue.keys(), [u'bench-a', u'b\xe9nch-b'])
+        expected = [(entry.name, entry.etag, entry.size, entry.last_modified)
+                    for state, entry in self.entries[:2]]
+        for objects in queue.values():
+            self.assertEqual(objects, expected * 2)
+
+
+class TestWorkQueue(ReplicationTestCase):
+
+    def test_content_type_kept(self):
+        # Reports don't record content types, the copies take the source's
+        for i in range(3):
+            self.src.seed(u'bench-a', u'Photo_%d.jpg' % i, 1024, i)
+            self.src.containers[u'bench-a'][u'Photo_%d.jpg' % i]['content_type'] = 'image/jpeg'
+        self.dst.create_container(u'bench-a')
+        report = tempfile.NamedTemporaryFile(suffix='.tsv')
+        self.replicate('--container-regexp', '^bench-a$', '--report', report.name, '--report-names')
+        self.replicate('--container-regexp', '^bench-a$', '--work-queue', report.name)
+
+        objects = self.dst.containers[u'bench-a']
+        self.assertEqual(len(objects), 3)
+        for record in objects.values():
+            self.assertEqual(record['content_type'], 'image/jpeg')
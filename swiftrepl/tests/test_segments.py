@@ -0,0 +1,62 @@
+from helpers import MIB, ReplicationTestCase, fakeswift, seed_manifest
+
+
+class TestStaticLargeObjects(ReplicationTestCase):
+
+    def test_manifest_segments_copied_whole(self):
+        # Segments above --segment-threshold are still copied as plain
+        # objects, or their etags wouldn't match the manifest's
+        seed_manifest(self.src, u'bench-a', u'movie.webm',
+                      [(u'bench-a_segments', u'movie.webm/%d' % i, 3 * MIB, i) for i in range(2)])
+        self.dst.create_container(u'bench-a')
+        self.replicate('--once', '--container-regexp', '^bench-a$',
+                       '--segment-threshold', str(MIB), '--segment-size', str(MIB))
+
+        manifest = self.dst.containers[u'bench-a'][u'movie.webm']
+        self.assertIn('manifest', manifest)
+        self.assertEqual(manifest['etag'], self.src.containers[u'bench-a'][u'movie.webm']['etag'])
+        segments = self.dst.containers[u'bench-a_segments']
+        self.assertEqual(sorted(segments), [u'movie.webm/0', u'movie.webm/1'])
+        for name, record in segments.items():
+            self.assertNotIn('manifest', record)
+            self.assertEqual(record['etag'], self.src.containers[u'bench-a_segments'][name]['etag'])
+        self.assertNotIn(u'bench-a_segments_segments', self.dst.containers)
+
+
+class TestSegmentedCopies(ReplicationTestCase):
+    segmenting = ('--segment-threshold', str(MIB), '--segment-size', str(MIB))
+
+    def seed_version(self, variant, last_modified):
+        self.src.store(u'bench-a', u'video.webm', {
+            'etag': fakeswift.content_etag(variant, 3 * MIB), 'bytes': 3 * MIB,
+            'variant': variant, 'last_modified': last_modified})
+
+    def test_overwrite_deletes_stale_segments(self):
+        self.seed_version(1, u'2016-01-01T00:00:00.000000')
+        self.dst.create_container(u'bench-a')
+        self.replicate('--once', '--container-regexp', '^bench-a$', *self.segmenting)
+        self.assertEqual(len(self.dst.containers[u'bench-a_segments']), 3)
+
+        self.seed_version(2, u'2016-02-01T00:00:00.000000')
+        self.replicate('--once', '--container-regexp', '^bench-a$', *self.segmenting)
+        manifest = self.dst.containers[u'bench-a'][u'video.webm']
+        self.assertEqual(manifest['meta']['swiftrepl-source-etag'],
+                         self.src.containers[u'bench-a'][u'video.webm']['etag'])
+        segments = self.dst.containers[u'bench-a_segments']
+        self.assertEqual(sorted(segments),
+                         sorted(segment['name'].split('/', 2)[2] for segment in manifest['manifest']))
+        for name in segments:
+            self.assertIn(u'/slo/2016-02-01T00:00:00.000000/', name)
+
+    def test_sync_deletes_removes_segments(self):
+        self.seed_version(1, u'2016-01-01T00:00:00.000000')
+        self.src.seed(u'bench-a', u'small.jpg', 1024, 2)
+        self.dst.create_container(u'bench-a')
+        self.replicate('--once', '--container-regexp', '^bench-a$', *self.segmenting)
+        self.assertEqual(len(self.dst.containers[u'bench-a_segments']), 3)
+
+        self.src.delete(u'bench-a', u'video.webm')
+        self.src.delete(u'bench-a', u'small.jpg')
+        self.replicate('--once', '--sync-deletes', '--container-regexp', '^bench-a$', *self.segmenting)
+        self.assertEqual(self.dst.containers[u'bench-a'], {})
+        self.assertEqual(self.dst.containers[u'bench-a_segments'], {})